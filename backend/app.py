@@ -1,9 +1,8 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context, url_for
 from flask_cors import CORS
 import os
 import sys
 import json
-import base64
 from datetime import datetime
 from dotenv import load_dotenv
 from openai import OpenAI
@@ -18,6 +17,13 @@ try:
 except ImportError:
     Database = None
 
+from funnel import parse_steps
+from pdf_jobs import PdfQueueFull, create_pdf_job_manager
+from personal_report import assemble_personal_report
+from report_cache import ReportCache
+from report_export import iter_segment_export
+from report_template import render_personal_report
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -54,6 +60,12 @@ if Database:
             print(f"Ошибка инициализации локальной БД: {e}")
             db = None
 
+# Кеш персональных отчетов (LRU по суммарному размеру, инвалидация по версии данных пользователя)
+report_cache = ReportCache(int(os.getenv('REPORT_CACHE_MAX_MB', '32')) * 1024 * 1024) if db else None
+
+# Очередь генерации PDF (пул процессов, кеш готовых файлов по хешу HTML)
+pdf_jobs = create_pdf_job_manager()
+
 @app.route('/api/health', methods=['GET'])
 def health():
     """Проверка работоспособности API"""
@@ -441,239 +453,38 @@ def get_user_analytics(tg_user_id):
     except Exception as e:
         return jsonify({'error': f'Ошибка при получении аналитики: {str(e)}'}), 500
 
+def build_personal_report(tg_user_id: int) -> dict:
+    """Собрать персональный отчет пользователя"""
+    # Информация о пользователе, персональный путь и агрегаты для сегментации —
+    # за одно соединение (два запроса, в Postgres — один round-trip)
+    return assemble_personal_report(db.get_personal_report_data(tg_user_id))
+
 @app.route('/api/user/<int:tg_user_id>/personal-report', methods=['GET'])
 def get_user_personal_report(tg_user_id):
-    """Получить полный персональный отчет пользователя"""
+    """Получить полный персональный отчет пользователя.
+
+    Отчет кешируется по версии данных пользователя; ETag строится из той же версии,
+    поэтому повторный запрос с If-None-Match без новых данных получает 304.
+    """
     if not db:
         return jsonify({'error': 'База данных не инициализирована'}), 500
 
     try:
-        # Получаем базовую информацию о пользователе
-        user_info = {
-            'tg_user_id': tg_user_id,
-            'cookie_id': None,
-            'traffic_source': 'Не определен',
-            'utm_params': {},
-            'referrer': None,
-            'first_visit_date': None
-        }
+        version = db.get_user_data_version(tg_user_id)
+        etag = f'report-{tg_user_id}-v{version}'
 
-        # Получаем информацию о пользователе из базы данных
-        conn = db.get_connection()
-        cursor = conn.cursor()
-
-        # Получаем cookie_id и информацию о первом визите
-        cursor.execute('''
-            SELECT cookie_id, source, utm_params, referrer, MIN(session_start) as first_visit
-            FROM site_sessions
-            WHERE tg_user_id = ?
-            GROUP BY cookie_id, source, utm_params, referrer
-            ORDER BY first_visit ASC
-            LIMIT 1
-        ''', (tg_user_id,))
-
-        user_row = cursor.fetchone()
-        if user_row:
-            user_info['cookie_id'] = user_row[0]
-            user_info['traffic_source'] = user_row[1] or 'Не определен'
-            user_info['utm_params'] = json.loads(user_row[2]) if user_row[2] else {}
-            user_info['referrer'] = user_row[3]
-            user_info['first_visit_date'] = user_row[4]
-
-        # Получаем персональный путь пользователя
-        journey = {
-            'miniapp_opens': [],
-            'content_views': [],
-            'ai_interactions': [],
-            'diagnostics': [],
-            'game_actions': [],
-            'cta_clicks': []
-        }
-
-        # MiniApp открытия
-        cursor.execute('''
-            SELECT DISTINCT ss.session_start, ss.page_id, ss.device_type, ss.session_start
-            FROM site_sessions ss
-            WHERE ss.tg_user_id = ?
-            ORDER BY ss.session_start DESC
-            LIMIT 20
-        ''', (tg_user_id,))
-
-        for row in cursor.fetchall():
-            journey['miniapp_opens'].append({
-                'timestamp': row[0],
-                'page': row[1] or 'Главная',
-                'device': row[2] or 'Не определено',
-                'timestamp_formatted': row[0]
-            })
-
-        # Просмотры контента
-        cursor.execute('''
-            SELECT se.created_at, se.event_name, se.metadata, se.page
-            FROM site_events se
-            WHERE se.tg_user_id = ? AND se.event_type = 'content_view'
-            ORDER BY se.created_at DESC
-            LIMIT 50
-        ''', (tg_user_id,))
-
-        for row in cursor.fetchall():
-            metadata = json.loads(row[2]) if row[2] else {}
-            journey['content_views'].append({
-                'section': metadata.get('content_type', row[1]),
-                'time_spent': metadata.get('time_spent', 0),
-                'scroll_depth': metadata.get('scroll_depth', 0),
-                'timestamp': row[0]
-            })
-
-        # AI взаимодействия
-        cursor.execute('''
-            SELECT se.created_at, se.metadata
-            FROM site_events se
-            WHERE se.tg_user_id = ? AND se.event_type = 'ai_interaction'
-            ORDER BY se.created_at DESC
-            LIMIT 30
-        ''', (tg_user_id,))
-
-        for row in cursor.fetchall():
-            metadata = json.loads(row[1]) if row[1] else {}
-            journey['ai_interactions'].append({
-                'messages_count': metadata.get('messages_count', 0),
-                'topics': metadata.get('topics', []),
-                'duration': metadata.get('duration', 0),
-                'timestamp': row[0]
-            })
-
-        # Диагностика
-        cursor.execute('''
-            SELECT se.created_at, se.metadata
-            FROM site_events se
-            WHERE se.tg_user_id = ? AND se.event_type = 'diagnostic'
-            ORDER BY se.created_at DESC
-            LIMIT 10
-        ''', (tg_user_id,))
-
-        for row in cursor.fetchall():
-            metadata = json.loads(row[1]) if row[1] else {}
-            journey['diagnostics'].append({
-                'progress': metadata.get('progress', 0),
-                'results': metadata.get('results'),
-                'time_spent': metadata.get('end_time', 0) - metadata.get('start_time', 0) if metadata.get('end_time') and metadata.get('start_time') else 0,
-                'timestamp': row[0]
-            })
-
-        # Игровые действия
-        cursor.execute('''
-            SELECT se.created_at, se.metadata
-            FROM site_events se
-            WHERE se.tg_user_id = ? AND se.event_type = 'game_action'
-            ORDER BY se.created_at DESC
-            LIMIT 20
-        ''', (tg_user_id,))
-
-        for row in cursor.fetchall():
-            metadata = json.loads(row[1]) if row[1] else {}
-            journey['game_actions'].append({
-                'game_type': metadata.get('game_type', 'Неизвестно'),
-                'action_type': metadata.get('action_type', 'Неизвестно'),
-                'achievements': metadata.get('achievement', []),
-                'scores': metadata.get('score', 0),
-                'timestamp': row[0]
-            })
-
-        # CTA клики
-        cursor.execute('''
-            SELECT se.created_at, se.metadata
-            FROM site_events se
-            WHERE se.tg_user_id = ? AND se.event_type = 'cta_click'
-            ORDER BY se.created_at DESC
-            LIMIT 20
-        ''', (tg_user_id,))
-
-        for row in cursor.fetchall():
-            metadata = json.loads(row[1]) if row[1] else {}
-            journey['cta_clicks'].append({
-                'location': metadata.get('cta_location', 'Неизвестно'),
-                'previous_step': metadata.get('previous_step', 'Неизвестно'),
-                'duration': metadata.get('step_duration', 0),
-                'timestamp': row[0]
-            })
-
-        conn.close()
-
-        # Получаем сегментацию пользователя
-        segmentation = db.get_user_segment(tg_user_id)
-
-        # Формируем рекомендации на основе сегментации
-        recommendations = {
-            'next_steps': [],
-            'automatic_actions': [],
-            'content_suggestions': [],
-            'cta_suggestions': []
-        }
-
-        segment = segmentation.get('segment', 'newcomer')
-        engagement = segmentation.get('engagement_level', 'low')
-
-        if segment == 'newcomer':
-            recommendations['next_steps'] = [
-                'Пройти диагностику для персональных рекомендаций',
-                'Изучить основные разделы сайта',
-                'Ознакомиться с кейсами и услугами'
-            ]
-            recommendations['content_suggestions'] = ['Введение', 'О компании', 'Услуги']
-            recommendations['cta_suggestions'] = ['Записаться на консультацию', 'Связаться']
-        elif segment == 'engaged':
-            recommendations['next_steps'] = [
-                'Углубить изучение конкретных услуг',
-                'Посмотреть кейсы по интересующим направлениям',
-                'Связаться для детального обсуждения'
-            ]
-            recommendations['content_suggestions'] = ['Кейсы', 'Технологии', 'Результаты']
-            recommendations['cta_suggestions'] = ['Получить предложение', 'Записаться на встречу']
-        elif segment == 'converter':
-            recommendations['next_steps'] = [
-                'Обсудить детали сотрудничества',
-                'Подготовить техническое задание',
-                'Определить сроки и бюджет'
-            ]
-            recommendations['automatic_actions'] = [
-                'Отправка персонального коммерческого предложения',
-                'Приглашение на презентацию услуг'
-            ]
-            recommendations['content_suggestions'] = ['Тарифы', 'Процессы', 'Гарантии']
-            recommendations['cta_suggestions'] = ['Начать проект', 'Подписать договор']
-        elif segment == 'loyal':
-            recommendations['next_steps'] = [
-                'Обсудить расширение сотрудничества',
-                'Рассмотреть новые направления',
-                'Стать партнером или рефералом'
-            ]
-            recommendations['automatic_actions'] = [
-                'Персональные предложения по новым услугам',
-                'Приглашения на эксклюзивные мероприятия'
-            ]
-            recommendations['content_suggestions'] = ['Новости', 'Партнерские программы', 'Эксклюзивные материалы']
-            recommendations['cta_suggestions'] = ['Стать партнером', 'Рекомендовать услуги']
-
-        # Формируем итоговый отчет
-        report = {
-            'user': user_info,
-            'journey': journey,
-            'segmentation': {
-                'user_segment': segment,
-                'engagement_level': engagement,
-                'basis': [
-                    f'Общее количество сессий: {segmentation.get("total_sessions", 0)}',
-                    f'Завершена диагностика: {"Да" if segmentation.get("diagnostics_completed", False) else "Нет"}',
-                    f'Уровень вовлеченности: {engagement}',
-                    f'Последняя активность: {segmentation.get("last_activity", "Неизвестно")}'
-                ]
-            },
-            'recommendations': recommendations,
-            'generated_at': str(datetime.now())
-        }
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            payload = report_cache.get(tg_user_id, version)
+            if payload is None:
+                payload = app.json.dumps(build_personal_report(tg_user_id)).encode('utf-8')
+                report_cache.put(tg_user_id, version, payload)
+            response = app.response_class(payload, mimetype='application/json')
 
-        return jsonify(report)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
     except Exception as e:
         print(f"Error generating personal report: {e}")
@@ -688,24 +499,11 @@ def get_user_personal_report_by_cookie(cookie_id):
         return jsonify({'error': 'База данных не инициализирована'}), 500
 
     try:
-        # Находим tg_user_id по cookie_id
-        conn = db.get_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT tg_user_id FROM site_sessions
-            WHERE cookie_id = ?
-            ORDER BY session_start DESC
-            LIMIT 1
-        ''', (cookie_id,))
-
-        row = cursor.fetchone()
-        conn.close()
-
-        if not row:
+        # Находим tg_user_id по cookie_id (in-process кеш, при попадании без запроса к БД)
+        tg_user_id = db.resolve_cookie_user(cookie_id)
+        if tg_user_id is None:
             return jsonify({'error': 'Пользователь не найден'}), 404
 
-        tg_user_id = row[0]
         # Перенаправляем на основной endpoint
         return get_user_personal_report(tg_user_id)
 
@@ -997,6 +795,32 @@ def get_segment_users():
     except Exception as e:
         return jsonify({'error': f'Ошибка при получении сегмента: {str(e)}'}), 500
 
+@app.route('/api/analytics/segment-reports/export', methods=['POST'])
+def export_segment_reports():
+    """Массовая выгрузка персональных отчетов сегмента потоком (NDJSON или zip с HTML)"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    data = request.get_json() or {}
+    criteria = data.get('criteria', {})
+    fmt = data.get('format', 'ndjson')
+
+    try:
+        stream = iter_segment_export(
+            db, criteria, fmt=fmt,
+            chunk_size=int(data.get('chunk_size', 500)),
+            workers=int(os.getenv('EXPORT_WORKERS', '2')),
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Ошибка выгрузки отчетов: {str(e)}'}), 500
+
+    extension, mimetype = ('zip', 'application/zip') if fmt == 'zip' else ('ndjson', 'application/x-ndjson')
+    file_name = f"segment_reports_{datetime.now().strftime('%Y-%m-%d')}.{extension}"
+    return Response(stream_with_context(stream), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={file_name}'})
+
 @app.route('/api/analytics/conversion-funnel', methods=['GET'])
 def get_conversion_funnel():
     """Получить воронку конверсии"""
@@ -1012,6 +836,108 @@ def get_conversion_funnel():
     except Exception as e:
         return jsonify({'error': f'Ошибка при получении воронки: {str(e)}'}), 500
 
+@app.route('/api/analytics/unique-visitors', methods=['GET'])
+def get_unique_visitors():
+    """Оценка уникальных посетителей (HyperLogLog) по дням, источникам и UTM кампаниям"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    try:
+        result = db.get_unique_visitors(
+            start_date=request.args.get('start_date'),
+            end_date=request.args.get('end_date'),
+            dimension=request.args.get('dimension', 'all'),
+            value=request.args.get('value')
+        )
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': f'Неверные параметры запроса: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при подсчете уникальных посетителей: {str(e)}'}), 500
+
+@app.route('/api/analytics/attribution', methods=['GET'])
+def get_source_attribution():
+    """Сессии, диагностики и клики CTA по источникам и UTM кампаниям"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    try:
+        result = db.get_source_attribution(
+            start_date=request.args.get('start_date'),
+            end_date=request.args.get('end_date')
+        )
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': f'Неверные параметры запроса: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при получении атрибуции: {str(e)}'}), 500
+
+@app.route('/api/analytics/funnel', methods=['POST'])
+def get_custom_funnel():
+    """Произвольная многошаговая воронка по событиям сайта"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    data = request.get_json() or {}
+
+    try:
+        steps = parse_steps(data.get('steps'))
+        window_seconds = int(float(data.get('window_hours', 24 * 7)) * 3600)
+        result = db.get_funnel(
+            steps,
+            window_seconds=window_seconds,
+            start_date=data.get('start_date'),
+            end_date=data.get('end_date')
+        )
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Неверные параметры воронки: {str(e)}'}), 400
+
+    if not result:
+        return jsonify({'error': 'Ошибка при расчете воронки'}), 500
+    return jsonify(result)
+
+@app.route('/api/analytics/navigation/next', methods=['GET'])
+def get_navigation_next():
+    """Куда пользователи переходят из страницы или раздела (предрасчитанная матрица)"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    node = request.args.get('node')
+    if not node:
+        return jsonify({'error': 'Не указан node (например, section:about или page:/)'}), 400
+
+    try:
+        result = db.get_navigation_next(
+            node,
+            start_date=request.args.get('start_date'),
+            end_date=request.args.get('end_date'),
+            limit=request.args.get('limit', 10, type=int)
+        )
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': f'Неверные параметры запроса: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при получении переходов: {str(e)}'}), 500
+
+@app.route('/api/analytics/navigation/paths', methods=['GET'])
+def get_navigation_paths():
+    """Самые частые пути навигации и пути к клику по CTA"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    try:
+        result = db.get_navigation_paths(
+            kind=request.args.get('kind', 'to_cta'),
+            start_date=request.args.get('start_date'),
+            end_date=request.args.get('end_date'),
+            limit=request.args.get('limit', 10, type=int)
+        )
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': f'Неверные параметры запроса: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при получении путей: {str(e)}'}), 500
+
 @app.route('/api/analytics/content-preferences/<int:tg_user_id>', methods=['GET'])
 def get_content_preferences(tg_user_id):
     """Получить предпочтения контента пользователя"""
@@ -1024,16 +950,45 @@ def get_content_preferences(tg_user_id):
     except Exception as e:
         return jsonify({'error': f'Ошибка при анализе предпочтений: {str(e)}'}), 500
 
+@app.route('/api/analytics/content-preferences/batch', methods=['POST'])
+def get_content_preferences_batch():
+    """Получить предпочтения контента для списка пользователей"""
+    if not db:
+        return jsonify({'error': 'База данных не инициализирована'}), 500
+
+    data = request.get_json() or {}
+    user_ids = data.get('user_ids')
+
+    if not isinstance(user_ids, list):
+        return jsonify({'error': 'user_ids должен быть списком'}), 400
+
+    try:
+        preferences = db.get_content_preferences_batch([int(uid) for uid in user_ids])
+        return jsonify({'preferences': {str(uid): prefs for uid, prefs in preferences.items()}})
+    except (TypeError, ValueError):
+        return jsonify({'error': 'user_ids должен содержать числовые идентификаторы'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Ошибка при анализе предпочтений: {str(e)}'}), 500
+
 @app.route('/api/generate-personal-report-pdf', methods=['POST'])
 def generate_personal_report_pdf():
-    """Генерировать PDF персонального отчета"""
+    """Поставить генерацию PDF персонального отчета в очередь.
+
+    Возвращает 202 и jobId; статус — GET /api/pdf-jobs/<job_id>, файл — GET /api/pdf-jobs/<job_id>/file.
+    Если передан callbackUrl (хост из PDF_CALLBACK_HOSTS), по завершении на него отправляется POST со статусом.
+    Если на сервере нет PDF рендерера (weasyprint или wkhtmltopdf), сразу возвращается 503.
+    """
     try:
         data = request.get_json()
         report_data = data.get('reportData')
         telegram_user_id = data.get('telegramUserId')
+        callback_url = data.get('callbackUrl')
 
         if not report_data:
             return jsonify({'error': 'Отсутствуют данные отчета'}), 400
+        # Без рендерера задача гарантированно завершится ошибкой — не принимаем ее
+        if not pdf_jobs.renderer_ready():
+            return jsonify({'error': 'Генерация PDF недоступна: не установлен weasyprint или wkhtmltopdf'}), 503
 
         # Генерируем HTML для персонального отчета
         html_content = generate_personal_report_html(report_data)
@@ -1041,9 +996,13 @@ def generate_personal_report_pdf():
         # Формируем имя файла
         file_name = f"personal_report_{telegram_user_id or 'user'}_{datetime.now().strftime('%Y-%m-%d')}.pdf"
 
-        # Имитируем генерацию PDF (в реальности нужно интегрировать с Puppeteer)
-        # Для простоты возвращаем заглушку
-        pdf_base64 = f"data:application/pdf;base64,{base64.b64encode(b'PDF content placeholder').decode()}"
+        try:
+            job = pdf_jobs.submit(html_content, file_name, callback_url=callback_url,
+                                  meta={'telegram_user_id': telegram_user_id})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except PdfQueueFull as e:
+            return jsonify({'error': str(e)}), 503
 
         # Отправляем PDF в Telegram бот, если указан telegramUserId
         telegram_sent = False
@@ -1057,218 +1016,39 @@ def generate_personal_report_pdf():
 
         return jsonify({
             'success': True,
-            'pdfUrl': pdf_base64,
-            'fileName': file_name,
+            **job,
+            'statusUrl': url_for('get_pdf_job', job_id=job['jobId']),
+            'pdfUrl': url_for('get_pdf_job_file', job_id=job['jobId']),
             'telegramSent': telegram_sent
-        })
+        }), 202
 
     except Exception as e:
         return jsonify({'error': f'Ошибка генерации персонального отчета: {str(e)}'}), 500
 
-def generate_personal_report_html(report_data):
-    """Генерировать HTML для персонального отчета"""
-    def format_date(date_string):
-        if not date_string:
-            return 'Не указано'
-        try:
-            return datetime.fromisoformat(date_string.replace('Z', '+00:00')).strftime('%d.%m.%Y')
-        except:
-            return date_string
-
-    def get_segment_color(segment):
-        colors = {
-            'newcomer': '#4a90e2',
-            'engaged': '#f0ad4e',
-            'converter': '#5cb85c',
-            'loyal': '#9b59b6'
-        }
-        return colors.get(segment, '#95a5a6')
+@app.route('/api/pdf-jobs/<job_id>', methods=['GET'])
+def get_pdf_job(job_id):
+    """Статус задачи генерации PDF: queued / done / failed"""
+    job = pdf_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    if job['status'] == 'done':
+        job['pdfUrl'] = url_for('get_pdf_job_file', job_id=job_id)
+    return jsonify(job)
+
+@app.route('/api/pdf-jobs/<job_id>/file', methods=['GET'])
+def get_pdf_job_file(job_id):
+    """Скачать готовый PDF задачи"""
+    job = pdf_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    path = pdf_jobs.file_path(job_id)
+    if not path:
+        return jsonify({'error': 'PDF еще не готов', 'status': job['status']}), 409
+    return send_file(path, mimetype='application/pdf', as_attachment=True, download_name=job['fileName'])
 
-    def get_engagement_color(level):
-        colors = {
-            'low': '#e74c3c',
-            'medium': '#f39c12',
-            'high': '#27ae60'
-        }
-        return colors.get(level, '#95a5a6')
-
-    html = f"""
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <style>
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700;800&display=swap');
-    * {{
-      margin: 0;
-      padding: 0;
-      box-sizing: border-box;
-    }}
-    body {{
-      font-family: 'Inter', 'Arial', sans-serif;
-      width: 794px;
-      min-height: 1123px;
-      background: linear-gradient(180deg, #ffffff 0%, #fafafa 100%);
-      margin: 0;
-      padding: 0;
-      color: #191923;
-    }}
-  </style>
-</head>
-<body>
-  <!-- Премиальная золотая полоса сверху -->
-  <div style="
-    width: 100%;
-    height: 45px;
-    background: linear-gradient(135deg, #FFD700 0%, #FFA500 50%, #FFD700 100%);
-    box-shadow: 0 4px 20px rgba(255, 215, 0, 0.3);
-  "></div>
-
-  <!-- Премиальная темная область для заголовка -->
-  <div style="
-    width: 100%;
-    background: linear-gradient(135deg, #191923 0%, #1a1a24 50%, #191923 100%);
-    padding: 50px 30px;
-    box-shadow: 0 4px 15px rgba(0, 0, 0, 0.1);
-  ">
-    <h1 style="
-      color: #FFD700;
-      font-size: 28px;
-      font-weight: 700;
-      text-align: center;
-      margin: 0;
-      padding: 0;
-      letter-spacing: 1px;
-      font-family: 'Inter', 'Arial', sans-serif;
-    ">Ваш персональный отчёт</h1>
-    <p style="
-      color: #ffffff;
-      font-size: 16px;
-      text-align: center;
-      margin-top: 10px;
-      opacity: 0.9;
-    ">Анализ вашего пути в MiniApp • {format_date(report_data.get('generated_at'))}</p>
-  </div>
-
-  <!-- Контент -->
-  <div style="
-    width: 100%;
-    background: #ffffff;
-    padding: 40px 30px;
-    box-sizing: border-box;
-  ">
-    <!-- Информация о пользователе -->
-    <div style="margin-bottom: 40px;">
-      <h2 style="
-        color: #191923;
-        font-size: 20px;
-        font-weight: 700;
-        margin-bottom: 20px;
-        border-bottom: 3px solid #FFD700;
-        padding-bottom: 10px;
-      ">👤 Информация о пользователе</h2>
-      <div style="display: grid; grid-template-columns: repeat(2, 1fr); gap: 15px;">
-        <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; border-left: 4px solid #4a90e2;">
-          <strong>Telegram ID:</strong> {report_data.get('user', {}).get('tg_user_id', 'Не указан')}
-        </div>
-        <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; border-left: 4px solid #4a90e2;">
-          <strong>Cookie ID:</strong> {report_data.get('user', {}).get('cookie_id', 'Не указан')}
-        </div>
-        <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; border-left: 4px solid #f0ad4e;">
-          <strong>Источник трафика:</strong> {report_data.get('user', {}).get('traffic_source', 'Не определен')}
-        </div>
-        <div style="background: #f8f9fa; padding: 15px; border-radius: 8px; border-left: 4px solid #f0ad4e;">
-          <strong>Первый визит:</strong> {format_date(report_data.get('user', {}).get('first_visit_date'))}
-        </div>
-      </div>
-    </div>
-
-    <!-- Сегментация -->
-    <div style="margin-bottom: 40px;">
-      <h2 style="
-        color: #191923;
-        font-size: 20px;
-        font-weight: 700;
-        margin-bottom: 20px;
-        border-bottom: 3px solid #FFD700;
-        padding-bottom: 10px;
-      ">🎯 Сегментация</h2>
-      <div style="display: grid; grid-template-columns: repeat(2, 1fr); gap: 20px;">
-        <div style="
-          background: {get_segment_color(report_data.get('segmentation', {}).get('user_segment'))};
-          color: white;
-          padding: 20px;
-          border-radius: 12px;
-          text-align: center;
-        ">
-          <h3 style="margin: 0 0 10px 0; font-size: 18px;">Сегмент пользователя</h3>
-          <p style="margin: 0; font-size: 24px; font-weight: 700;">{report_data.get('segmentation', {}).get('user_segment', 'Не определен')}</p>
-        </div>
-        <div style="
-          background: {get_engagement_color(report_data.get('segmentation', {}).get('engagement_level'))};
-          color: white;
-          padding: 20px;
-          border-radius: 12px;
-          text-align: center;
-        ">
-          <h3 style="margin: 0 0 10px 0; font-size: 18px;">Уровень вовлеченности</h3>
-          <p style="margin: 0; font-size: 24px; font-weight: 700;">{report_data.get('segmentation', {}).get('engagement_level', 'Не определен')}</p>
-        </div>
-      </div>
-    </div>
-
-    <!-- Рекомендации -->
-    <div style="margin-bottom: 40px;">
-      <h2 style="
-        color: #191923;
-        font-size: 20px;
-        font-weight: 700;
-        margin-bottom: 20px;
-        border-bottom: 3px solid #FFD700;
-        padding-bottom: 10px;
-      ">💡 Персональные рекомендации</h2>
-      <div style="background: #f8f9fa; padding: 20px; border-radius: 8px;">
-        <h4 style="margin: 0 0 15px 0; color: #191923;">🎯 Следующие шаги:</h4>
-        <ul style="margin: 0; padding-left: 20px;">
-"""
-
-    # Добавляем рекомендации
-    next_steps = report_data.get('recommendations', {}).get('next_steps', [])
-    if next_steps:
-        for step in next_steps[:3]:  # Ограничиваем до 3 рекомендаций
-            html += f"<li>{step}</li>"
-    else:
-        html += "<li>Рекомендации формируются...</li>"
-
-    html += """
-        </ul>
-      </div>
-    </div>
-  </div>
-
-  <!-- Премиальный футер -->
-  <div style="
-    margin-top: 40px;
-    text-align: center;
-    padding: 20px;
-    background: linear-gradient(135deg, rgba(255, 215, 0, 0.1) 0%, rgba(255, 215, 0, 0.05) 100%);
-    border-radius: 10px;
-    border-top: 1px solid rgba(255, 215, 0, 0.3);
-  ">
-    <p style="
-      margin: 0;
-      color: #969696;
-      font-size: 12px;
-      font-style: italic;
-      font-family: 'Inter', 'Arial', sans-serif;
-    ">✨ Персональный отчет • {format_date(report_data.get('generated_at'))} ✨</p>
-  </div>
-</body>
-</html>
-"""
-
-    return html
+def generate_personal_report_html(report_data):
+    """Генерировать HTML для персонального отчета (предкомпилированный шаблон templates/personal_report.html)"""
+    return render_personal_report(report_data)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
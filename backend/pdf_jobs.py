@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Асинхронная генерация PDF персональных отчетов
+
+Рендеринг HTML -> PDF выполняется в пуле процессов, а не в потоках Flask: запрос только
+ставит задачу и возвращает job id. Готовые PDF кешируются на диске по хешу HTML, поэтому
+повторный запрос того же отчета не рендерится заново.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_MAX_PENDING = 50
+DEFAULT_MAX_CACHED_FILES = 500
+# Сколько хранить сведения о завершенных задачах
+JOB_TTL_SECONDS = 3600
+CALLBACK_TIMEOUT_SECONDS = 5
+
+
+class PdfQueueFull(Exception):
+    """Очередь рендеринга переполнена"""
+
+
+def renderer_available() -> bool:
+    """Есть ли чем рендерить PDF: WeasyPrint импортируется (с системными библиотеками) или wkhtmltopdf в PATH"""
+    try:
+        import weasyprint  # noqa: F401
+        return True
+    except (ImportError, OSError):
+        return shutil.which('wkhtmltopdf') is not None
+
+
+def render_pdf(html: str, output_path: str) -> str:
+    """Отрендерить HTML в PDF (выполняется в процессе пула).
+
+    Использует WeasyPrint, если он установлен, иначе утилиту wkhtmltopdf.
+    Файл пишется во временный и атомарно переименовывается.
+    """
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    try:
+        try:
+            from weasyprint import HTML
+            HTML(string=html).write_pdf(tmp_path)
+        except (ImportError, OSError):
+            binary = shutil.which('wkhtmltopdf')
+            if not binary:
+                raise RuntimeError('PDF рендерер не найден: установите weasyprint или wkhtmltopdf')
+            subprocess.run(
+                [binary, '--quiet', '--encoding', 'utf-8', '-', tmp_path],
+                input=html.encode('utf-8'), check=True, timeout=120, capture_output=True,
+            )
+        os.replace(tmp_path, output_path)
+        return output_path
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class PdfJobManager:
+    """Очередь задач рендеринга PDF с пулом процессов и кешем файлов по хешу содержимого"""
+
+    def __init__(self, output_dir: str, max_workers: int = DEFAULT_MAX_WORKERS,
+                 max_pending: int = DEFAULT_MAX_PENDING, max_cached_files: int = DEFAULT_MAX_CACHED_FILES,
+                 callback_hosts: Optional[List[str]] = None, executor: Optional[Executor] = None,
+                 renderer=render_pdf):
+        if max_workers <= 0:
+            raise ValueError("max_workers должен быть положительным")
+        self.output_dir = output_dir
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_cached_files = max_cached_files
+        # Callback отправляется только на разрешенные хосты (защита от SSRF)
+        self.callback_hosts = set(callback_hosts or [])
+        self.renderer = renderer
+        self._renderer_checked = False
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._executor = executor
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        # content_hash -> job_id незавершенной задачи (одинаковый HTML рендерится один раз)
+        self._in_flight: Dict[str, str] = {}
+        # RLock: done-callback уже завершенного future вызывается синхронно внутри submit
+        self._lock = threading.RLock()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def renderer_ready(self) -> bool:
+        """Можно ли сейчас рендерить PDF (проверка системного рендерера кешируется после успеха)"""
+        if self.renderer is not render_pdf or self._renderer_checked:
+            return True
+        self._renderer_checked = renderer_available()
+        return self._renderer_checked
+
+    def _file_path(self, content_hash: str) -> str:
+        return os.path.join(self.output_dir, f"{content_hash}.pdf")
+
+    def callback_allowed(self, callback_url: Optional[str]) -> bool:
+        if not callback_url:
+            return True
+        parsed = urlparse(callback_url)
+        return parsed.scheme in ('http', 'https') and parsed.hostname in self.callback_hosts
+
+    def submit(self, html: str, file_name: str, callback_url: Optional[str] = None,
+               meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Поставить HTML в очередь рендеринга; возвращает снимок задачи"""
+        if not self.callback_allowed(callback_url):
+            raise ValueError('callbackUrl не входит в список разрешенных хостов')
+
+        content_hash = hashlib.sha256(html.encode('utf-8')).hexdigest()
+        path = self._file_path(content_hash)
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': STATUS_QUEUED,
+            'file_name': file_name,
+            'content_hash': content_hash,
+            'created_at': time.time(),
+            'finished_at': None,
+            'error': None,
+            'cached': False,
+            # Все callback запросов, присоединившихся к этой задаче
+            'callback_urls': [callback_url] if callback_url else [],
+            'meta': meta or {},
+        }
+
+        with self._lock:
+            self._prune_jobs()
+            if os.path.exists(path):
+                job.update(status=STATUS_DONE, finished_at=time.time(), cached=True)
+                self._jobs[job['id']] = job
+                # Обновляем mtime, чтобы часто запрашиваемые файлы не вытеснялись
+                os.utime(path)
+            elif content_hash in self._in_flight:
+                job = self._jobs[self._in_flight[content_hash]]
+                if callback_url and callback_url not in job['callback_urls']:
+                    job['callback_urls'].append(callback_url)
+                return self.snapshot(job)
+            else:
+                if len(self._in_flight) >= self.max_pending:
+                    raise PdfQueueFull('Очередь генерации PDF переполнена')
+                self._jobs[job['id']] = job
+                self._in_flight[content_hash] = job['id']
+                future = self._get_executor().submit(self.renderer, html, path)
+                future.add_done_callback(lambda f, job_id=job['id']: self._on_done(job_id, f))
+                return self.snapshot(job)
+
+        if callback_url:
+            self._send_callback(job, callback_url)
+        return self.snapshot(job)
+
+    def _on_done(self, job_id: str, future) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            self._in_flight.pop(job['content_hash'], None)
+            error = future.exception()
+            if error is not None:
+                job.update(status=STATUS_FAILED, error=str(error))
+                logger.error(f"Ошибка рендеринга PDF {job_id}: {error}")
+            else:
+                job['status'] = STATUS_DONE
+            job['finished_at'] = time.time()
+            self._prune_files()
+            callback_urls = list(job['callback_urls'])
+
+        for callback_url in callback_urls:
+            self._send_callback(job, callback_url)
+
+    def _send_callback(self, job: Dict[str, Any], callback_url: str) -> None:
+        """POST со статусом задачи на callback_url (в отдельном потоке, ошибки только логируются)"""
+        body = json.dumps(self.snapshot(job)).encode('utf-8')
+
+        def deliver():
+            try:
+                req = Request(callback_url, data=body, headers={'Content-Type': 'application/json'})
+                urlopen(req, timeout=CALLBACK_TIMEOUT_SECONDS).close()
+            except Exception as e:
+                logger.warning(f"Не удалось отправить callback для PDF задачи {job['id']}: {e}")
+
+        threading.Thread(target=deliver, daemon=True).start()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self.snapshot(job) if job else None
+
+    def file_path(self, job_id: str) -> Optional[str]:
+        """Путь к готовому PDF задачи или None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job['status'] != STATUS_DONE:
+                return None
+            path = self._file_path(job['content_hash'])
+        return path if os.path.exists(path) else None
+
+    @staticmethod
+    def snapshot(job: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'jobId': job['id'],
+            'status': job['status'],
+            'fileName': job['file_name'],
+            'cached': job['cached'],
+            'error': job['error'],
+        }
+
+    def _prune_jobs(self) -> None:
+        """Удалить сведения о давно завершенных задачах (под self._lock)"""
+        deadline = time.time() - JOB_TTL_SECONDS
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['finished_at'] is not None and job['finished_at'] < deadline]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _prune_files(self) -> None:
+        """Ограничить число закешированных PDF, удаляя самые старые (под self._lock)"""
+        try:
+            files = [os.path.join(self.output_dir, name) for name in os.listdir(self.output_dir)
+                     if name.endswith('.pdf')]
+            if len(files) <= self.max_cached_files:
+                return
+            files.sort(key=os.path.getmtime)
+            for path in files[:len(files) - self.max_cached_files]:
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Ошибка очистки кеша PDF: {e}")
+
+
+def create_pdf_job_manager() -> PdfJobManager:
+    """Менеджер задач с настройками из окружения"""
+    hosts = [h.strip() for h in os.getenv('PDF_CALLBACK_HOSTS', '').split(',') if h.strip()]
+    return PdfJobManager(
+        output_dir=os.getenv('PDF_OUTPUT_DIR') or os.path.join(tempfile.gettempdir(), 'spacegrow_pdf'),
+        max_workers=int(os.getenv('PDF_WORKERS', str(DEFAULT_MAX_WORKERS))),
+        max_pending=int(os.getenv('PDF_MAX_PENDING', str(DEFAULT_MAX_PENDING))),
+        max_cached_files=int(os.getenv('PDF_CACHE_MAX_FILES', str(DEFAULT_MAX_CACHED_FILES))),
+        callback_hosts=hosts,
+    )
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Сборка персонального отчета из данных Database.get_personal_report_data
+(общая для эндпоинта отчета и массовой выгрузки)
+"""
+import logging
+from datetime import datetime
+
+from recommendation_rules import REPORT_RULESET
+
+logger = logging.getLogger(__name__)
+
+
+def assemble_personal_report(report_data: dict) -> dict:
+    """Персональный отчет: данные пользователя, путь, сегментация и рекомендации"""
+    user_info = report_data['user']
+    journey = report_data['journey']
+    segmentation = report_data['segmentation']
+
+    segment = segmentation.get('segment', 'newcomer')
+    engagement = segmentation.get('engagement_level', 'low')
+
+    # Рекомендации на основе сегментации — по таблице правил recommendation_rules.REPORT_RULES
+    recommendations = REPORT_RULESET.evaluate(segmentation)
+
+    # Формируем итоговый отчет
+    report = {
+        'user': user_info,
+        'journey': journey,
+        'segmentation': {
+            'user_segment': segment,
+            'engagement_level': engagement,
+            'basis': [
+                f'Общее количество сессий: {segmentation.get("total_sessions", 0)}',
+                f'Завершена диагностика: {"Да" if segmentation.get("diagnostics_completed", False) else "Нет"}',
+                f'Уровень вовлеченности: {engagement}',
+                f'Последняя активность: {segmentation.get("last_activity", "Неизвестно")}'
+            ]
+        },
+        'recommendations': recommendations,
+        'generated_at': str(datetime.now())
+    }
+
+    return report
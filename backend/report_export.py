@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Массовая выгрузка персональных отчетов пользователей сегмента
+
+Данные читаются порциями по диапазонам user_id (Database.iter_segment_report_data),
+отчеты собираются и сериализуются (ndjson) или рендерятся в HTML (zip) в общем пуле процессов.
+Результат отдается потоком байтов:
+  ndjson — по строке JSON отчета на пользователя;
+  zip    — архив с report_<tg_user_id>.html на пользователя.
+В памяти одновременно находится не больше одной порции отчетов.
+"""
+import atexit
+import json
+import logging
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, Optional
+
+from personal_report import assemble_personal_report
+from report_template import render_personal_report
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('ndjson', 'zip')
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_WORKERS = 2
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """Общий пул процессов выгрузок: создается при первой выгрузке (размер — workers первого
+    вызова) и закрывается при выходе, чтобы параллельные запросы не запускали свои пулы"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            atexit.register(_shutdown_pool)
+        return _pool
+
+
+def _shutdown_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+class _StreamBuffer:
+    """Файловый объект без seek для zipfile: накапливает записанные байты до выдачи"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data: bytes) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def iter_segment_export(db, segment_criteria: dict, fmt: str = 'ndjson',
+                        chunk_size: int = DEFAULT_CHUNK_SIZE, workers: int = DEFAULT_WORKERS,
+                        progress: Optional[Callable[[dict], None]] = None) -> Iterator[bytes]:
+    """Поток байтов выгрузки отчетов сегмента.
+
+    progress(state) вызывается после каждой порции: scanned_users, exported_reports, elapsed_seconds.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    if not isinstance(segment_criteria, dict):
+        raise ValueError("Критерии сегмента должны быть объектом")
+    # Проверяем критерии до начала потока, чтобы ошибка вернулась клиенту, а не оборвала ответ
+    batches = db.iter_segment_report_data(segment_criteria, chunk_size=chunk_size)
+    first = next(batches, None)
+    return _export_stream(first, batches, fmt, workers, progress)
+
+
+def _report_line(data: dict) -> str:
+    """Строка NDJSON отчета; выполняется в процессе пула"""
+    return json.dumps(assemble_personal_report(data), ensure_ascii=False, default=str)
+
+
+def _export_stream(first, batches, fmt: str, workers: int, progress) -> Iterator[bytes]:
+    started = time.perf_counter()
+    state = {'scanned_users': 0, 'exported_reports': 0, 'elapsed_seconds': 0.0}
+
+    def all_batches():
+        if first is not None:
+            yield first
+            yield from batches
+
+    def report_progress(scanned: int, exported: int) -> None:
+        state['scanned_users'] += scanned
+        state['exported_reports'] += exported
+        state['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+        if progress:
+            progress(dict(state))
+
+    pool = _get_pool(workers)
+    if fmt == 'ndjson':
+        for scanned, batch in all_batches():
+            chunksize = max(1, len(batch) // (workers * 4))
+            lines = list(pool.map(_report_line, batch, chunksize=chunksize))
+            report_progress(scanned, len(lines))
+            if lines:
+                yield ('\n'.join(lines) + '\n').encode('utf-8')
+    else:
+        buffer = _StreamBuffer()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for scanned, batch in all_batches():
+                reports = [assemble_personal_report(data) for data in batch]
+                chunksize = max(1, len(reports) // (workers * 4))
+                for report, html in zip(reports, pool.map(render_personal_report, reports, chunksize=chunksize)):
+                    archive.writestr(f"report_{report['user']['tg_user_id']}.html", html)
+                report_progress(scanned, len(reports))
+                data = buffer.drain()
+                if data:
+                    yield data
+        # Центральный каталог архива записывается при закрытии ZipFile
+        yield buffer.drain()
+
+    logger.info(f"Выгрузка отчетов завершена: {state}")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Предкомпилированный шаблон HTML персонального отчета
+
+Шаблон templates/personal_report.html разбирается один раз при импорте на статические
+фрагменты и слоты вида {{ name }}; рендеринг — один ''.join без повторного разбора.
+Все значения из данных отчета экранируются.
+"""
+import logging
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+from html import escape
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'templates', 'personal_report.html')
+
+SLOT_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+SEGMENT_COLORS = {
+    'newcomer': '#4a90e2',
+    'engaged': '#f0ad4e',
+    'converter': '#5cb85c',
+    'loyal': '#9b59b6'
+}
+ENGAGEMENT_COLORS = {
+    'low': '#e74c3c',
+    'medium': '#f39c12',
+    'high': '#27ae60'
+}
+DEFAULT_COLOR = '#95a5a6'
+
+# Сколько рекомендаций выводится в отчете
+MAX_NEXT_STEPS = 3
+
+
+class CompiledTemplate:
+    """Шаблон, разобранный на чередующиеся статические фрагменты и имена слотов"""
+
+    def __init__(self, source: str):
+        parts = SLOT_PATTERN.split(source)
+        # После split: четные элементы — статический текст, нечетные — имена слотов
+        self.chunks: List[str] = parts[0::2]
+        self.slots: List[str] = parts[1::2]
+        # Пары (слот, следующий за ним статический фрагмент)
+        self._layout = list(zip(self.slots, self.chunks[1:]))
+
+    def render(self, values: Dict[str, str]) -> str:
+        """Подставить значения слотов (уже экранированные) и склеить результат"""
+        out = [self.chunks[0]]
+        append = out.append
+        for slot, chunk in self._layout:
+            append(values[slot])
+            append(chunk)
+        return ''.join(out)
+
+
+def load_template(path: str = TEMPLATE_PATH) -> CompiledTemplate:
+    with open(path, encoding='utf-8') as f:
+        return CompiledTemplate(f.read())
+
+
+PERSONAL_REPORT_TEMPLATE = load_template()
+
+
+def format_date(date_string: Any) -> str:
+    """ДД.ММ.ГГГГ из ISO строки; нераспознанное значение возвращается как есть"""
+    if not date_string:
+        return 'Не указано'
+    if not isinstance(date_string, str):
+        return str(date_string)
+    return _format_iso_date(date_string)
+
+
+@lru_cache(maxsize=4096)
+def _format_iso_date(date_string: str) -> str:
+    # Кешируется: при массовой генерации отчетов даты повторяются
+    try:
+        parsed = datetime.fromisoformat(date_string.replace('Z', '+00:00'))
+    except ValueError:
+        return date_string
+    # Эквивалент strftime('%d.%m.%Y'), но заметно быстрее для дат с часовым поясом
+    return '%02d.%02d.%04d' % (parsed.day, parsed.month, parsed.year)
+
+
+def _text(value: Any) -> str:
+    return escape(str(value), quote=True)
+
+
+def personal_report_values(report_data: Dict[str, Any]) -> Dict[str, str]:
+    """Экранированные значения слотов шаблона по данным из /api/user/<id>/personal-report"""
+    user = report_data.get('user') or {}
+    segmentation = report_data.get('segmentation') or {}
+    segment = segmentation.get('user_segment')
+    engagement = segmentation.get('engagement_level')
+
+    next_steps = (report_data.get('recommendations') or {}).get('next_steps') or []
+    if next_steps:
+        steps_html = ''.join(f"<li>{_text(step)}</li>" for step in next_steps[:MAX_NEXT_STEPS])
+    else:
+        steps_html = "<li>Рекомендации формируются...</li>"
+
+    return {
+        'generated_at': _text(format_date(report_data.get('generated_at'))),
+        'tg_user_id': _text(user.get('tg_user_id', 'Не указан')),
+        'cookie_id': _text(user.get('cookie_id', 'Не указан')),
+        'traffic_source': _text(user.get('traffic_source', 'Не определен')),
+        'first_visit_date': _text(format_date(user.get('first_visit_date'))),
+        'segment_color': SEGMENT_COLORS.get(segment, DEFAULT_COLOR),
+        'user_segment': _text(segmentation.get('user_segment', 'Не определен')),
+        'engagement_color': ENGAGEMENT_COLORS.get(engagement, DEFAULT_COLOR),
+        'engagement_level': _text(segmentation.get('engagement_level', 'Не определен')),
+        'next_steps': steps_html,
+    }
+
+
+def render_personal_report(report_data: Dict[str, Any]) -> str:
+    """HTML персонального отчета"""
+    return PERSONAL_REPORT_TEMPLATE.render(personal_report_values(report_data))
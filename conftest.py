@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Общие фикстуры тестов
+"""
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+import pytest
+
+from db import Database
+
+
+class FakeClock:
+    """Часы для clock= компонентов: время задается тестом через now"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Пустая sqlite БД со всеми миграциями"""
+    # Миграции из конструктора на пустой БД не находят users (ее создает init_db) — их ошибки не показываем
+    logging.disable(logging.ERROR)
+    database = Database(str(tmp_path / 'bot.db'))
+    logging.disable(logging.NOTSET)
+    database.init_db()
+    return database
+
+
+@pytest.fixture
+def api_client(db, monkeypatch):
+    """Тестовый клиент backend/app.py, работающий с фикстурой db"""
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
+    import db as db_module
+    # app при импорте открывает telegram-bot/bot_users.db — подменяем Database на время первого импорта
+    monkeypatch.setattr(db_module, 'Database', lambda *args, **kwargs: db)
+    import app
+    monkeypatch.setattr(app, 'db', db)
+    return app.app.test_client()
@@ -43,6 +43,7 @@ def main():
             second_reminder_sent BOOLEAN DEFAULT 0,
             started_at TIMESTAMP,
             diagnostics_started_at TIMESTAMP,
+            next_reminder_at TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Рассылка кампании из broadcast_outbox против локальной заглушки Bot API
+
+Создает временную sqlite БД с --users пользователями сегмента engaged, ставит кампанию
+в очередь и отправляет ее через BroadcastSender. Заглушка (scripts/benchmark_delivery.py)
+соблюдает лимиты Telegram и отвечает 429 при их превышении. С --interrupt-after прогон
+прерывается и запускается заново, чтобы проверить возобновление (сколько чатов получили
+сообщение дважды).
+
+Пример:
+    python scripts/benchmark_broadcast.py --users 1000
+    python scripts/benchmark_broadcast.py --users 300 --interrupt-after 5
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram-bot'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from benchmark_delivery import TOKEN, StubBotApi, make_handler
+from broadcast import BroadcastSender
+from db import Database
+
+
+class CountingStubBotApi(StubBotApi):
+    """Заглушка, которая считает принятые сообщения по чатам"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.per_chat = Counter()
+
+    def admit(self, chat_id) -> int:
+        retry_after = super().admit(chat_id)
+        if not retry_after:
+            with self.lock:
+                self.per_chat[chat_id] += 1
+        return retry_after
+
+
+def prepare_db(path: str, users: int) -> Database:
+    # Миграции из конструктора на пустой БД не находят users (ее создает init_db) — их ошибки не показываем
+    logging.disable(logging.ERROR)
+    db = Database(path)
+    logging.disable(logging.NOTSET)
+    db.init_db()
+    conn = db.get_connection()
+    conn.executemany('INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)',
+                     [(user_id, f'user{user_id}', 'User') for user_id in range(1, users + 1)])
+    conn.commit()
+    conn.close()
+    # Версия 0 (данных нет) — enqueue_broadcast не пересчитывает заданные вручную сегменты
+    db.save_user_segments({user_id: {
+        'segment': 'engaged', 'engagement_level': 'medium',
+        'conversion_potential': 'high', 'diagnostics_completed': False,
+    } for user_id in range(1, users + 1)}, {user_id: 0 for user_id in range(1, users + 1)})
+    return db
+
+
+async def send(port: int, db: Database, campaign_id: int, lease_seconds: int, timeout: float = None):
+    bot = Bot(TOKEN, base_url=f'http://127.0.0.1:{port}/bot', request=HTTPXRequest(connection_pool_size=32))
+    async with bot:
+        sender = BroadcastSender(bot, db, lease_seconds=lease_seconds)
+        if timeout is None:
+            return await sender.run(campaign_id)
+        try:
+            return await asyncio.wait_for(sender.run(campaign_id), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Рассылка кампании против заглушки Bot API')
+    parser.add_argument('--users', type=int, default=1000, help='Получателей в сегменте')
+    parser.add_argument('--latency-ms', type=float, default=80, help='Задержка ответа заглушки')
+    parser.add_argument('--stub-rate', type=float, default=30, help='Лимит заглушки, сообщений/с')
+    parser.add_argument('--interrupt-after', type=float, help='Прервать первый прогон через столько секунд')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = prepare_db(os.path.join(tmp, 'broadcast.db'), args.users)
+        campaign_id = db.create_broadcast_campaign('benchmark', 'Новая подборка материалов', {
+            'segment': 'engaged', 'diagnostics_completed': False})
+        print(f"В очереди: {db.enqueue_broadcast(campaign_id)}, повторная постановка: "
+              f"{db.enqueue_broadcast(campaign_id)}")
+
+        api = CountingStubBotApi(latency=args.latency_ms / 1000, global_rate=args.stub_rate)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(api))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            port = server.server_address[1]
+            if args.interrupt_after:
+                asyncio.run(send(port, db, campaign_id, lease_seconds=0, timeout=args.interrupt_after))
+                print(f"Прервано: {db.get_broadcast_progress(campaign_id)}")
+            totals = asyncio.run(send(port, db, campaign_id, lease_seconds=0))
+        finally:
+            server.shutdown()
+
+        print(f"Отправлено за прогон {totals['delivered']} за {totals['elapsed_seconds']} с "
+              f"({totals['throughput']} сообщ./с), 429 от заглушки {api.rejected}, повторов {totals['retries']}")
+        print(f"Прогресс: {totals['progress']}, кампания завершена: {totals['completed']}")
+        print(f"Чатов получили сообщение: {len(api.per_chat)}, дважды и более: "
+              f"{sum(1 for count in api.per_chat.values() if count > 1)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Проверка движка доставки против локальной заглушки Bot API
+
+Заглушка отвечает на getMe и sendMessage с задержкой --latency-ms и сама следит за
+лимитами Telegram: больше 30 сообщений в секунду на бота или больше 1 сообщения в секунду
+в чат — ответ 429 с retry_after. Сообщения отправляет настоящий telegram.Bot.
+
+Пример:
+    python scripts/benchmark_delivery.py --messages 300 --concurrency 1 20
+    python scripts/benchmark_delivery.py --messages 200 --concurrency 20 --stub-rate 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram-bot'))
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from delivery import DeliveryEngine, RateLimiter
+
+TOKEN = '123456:TEST'
+
+
+class StubBotApi:
+    """Состояние заглушки: лимиты и счетчики (общие для потоков HTTP сервера)"""
+
+    def __init__(self, latency: float, global_rate: float = 30, per_chat_interval: float = 1.0):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.lock = threading.Lock()
+        self.tokens = global_rate
+        self.updated = time.monotonic()
+        self.last_by_chat = {}
+        self.accepted = 0
+        self.rejected = 0
+
+    def admit(self, chat_id) -> int:
+        """0 — сообщение принято, иначе retry_after"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.global_rate, self.tokens + (now - self.updated) * self.global_rate)
+            self.updated = now
+            last = self.last_by_chat.get(chat_id)
+            # Небольшой допуск на дрожание часов между клиентом и заглушкой
+            if self.tokens < 1 or (last is not None and now - last < self.per_chat_interval * 0.9):
+                self.rejected += 1
+                return 1
+            self.tokens -= 1
+            self.last_by_chat[chat_id] = now
+            self.accepted += 1
+            return 0
+
+
+def make_handler(api: StubBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _params(self) -> dict:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+            if not body:
+                return {}
+            try:
+                return json.loads(body)
+            except ValueError:
+                return {key: values[0] for key, values in parse_qs(body).items()}
+
+        def _reply(self, status: int, payload: dict) -> None:
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            method = self.path.rsplit('/', 1)[-1]
+            params = self._params()
+            if method == 'getMe':
+                self._reply(200, {'ok': True, 'result': {
+                    'id': 123456, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}})
+                return
+            if method != 'sendMessage':
+                self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                return
+
+            time.sleep(api.latency)
+            chat_id = int(params['chat_id'])
+            retry_after = api.admit(chat_id)
+            if retry_after:
+                self._reply(429, {'ok': False, 'error_code': 429,
+                                  'description': f'Too Many Requests: retry after {retry_after}',
+                                  'parameters': {'retry_after': retry_after}})
+                return
+            self._reply(200, {'ok': True, 'result': {
+                'message_id': api.accepted, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}})
+
+    return Handler
+
+
+async def run_engine(port: int, messages: int, concurrency: int) -> dict:
+    bot = Bot(TOKEN, base_url=f'http://127.0.0.1:{port}/bot',
+              request=HTTPXRequest(connection_pool_size=max(concurrency, 1)))
+    async with bot:
+        engine = DeliveryEngine(RateLimiter(), concurrency=concurrency)
+        jobs = [(chat_id, lambda chat_id=chat_id: bot.send_message(chat_id=chat_id, text='Напоминание'))
+                for chat_id in range(1, messages + 1)]
+        return await engine.run(jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Движок доставки против заглушки Bot API')
+    parser.add_argument('--messages', type=int, default=300, help='Сообщений (в разные чаты)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 20], help='Значения concurrency')
+    parser.add_argument('--latency-ms', type=float, default=80, help='Задержка ответа заглушки')
+    parser.add_argument('--stub-rate', type=float, default=30,
+                        help='Лимит заглушки, сообщений/с (ниже 25 — проверка обработки 429)')
+    args = parser.parse_args()
+
+    for concurrency in args.concurrency:
+        api = StubBotApi(latency=args.latency_ms / 1000, global_rate=args.stub_rate)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(api))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            report = asyncio.run(run_engine(server.server_address[1], args.messages, concurrency))
+        finally:
+            server.shutdown()
+        print(f"concurrency={concurrency}: доставлено {len(report['delivered'])}/{report['total']} "
+              f"за {report['elapsed_seconds']} с ({report['throughput']} сообщ./с), "
+              f"429 от заглушки {api.rejected}, повторов {report['retries']}, "
+              f"задержка p50/p95 {report['latency_ms']['p50']}/{report['latency_ms']['p95']} мс, "
+              f"send p95 {report['send_ms']['p95']} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка движка воронок на синтетических событиях
+
+Пример:
+    python scripts/benchmark_funnel.py --events 3000000
+    python scripts/benchmark_funnel.py --events 2000000 --sqlite /tmp/funnel_bench.db
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram-bot'))
+
+from funnel import FunnelEngine, FunnelStep
+
+STEPS = [
+    FunnelStep(name='Визит', event_type='visit', event_name='source_visit'),
+    FunnelStep(name='Просмотр раздела', event_type='content', event_name='content_view', section='services'),
+    FunnelStep(name='Диагностика', event_type='diagnostic', event_name='diagnostic_completed'),
+    FunnelStep(name='Клик CTA', event_type='cta', event_name='cta_click', cta_location='footer'),
+]
+
+NOISE = [
+    ('app', 'miniapp_open', None, None),
+    ('content', 'content_view', 'about', None),
+    ('ai', 'ai_interaction', None, None),
+    ('cta', 'cta_click', None, 'header'),
+]
+
+FUNNEL_EVENTS = [
+    ('visit', 'source_visit', None, None),
+    ('content', 'content_view', 'services', None),
+    ('diagnostic', 'diagnostic_completed', None, None),
+    ('cta', 'cta_click', None, 'footer'),
+]
+
+
+def generate_events(total: int, events_per_user: int = 30, seed: int = 42):
+    """События, уже отсортированные по (tg_user_id, ts)"""
+    rnd = random.Random(seed)
+    users = max(1, total // events_per_user)
+    for user_id in range(1, users + 1):
+        ts = 1_700_000_000 + rnd.randint(0, 30 * 86400)
+        for _ in range(events_per_user):
+            ts += rnd.randint(10, 6 * 3600)
+            if rnd.random() < 0.3:
+                kind = FUNNEL_EVENTS[min(int(rnd.expovariate(1.2)), len(FUNNEL_EVENTS) - 1)]
+            else:
+                kind = rnd.choice(NOISE)
+            yield (user_id, ts) + kind
+
+
+def run_in_memory(total: int) -> None:
+    engine = FunnelEngine(STEPS, window_seconds=3 * 86400)
+    started = time.perf_counter()
+    report = engine.evaluate(generate_events(total))
+    elapsed = time.perf_counter() - started
+    print(f"В памяти (вместе с генерацией): {total:,} событий за {elapsed:.2f} с ({total / elapsed:,.0f} событий/с)")
+    for step in report['steps']:
+        print(f"  {step['step']}. {step['name']}: {step['users']} (отток {step['drop_off']})")
+
+
+def run_sqlite(total: int, path: str) -> None:
+    from db import Database
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE site_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, session_id INTEGER, tg_user_id INTEGER,
+            event_type TEXT, event_name TEXT, section TEXT, custom_data TEXT, created_at TIMESTAMP
+        )
+    ''')
+    conn.executemany(
+        'INSERT INTO site_events (session_id, tg_user_id, event_type, event_name, section, custom_data, created_at) '
+        "VALUES (1, ?, ?, ?, ?, ?, datetime(?, 'unixepoch'))",
+        ((user, event_type, event_name, section,
+          f'{{"cta_location": "{cta}"}}' if cta else None, ts)
+         for user, ts, event_type, event_name, section, cta in generate_events(total))
+    )
+    conn.execute('CREATE INDEX idx_site_events_user_created ON site_events(tg_user_id, created_at)')
+    conn.commit()
+    conn.close()
+
+    db = Database(path)
+    started = time.perf_counter()
+    report = db.get_funnel(STEPS, window_seconds=3 * 86400, start_date='2023-01-01', end_date='2024-12-31')
+    elapsed = time.perf_counter() - started
+    print(f"SQLite: {total:,} событий за {elapsed:.2f} с, вошли {report['users_entered']}, "
+          f"дошли до конца {report['users_completed']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочная проверка движка воронок')
+    parser.add_argument('--events', type=int, default=3_000_000, help='Количество синтетических событий')
+    parser.add_argument('--sqlite', help='Путь к временной SQLite базе для проверки полного пути через БД')
+    args = parser.parse_args()
+
+    run_in_memory(args.events)
+    if args.sqlite:
+        run_sqlite(args.events, args.sqlite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Сравнение времени сборки персонального отчета: прежняя схема (7 запросов + get_user_segment)
+и get_personal_report_data (одно соединение, два запроса; в Postgres — pipeline mode)
+
+Usage:
+  python scripts/benchmark_personal_report.py                                   # синтетическая SQLite база
+  python scripts/benchmark_personal_report.py --db postgresql://... --user 123  # существующая база
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram-bot'))
+
+from db import Database
+
+LEGACY_QUERIES = [
+    '''SELECT cookie_id, source, utm_params, referrer, MIN(session_start) as first_visit
+       FROM site_sessions WHERE tg_user_id = ?
+       GROUP BY cookie_id, source, utm_params, referrer ORDER BY first_visit ASC LIMIT 1''',
+    '''SELECT DISTINCT ss.session_start, ss.page_id, ss.device_type, ss.session_start
+       FROM site_sessions ss WHERE ss.tg_user_id = ? ORDER BY ss.session_start DESC LIMIT 20''',
+] + [
+    f'''SELECT se.created_at, se.metadata FROM site_events se
+        WHERE se.tg_user_id = ? AND se.event_type = '{event_type}'
+        ORDER BY se.created_at DESC LIMIT {limit}'''
+    for event_type, limit in (('content', 50), ('ai', 30), ('diagnostic', 10), ('game', 20), ('cta', 20))
+]
+
+
+def legacy_report(db: Database, tg_user_id: int) -> None:
+    """Прежняя схема эндпоинта: отдельные запросы на каждый раздел и get_user_segment"""
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    for sql in LEGACY_QUERIES:
+        cursor.execute(sql, (tg_user_id,))
+        cursor.fetchall()
+    conn.close()
+    db.get_user_segment(tg_user_id)
+
+
+def seed_sqlite(path: str, users: int, events_per_user: int) -> Database:
+    import sqlite3
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+        has_started_diagnostics BOOLEAN DEFAULT 0, first_reminder_sent BOOLEAN DEFAULT 0,
+        second_reminder_sent BOOLEAN DEFAULT 0, started_at TIMESTAMP, diagnostics_started_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany('INSERT INTO users (user_id) VALUES (?)', [(uid,) for uid in range(1, users + 1)])
+    conn.commit()
+    conn.close()
+
+    db = Database(path)
+    for uid in range(1, users + 1):
+        session_id = db.create_site_session(f'cookie_{uid}', tg_user_id=uid)
+        db.log_source_visit(session_id, 'telegram', f'cookie_{uid}', {'utm_campaign': 'bench'}, tg_user_id=uid)
+        for i in range(events_per_user):
+            if i % 3 == 0:
+                db.log_content_view(session_id, 'article', f'a{i}', None, 'services', 30, 60, f'cookie_{uid}', uid)
+            elif i % 3 == 1:
+                db.log_cta_click(session_id, 'telegram', None, 'footer', None, 5, f'cookie_{uid}', uid)
+            else:
+                db.log_event(session_id, 'page_view', 'page_loaded', page='/', tg_user_id=uid)
+    return db
+
+
+def measure(fn, db: Database, user_ids, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        for uid in user_ids:
+            started = time.perf_counter()
+            fn(db, uid)
+            timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк сборки персонального отчета')
+    parser.add_argument('--db', help='DATABASE_URL или путь к SQLite (по умолчанию — синтетическая база)')
+    parser.add_argument('--user', type=int, action='append', help='tg_user_id для замера (можно несколько)')
+    parser.add_argument('--users', type=int, default=50, help='Пользователей в синтетической базе')
+    parser.add_argument('--events', type=int, default=200, help='Событий на пользователя в синтетической базе')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.db:
+        db = Database(args.db)
+        user_ids = args.user or []
+        if not user_ids:
+            parser.error('Для существующей базы укажите --user')
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'report_bench.db')
+        db = seed_sqlite(path, args.users, args.events)
+        user_ids = list(range(1, args.users + 1))
+
+    legacy = measure(legacy_report, db, user_ids, args.repeat)
+    current = measure(lambda d, uid: d.get_personal_report_data(uid), db, user_ids, args.repeat)
+    print(f"Прежняя схема: медиана {legacy:.2f} мс на отчет")
+    print(f"get_personal_report_data: медиана {current:.2f} мс на отчет ({legacy / current:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
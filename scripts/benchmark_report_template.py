@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк рендеринга HTML персонального отчета: renders/sec
+
+Сравнивает предкомпилированный шаблон (report_template.render_personal_report) с разбором
+того же шаблона на каждом вызове (re.sub по исходному тексту).
+
+Usage:
+  python scripts/benchmark_report_template.py [--seconds 2]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+from report_template import SLOT_PATTERN, TEMPLATE_PATH, personal_report_values, render_personal_report
+
+SAMPLE_REPORT = {
+    'generated_at': '2026-01-23T17:00:00Z',
+    'user': {
+        'tg_user_id': 987654321,
+        'cookie_id': 'abc123def456',
+        'traffic_source': 'telegram',
+        'first_visit_date': '2026-01-20T10:00:00',
+    },
+    'segmentation': {'user_segment': 'engaged', 'engagement_level': 'medium'},
+    'recommendations': {'next_steps': [
+        'Пройдите диагностику <полностью>',
+        'Изучите раздел «Воронки продаж»',
+        'Задайте вопрос ИИ-наставнику',
+        'Лишняя рекомендация',
+    ]},
+}
+
+with open(TEMPLATE_PATH, encoding='utf-8') as f:
+    TEMPLATE_SOURCE = f.read()
+
+
+def parse_per_call(report_data):
+    """Базовая линия: шаблон разбирается заново на каждом вызове"""
+    values = personal_report_values(report_data)
+    return SLOT_PATTERN.sub(lambda m: values[m.group(1)], TEMPLATE_SOURCE)
+
+
+def renders_per_second(fn, seconds: float) -> float:
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            fn(SAMPLE_REPORT)
+        count += 100
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк рендеринга HTML персонального отчета')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Длительность каждого замера')
+    args = parser.parse_args()
+
+    assert parse_per_call(SAMPLE_REPORT) == render_personal_report(SAMPLE_REPORT)
+
+    baseline = renders_per_second(parse_per_call, args.seconds)
+    compiled = renders_per_second(render_personal_report, args.seconds)
+    print(f"Разбор шаблона на каждом вызове: {baseline:,.0f} renders/sec")
+    print(f"Предкомпилированный шаблон:      {compiled:,.0f} renders/sec ({compiled / baseline:.1f}x)")
+
+if __name__ == '__main__':
+    main()
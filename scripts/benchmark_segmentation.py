@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Масштабирование расчета сегментов по числу процессов на синтетической SQLite базе
+
+Пример:
+    python scripts/benchmark_segmentation.py --users 200000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram-bot'))
+
+from db import Database
+from user_segmentation import UserSegmentation
+
+
+def build_database(path: str, users: int, seed: int = 42) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+            has_started_diagnostics BOOLEAN DEFAULT 0, first_reminder_sent BOOLEAN DEFAULT 0,
+            second_reminder_sent BOOLEAN DEFAULT 0, started_at TIMESTAMP, diagnostics_started_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+    # Схема остальных таблиц — миграциями
+    Database(path)
+
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (user_id) VALUES (?)', ((uid,) for uid in range(1, users + 1)))
+    sessions, events, diagnostics = [], [], []
+    for uid in range(1, users + 1):
+        for _ in range(rnd.randint(1, 8)):
+            sessions.append((f'ck{uid}', uid, f'-{rnd.randint(0, 60)} days'))
+        events.extend((uid, uid, 'page_view', 'view') for _ in range(rnd.randint(1, 40)))
+        if rnd.random() < 0.2:
+            diagnostics.append((uid, '{}'))
+    conn.executemany("INSERT INTO site_sessions (cookie_id, tg_user_id, session_start) "
+                     "VALUES (?, ?, datetime('now', ?))", sessions)
+    conn.executemany("INSERT INTO site_events (session_id, tg_user_id, event_type, event_name) "
+                     "VALUES (?, ?, ?, ?)", events)
+    conn.executemany("INSERT INTO diagnostics_results (tg_user_id, result_json) VALUES (?, ?)", diagnostics)
+    # Версии данных, которые в работе увеличивает запись событий (все пользователи «грязные»)
+    conn.executemany('INSERT INTO user_data_versions (tg_user_id, version) VALUES (?, 1)',
+                     ((uid,) for uid in range(1, users + 1)))
+    conn.commit()
+    conn.close()
+    print(f"База: {users:,} пользователей, {len(sessions):,} сессий, {len(events):,} событий")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Масштабирование расчета сегментов по процессам')
+    parser.add_argument('--users', type=int, default=200_000, help='Количество синтетических пользователей')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='Числа процессов')
+    parser.add_argument('--sqlite', default='/tmp/segmentation_bench.db', help='Путь к временной SQLite базе')
+    args = parser.parse_args()
+
+    build_database(args.sqlite, args.users)
+    segmentation = UserSegmentation(args.sqlite)
+    user_ids = [uid for chunk in segmentation.db.iter_user_ids() for uid in chunk]
+
+    baseline = None
+    for workers in args.workers:
+        started = time.perf_counter()
+        computed = sum(len(segments) for _, segments in segmentation._compute_segments(user_ids, workers))
+        compute_elapsed = time.perf_counter() - started
+
+        # Все пользователи снова «грязные»: снимок пересчитывает и записывает всех
+        conn = sqlite3.connect(args.sqlite)
+        conn.execute('UPDATE user_segments SET data_version = -1')
+        conn.commit()
+        conn.close()
+        started = time.perf_counter()
+        snapshot = segmentation.build_segment_snapshot(workers=workers)
+        snapshot_elapsed = time.perf_counter() - started
+
+        # Данные не менялись: снимок — только чтение user_segments
+        started = time.perf_counter()
+        segmentation.build_segment_snapshot(workers=workers)
+        unchanged_elapsed = time.perf_counter() - started
+
+        baseline = baseline or compute_elapsed
+        print(f"workers={workers}: расчет {computed:,} сегментов {compute_elapsed:.2f} с "
+              f"(x{baseline / compute_elapsed:.2f}), снимок с записью {snapshot_elapsed:.2f} с, "
+              f"без изменений {unchanged_elapsed:.2f} с, сегменты {snapshot['counts']}")
+
+
+if __name__ == '__main__':
+    main()
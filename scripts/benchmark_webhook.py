@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Задержка «обновление → ответ» в режимах polling и webhook против локальной заглушки Bot API
+
+Заглушка принимает обновления от генератора и либо отдает их через getUpdates (long polling),
+либо сама отправляет POST на webhook сервер бота (telegram-bot/webhook.py) с секретным
+заголовком через --webhook-connections параллельных соединений, как это делает Telegram.
+Обработчик бота ждет --handler-ms (имитация работы с БД и сетью) и отвечает sendMessage;
+задержка — от появления обновления в заглушке до прихода ответа.
+
+Пример:
+    python scripts/benchmark_webhook.py --updates 300 --rate 50 --handler-ms 50
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'telegram-bot'))
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, MessageHandler, filters
+from telegram.request import HTTPXRequest
+
+from webhook import serve_webhook
+
+TOKEN = '123456:TEST'
+SECRET = 'benchmark-secret'
+WEBHOOK_PATH = '/telegram/webhook'
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class StubBotApi:
+    """Очередь обновлений для getUpdates и время появления каждого обновления и ответа на него"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = []
+        self.injected_at = {}
+        self.replied_at = {}
+        self.all_replied = threading.Event()
+        self.expected = 0
+
+    def inject(self, update: dict) -> None:
+        with self.cond:
+            self.injected_at[update['update_id']] = time.perf_counter()
+            self.pending.append(update)
+            self.cond.notify_all()
+
+    def get_updates(self, offset: int, timeout: float) -> list:
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                self.pending = [u for u in self.pending if u['update_id'] >= offset]
+                if self.pending or time.monotonic() >= deadline:
+                    return list(self.pending[:100])
+                self.cond.wait(deadline - time.monotonic())
+
+    def replied(self, update_id: int) -> None:
+        with self.cond:
+            self.replied_at.setdefault(update_id, time.perf_counter())
+            if len(self.replied_at) >= self.expected:
+                self.all_replied.set()
+
+
+def make_handler(api: StubBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _params(self) -> dict:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+            if not body:
+                return {}
+            try:
+                return json.loads(body)
+            except ValueError:
+                return {key: values[0] for key, values in parse_qs(body).items()}
+
+        def _reply(self, result) -> None:
+            data = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            try:
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # Клиент закрыл long poll при остановке polling
+                pass
+
+        def do_POST(self):
+            method = self.path.rsplit('/', 1)[-1]
+            params = self._params()
+            if method == 'getMe':
+                self._reply({'id': 123456, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'})
+            elif method == 'getUpdates':
+                self._reply(api.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0)))
+            elif method == 'sendMessage':
+                chat_id = int(params['chat_id'])
+                api.replied(int(params['text'].split()[-1]))
+                self._reply({'message_id': 1, 'date': int(time.time()),
+                             'chat': {'id': chat_id, 'type': 'private'}, 'text': params['text']})
+            else:
+                # setWebhook, deleteWebhook и прочее
+                self._reply(True)
+
+    return Handler
+
+
+def make_update(update_id: int) -> dict:
+    chat_id = 1000 + update_id
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': f'ping {update_id}',
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+    }}
+
+
+def build_application(api_port: int, handler_ms: float, concurrent_updates: int) -> Application:
+    async def pong(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await asyncio.sleep(handler_ms / 1000)
+        await update.message.reply_text(f'pong {update.update_id}')
+
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f'http://127.0.0.1:{api_port}/bot')
+        .request(HTTPXRequest(connection_pool_size=max(concurrent_updates, 1) + 4))
+        .get_updates_request(HTTPXRequest())
+        .concurrent_updates(concurrent_updates)
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, pong))
+    return application
+
+
+def start_generator(updates: int, rate: float, deliver) -> threading.Thread:
+    def run():
+        started = time.perf_counter()
+        for update_id in range(1, updates + 1):
+            delay = started + (update_id - 1) / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            deliver(make_update(update_id))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+async def run_polling_mode(api: StubBotApi, api_port: int, args, concurrent_updates: int) -> None:
+    application = build_application(api_port, args.handler_ms, concurrent_updates)
+    async with application:
+        await application.updater.start_polling(timeout=10)
+        await application.start()
+        start_generator(args.updates, args.rate, api.inject)
+        await asyncio.to_thread(api.all_replied.wait, args.timeout)
+        await application.updater.stop()
+        await application.stop()
+
+
+async def run_webhook_mode(api: StubBotApi, api_port: int, args, concurrent_updates: int) -> None:
+    application = build_application(api_port, args.handler_ms, concurrent_updates)
+    stop_event = asyncio.Event()
+    server_task = asyncio.create_task(serve_webhook(
+        application, f'http://127.0.0.1:{args.webhook_port}{WEBHOOK_PATH}', SECRET,
+        listen='127.0.0.1', port=args.webhook_port, path=WEBHOOK_PATH, stop_event=stop_event))
+    # Ждем, пока сервер начнет принимать соединения
+    for _ in range(100):
+        try:
+            probe = http.client.HTTPConnection('127.0.0.1', args.webhook_port, timeout=1)
+            probe.connect()
+            probe.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+
+    # Telegram держит до max_connections соединений с webhook и шлет по ним обновления параллельно
+    outbox: queue.Queue = queue.Queue()
+
+    def sender():
+        conn = http.client.HTTPConnection('127.0.0.1', args.webhook_port, timeout=10)
+        while True:
+            update = outbox.get()
+            if update is None:
+                return
+            body = json.dumps(update).encode('utf-8')
+            conn.request('POST', WEBHOOK_PATH, body=body, headers={
+                'Content-Type': 'application/json',
+                'X-Telegram-Bot-Api-Secret-Token': SECRET,
+            })
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                print(f"webhook ответил {response.status} на обновление {update['update_id']}")
+
+    pool = ThreadPoolExecutor(args.webhook_connections)
+    for _ in range(args.webhook_connections):
+        pool.submit(sender)
+    def enqueue(update: dict) -> None:
+        api.injected_at[update['update_id']] = time.perf_counter()
+        outbox.put(update)
+
+    start_generator(args.updates, args.rate, enqueue)
+    await asyncio.to_thread(api.all_replied.wait, args.timeout)
+    for _ in range(args.webhook_connections):
+        outbox.put(None)
+    pool.shutdown(wait=True)
+    stop_event.set()
+    await server_task
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Задержка обновление → ответ: polling и webhook')
+    parser.add_argument('--updates', type=int, default=300, help='Сколько обновлений отправить')
+    parser.add_argument('--rate', type=float, default=50, help='Обновлений в секунду')
+    parser.add_argument('--handler-ms', type=float, default=50, help='Время работы обработчика')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='concurrent_updates (polling дополнительно меряется с 1, как в bot.py)')
+    parser.add_argument('--webhook-connections', type=int, default=8, help='Параллельных соединений к webhook')
+    parser.add_argument('--webhook-port', type=int, default=18443)
+    parser.add_argument('--timeout', type=float, default=120, help='Сколько ждать всех ответов')
+    args = parser.parse_args()
+
+    for mode, runner, concurrent_updates in (
+        ('polling', run_polling_mode, 1),
+        ('polling', run_polling_mode, args.concurrency),
+        ('webhook', run_webhook_mode, args.concurrency),
+    ):
+        api = StubBotApi()
+        api.expected = args.updates
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(api))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        started = time.perf_counter()
+        try:
+            asyncio.run(runner(api, server.server_address[1], args, concurrent_updates))
+        finally:
+            server.shutdown()
+        elapsed = time.perf_counter() - started
+
+        latencies = [(api.replied_at[uid] - api.injected_at[uid]) * 1000
+                     for uid in api.replied_at if uid in api.injected_at]
+        print(f"{mode} (concurrent_updates={concurrent_updates}): ответов {len(latencies)}/{args.updates} "
+              f"за {elapsed:.2f} с, задержка p50/p95/max "
+              f"{_percentile(latencies, 0.5):.1f}/{_percentile(latencies, 0.95):.1f}/{max(latencies, default=0):.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@ CREATE TABLE IF NOT EXISTS users (
   started_at TIMESTAMP,
   diagnostics_started_at TIMESTAMP,
   diagnostics_completed_at TIMESTAMP,
+  next_reminder_at TIMESTAMP,
   created_at TIMESTAMP DEFAULT now(),
   updated_at TIMESTAMP DEFAULT now()
 );
@@ -180,14 +181,202 @@ CREATE TABLE IF NOT EXISTS game_actions (
   CONSTRAINT fk_game_user FOREIGN KEY (tg_user_id) REFERENCES users(user_id) ON DELETE SET NULL
 );
 
+-- HyperLogLog sketches of unique visitors
+CREATE TABLE IF NOT EXISTS visitor_sketches (
+  day TEXT NOT NULL,
+  dimension TEXT NOT NULL,
+  value TEXT NOT NULL,
+  sketch BYTEA NOT NULL,
+  updated_at TIMESTAMP DEFAULT now(),
+  PRIMARY KEY (day, dimension, value)
+);
+
+-- Per-user activity profiles (hour histogram, first/last seen)
+CREATE TABLE IF NOT EXISTS user_activity_profiles (
+  tg_user_id BIGINT PRIMARY KEY,
+  hour_histogram BYTEA NOT NULL,
+  first_seen_at TIMESTAMP,
+  last_seen_at TIMESTAMP,
+  sessions_count INTEGER DEFAULT 0,
+  first_session_at TIMESTAMP,
+  updated_at TIMESTAMP DEFAULT now(),
+  CONSTRAINT fk_activity_user FOREIGN KEY (tg_user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- Per-user content / AI conversation preference counters
+CREATE TABLE IF NOT EXISTS user_preference_counters (
+  tg_user_id BIGINT NOT NULL,
+  kind TEXT NOT NULL,
+  value TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT now(),
+  PRIMARY KEY (tg_user_id, kind, value)
+);
+
+INSERT INTO user_preference_counters (tg_user_id, kind, value, count)
+SELECT tg_user_id, 'content_type', content_type, COUNT(*)
+FROM content_views
+WHERE tg_user_id IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM user_preference_counters WHERE kind = 'content_type')
+GROUP BY tg_user_id, content_type;
+
+INSERT INTO user_preference_counters (tg_user_id, kind, value, count)
+SELECT tg_user_id, 'conversation_type', conversation_type, COUNT(*)
+FROM ai_interactions
+WHERE tg_user_id IS NOT NULL AND conversation_type IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM user_preference_counters WHERE kind = 'conversation_type')
+GROUP BY tg_user_id, conversation_type;
+
+-- Precomputed navigation: transitions and frequent paths by day
+CREATE TABLE IF NOT EXISTS navigation_transitions (
+  day TEXT NOT NULL,
+  from_node TEXT NOT NULL,
+  to_node TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, from_node, to_node)
+);
+
+CREATE TABLE IF NOT EXISTS navigation_paths (
+  day TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  path TEXT NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, kind, path)
+);
+
+CREATE TABLE IF NOT EXISTS navigation_days (
+  day TEXT PRIMARY KEY,
+  events_count INTEGER NOT NULL DEFAULT 0,
+  is_complete INTEGER NOT NULL DEFAULT 0,
+  built_at TIMESTAMP DEFAULT now()
+);
+
+-- Per-user data version (personal report cache / ETag)
+CREATE TABLE IF NOT EXISTS user_data_versions (
+  tg_user_id BIGINT PRIMARY KEY,
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT now()
+);
+
+-- Users with data from before user_data_versions existed start at version 1 (dirty for segmentation)
+INSERT INTO user_data_versions (tg_user_id, version)
+SELECT tg_user_id, 1 FROM (
+  SELECT tg_user_id FROM site_sessions WHERE tg_user_id IS NOT NULL
+  UNION
+  SELECT tg_user_id FROM site_events WHERE tg_user_id IS NOT NULL
+  UNION
+  SELECT tg_user_id FROM diagnostics_results WHERE tg_user_id IS NOT NULL
+) existing
+ON CONFLICT (tg_user_id) DO NOTHING;
+
+-- Per-user journey ring buffers for the personal report
+CREATE TABLE IF NOT EXISTS user_journeys (
+  tg_user_id BIGINT NOT NULL,
+  category TEXT NOT NULL,
+  entries JSONB NOT NULL,
+  updated_at TIMESTAMP DEFAULT now(),
+  PRIMARY KEY (tg_user_id, category)
+);
+
+-- Precomputed rule-based recommendations per user data version
+CREATE TABLE IF NOT EXISTS user_recommendations (
+  tg_user_id BIGINT PRIMARY KEY,
+  segment TEXT,
+  engagement_level TEXT,
+  recommendations JSONB NOT NULL,
+  data_version INTEGER NOT NULL DEFAULT 0,
+  updated_at TIMESTAMP DEFAULT now()
+);
+
+-- Latest computed segment per user (membership for segment aggregates)
+CREATE TABLE IF NOT EXISTS user_segments (
+  tg_user_id BIGINT PRIMARY KEY,
+  segment TEXT NOT NULL,
+  engagement_level TEXT NOT NULL,
+  conversion_potential TEXT,
+  diagnostics_completed BOOLEAN DEFAULT FALSE,
+  data_version INTEGER NOT NULL DEFAULT -1,
+  updated_at TIMESTAMP DEFAULT now()
+);
+
+-- Segment transitions audit trail
+CREATE TABLE IF NOT EXISTS user_segment_history (
+  id BIGSERIAL PRIMARY KEY,
+  tg_user_id BIGINT NOT NULL,
+  previous_segment TEXT,
+  segment TEXT NOT NULL,
+  previous_engagement_level TEXT,
+  engagement_level TEXT NOT NULL,
+  data_version INTEGER,
+  changed_at TIMESTAMP DEFAULT now()
+);
+
+-- One segmentation snapshot per automated actions run
+CREATE TABLE IF NOT EXISTS segment_snapshots (
+  id SERIAL PRIMARY KEY,
+  created_at TIMESTAMP DEFAULT now(),
+  users_count INTEGER NOT NULL DEFAULT 0,
+  segment_counts JSONB NOT NULL,
+  duration_ms INTEGER
+);
+
+-- Broadcast campaigns by segment and their send queue (outbox)
+CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+  id SERIAL PRIMARY KEY,
+  name TEXT UNIQUE NOT NULL,
+  message_text TEXT NOT NULL,
+  segment_criteria JSONB,
+  status TEXT NOT NULL DEFAULT 'active',
+  created_at TIMESTAMP DEFAULT now(),
+  completed_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_outbox (
+  campaign_id INTEGER NOT NULL,
+  tg_user_id BIGINT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  updated_at TIMESTAMP DEFAULT now(),
+  sent_at TIMESTAMP,
+  PRIMARY KEY (campaign_id, tg_user_id)
+);
+
+-- Columns added after the initial schema (existing databases)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS next_reminder_at TIMESTAMP;
+-- Backfill for users still owed reminders (same rule as the SQLite migration); idempotent,
+-- since a pending user with a schedule never has next_reminder_at NULL
+UPDATE users
+SET next_reminder_at = CASE
+  WHEN first_reminder_sent = false THEN started_at + INTERVAL '10 minutes'
+  WHEN second_reminder_sent = false THEN started_at + INTERVAL '24 hours'
+END
+WHERE has_started_diagnostics = false AND started_at IS NOT NULL AND next_reminder_at IS NULL
+  AND (first_reminder_sent = false OR second_reminder_sent = false);
+ALTER TABLE user_segments ADD COLUMN IF NOT EXISTS data_version INTEGER NOT NULL DEFAULT -1;
+
 -- Indexes
 CREATE INDEX IF NOT EXISTS idx_user_identities_tg_user ON user_identities(tg_user_id);
 CREATE INDEX IF NOT EXISTS idx_user_identities_cookie ON user_identities(cookie_id);
 CREATE INDEX IF NOT EXISTS idx_site_sessions_cookie ON site_sessions(cookie_id);
 CREATE INDEX IF NOT EXISTS idx_site_sessions_tg_user ON site_sessions(tg_user_id);
+CREATE INDEX IF NOT EXISTS idx_site_sessions_start ON site_sessions(session_start);
+CREATE INDEX IF NOT EXISTS idx_site_sessions_source_campaign ON site_sessions(source, utm_campaign);
+CREATE INDEX IF NOT EXISTS idx_site_sessions_cookie_start ON site_sessions(cookie_id, session_start DESC);
 CREATE INDEX IF NOT EXISTS idx_site_events_session ON site_events(session_id);
 CREATE INDEX IF NOT EXISTS idx_site_events_tg_user ON site_events(tg_user_id);
+CREATE INDEX IF NOT EXISTS idx_site_events_user_created ON site_events(tg_user_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_diagnostics_tg_user ON diagnostics_results(tg_user_id);
+CREATE INDEX IF NOT EXISTS idx_visitor_sketches_dimension ON visitor_sketches(dimension, day);
+CREATE INDEX IF NOT EXISTS idx_navigation_transitions_from ON navigation_transitions(from_node, day);
+CREATE INDEX IF NOT EXISTS idx_user_segments_segment ON user_segments(segment);
+CREATE INDEX IF NOT EXISTS idx_user_segment_history_user ON user_segment_history(tg_user_id, changed_at);
+CREATE INDEX IF NOT EXISTS idx_users_next_reminder ON users(next_reminder_at) WHERE next_reminder_at IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_users_first_reminder_pending ON users(started_at)
+  WHERE has_started_diagnostics = false AND first_reminder_sent = false;
+CREATE INDEX IF NOT EXISTS idx_users_second_reminder_pending ON users(started_at)
+  WHERE has_started_diagnostics = false AND second_reminder_sent = false;
+CREATE INDEX IF NOT EXISTS idx_broadcast_outbox_status ON broadcast_outbox(campaign_id, status, tg_user_id);
 
 '''
 
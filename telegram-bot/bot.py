@@ -1,10 +1,16 @@
 import os
+import asyncio
 import logging
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from broadcast import send_active_campaigns
 from db import Database
 from notifications import NotificationService
+from reminder_scheduler import ReminderScheduler
+from stats_snapshot import STATS_REFRESH_INTERVAL, StatsSnapshot
+from webhook import serve_webhook
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -25,9 +31,17 @@ logger.info("Логирование настроено. Логи сохраня
 # URL вашего сайта (MiniApp)
 MINIAPP_URL = os.getenv('MINIAPP_URL', 'https://spacegrow.vercel.app/')
 
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+
 # Инициализация БД и сервиса уведомлений
 db = Database()
 notification_service = None  # Инициализируется после создания бота
+reminder_scheduler = None  # Планировщик напоминаний, запускается вместе с приложением
+stats_snapshot = StatsSnapshot(db)  # Счетчики /stats, обновляются в фоне
+
+# Как часто проверять активные кампании рассылок (секунды)
+BROADCAST_POLL_INTERVAL = 60
 
 # Команда /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -41,7 +55,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         first_name=user.first_name,
         last_name=user.last_name
     )
-    logger.info(f"Пользователь {user.id} запустил /start. Таймер напоминания установлен на 1 минуту")
+    if reminder_scheduler:
+        reminder_scheduler.refresh([user.id])
+    logger.info(f"Пользователь {user.id} запустил /start. Напоминание запланировано")
     
     # Создаем кнопку с WebApp
     keyboard = [
@@ -98,10 +114,14 @@ async def handle_web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Если в данных есть информация о начале диагностики
         elif 'diagnostics' in data.lower() or 'started' in data.lower():
             db.mark_diagnostics_started(user.id)
+            if reminder_scheduler:
+                reminder_scheduler.cancel(user.id)
             logger.info(f"Пользователь {user.id} начал диагностику через MiniApp")
         else:
             # Просто открытие MiniApp тоже считаем началом
             db.mark_diagnostics_started(user.id)
+            if reminder_scheduler:
+                reminder_scheduler.cancel(user.id)
             logger.info(f"Пользователь {user.id} открыл MiniApp")
 
 # Команда /diagnostics
@@ -111,6 +131,8 @@ async def diagnostics_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     # Отмечаем, что пользователь начал диагностику
     db.mark_diagnostics_started(user.id)
+    if reminder_scheduler:
+        reminder_scheduler.cancel(user.id)
     
     diagnostics_url = f"{MINIAPP_URL}#diagnostics"
     keyboard = [
@@ -143,56 +165,33 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     try:
-        # Получаем статистику из БД
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        # Общая статистика
-        cursor.execute('SELECT COUNT(*) as total FROM users')
-        total = cursor.fetchone()['total']
-        
-        cursor.execute('SELECT COUNT(*) as started FROM users WHERE has_started_diagnostics = 1')
-        started = cursor.fetchone()['started']
-        
-        cursor.execute('SELECT COUNT(*) as first_sent FROM users WHERE first_reminder_sent = 1')
-        first_sent = cursor.fetchone()['first_sent']
-        
-        cursor.execute('SELECT COUNT(*) as second_sent FROM users WHERE second_reminder_sent = 1')
-        second_sent = cursor.fetchone()['second_sent']
-        
-        # Пользователи ожидающие первого напоминания
-        cursor.execute('''
-            SELECT COUNT(*) as pending 
-            FROM users 
-            WHERE has_started_diagnostics = 0 
-            AND first_reminder_sent = 0
-            AND started_at IS NOT NULL
-            AND datetime(started_at, '+10 minutes') <= datetime('now')
-        ''')
-        pending_first = cursor.fetchone()['pending']
-        
-        # Последние 5 пользователей
-        cursor.execute('''
-            SELECT user_id, first_name, username, has_started_diagnostics, 
-                   first_reminder_sent, started_at
-            FROM users
-            ORDER BY created_at DESC
-            LIMIT 5
-        ''')
-        recent_users = cursor.fetchall()
-        
-        conn.close()
+        # Счетчики из снимка в памяти (обновляется в фоне, см. stats_snapshot.py)
+        stats = await stats_snapshot.get()
+        if stats is None:
+            raise RuntimeError("снимок статистики еще не готов")
+
+        def rate(value):
+            return 'н/д' if value is None else value
+
+        lag_minutes = round(stats['segmentation_lag_seconds'] / 60)
         
         # Формируем сообщение
         stats_text = (
             f"📊 <b>Статистика бота</b>\n\n"
-            f"👥 Всего пользователей: <b>{total}</b>\n"
-            f"✅ Начали диагностику: <b>{started}</b>\n"
-            f"📨 Первое напоминание отправлено: <b>{first_sent}</b>\n"
-            f"📨 Второе напоминание отправлено: <b>{second_sent}</b>\n"
-            f"⏰ Ожидают первого напоминания (прошла 10+ мин): <b>{pending_first}</b>\n\n"
+            f"👥 Всего пользователей: <b>{stats['total_users']}</b>\n"
+            f"✅ Начали диагностику: <b>{stats['started_diagnostics']}</b>\n"
+            f"📨 Первое напоминание отправлено: <b>{stats['first_reminders_sent']}</b>\n"
+            f"📨 Второе напоминание отправлено: <b>{stats['second_reminders_sent']}</b>\n"
+            f"⏰ Ожидают первого напоминания (прошла 10+ мин): <b>{stats['pending_first_reminder']}</b>\n\n"
+            f"<b>Пропускная способность</b> (за {stats['rate_window_seconds']} с):\n"
+            f"⚡ Событий сайта в минуту: <b>{rate(stats['events_per_min'])}</b>\n"
+            f"📬 Напоминаний в минуту: <b>{rate(stats['reminders_per_min'])}</b>\n"
+            f"🧮 Ждут пересчета сегмента: <b>{stats['segmentation_dirty']}</b> "
+            f"(отставание {lag_minutes} мин)\n"
+            f"🕒 Снимок обновлен {round(stats_snapshot.age())} с назад\n\n"
         )
         
+        recent_users = stats['recent_users']
         if recent_users:
             stats_text += "<b>Последние пользователи:</b>\n"
             for idx, u in enumerate(recent_users, 1):
@@ -311,6 +310,30 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             reply_markup=reply_markup
         )
 
+# Периодический пересчет навигации
+async def update_navigation_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Инкрементальный пересчет матрицы переходов и путей навигации по дням (в потоке, не блокирует бота)"""
+    await asyncio.to_thread(db.update_navigation_stats)
+
+async def refresh_recommendations(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Пересчет рекомендаций пользователей, данные которых изменились (в потоке, не блокирует бота)"""
+    await asyncio.to_thread(db.refresh_user_recommendations)
+
+async def refresh_stats_snapshot(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Фоновое обновление счетчиков /stats"""
+    await stats_snapshot.refresh_async()
+
+async def send_broadcasts(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправка активных кампаний рассылок клиентом бота через общий с напоминаниями лимитер"""
+    await send_active_campaigns(context.bot, db, notification_service.delivery)
+
+async def start_reminder_scheduler(application: Application) -> None:
+    """Запуск планировщика напоминаний в цикле событий приложения"""
+    application.create_task(reminder_scheduler.run())
+
+async def stop_reminder_scheduler(application: Application) -> None:
+    reminder_scheduler.stop()
+
 # Обработка ошибок
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок"""
@@ -318,7 +341,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 def main() -> None:
     """Запуск бота"""
-    global notification_service
+    global notification_service, reminder_scheduler
     
     # Получаем токен из переменных окружения
     token = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -326,24 +349,63 @@ def main() -> None:
     if not token:
         raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
     
+    if BOT_MODE not in ('polling', 'webhook'):
+        raise ValueError(f"Неизвестный BOT_MODE: {BOT_MODE} (ожидается polling или webhook)")
+    
     # Создаем приложение
-    application = Application.builder().token(token).build()
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(start_reminder_scheduler)
+        .post_shutdown(stop_reminder_scheduler)
+    )
+    if BOT_MODE == 'webhook':
+        # Обновления от Telegram приходят параллельно — обрабатываем их параллельно
+        builder = builder.concurrent_updates(int(os.getenv('BOT_CONCURRENT_UPDATES', '16')))
+    application = builder.build()
     
     # Инициализируем сервис уведомлений
     notification_service = NotificationService(application.bot, db, MINIAPP_URL)
+
+    # Напоминания отправляются по времени наступления (users.next_reminder_at), без поминутного опроса
+    reminder_scheduler = ReminderScheduler(db, notification_service.send_due_reminders)
     
     # Настраиваем планировщик задач через JobQueue
     job_queue = application.job_queue
     
-    # Проверяем напоминания каждую минуту
     if job_queue:
+        # Пересчитываем навигацию (переходы и пути) раз в час
+        job_queue.run_repeating(
+            update_navigation_stats,
+            interval=3600,
+            first=120,
+            name='update_navigation_stats'
+        )
+
+        # Обновляем предрасчитанные рекомендации (только пользователи с новыми данными)
         job_queue.run_repeating(
-            notification_service.check_and_send_reminders,
-            interval=60,  # 60 секунд = 1 минута
-            first=60,  # Первый запуск через 60 секунд
-            name='check_reminders'
+            refresh_recommendations,
+            interval=900,
+            first=180,
+            name='refresh_recommendations'
+        )
+
+        # Кампании рассылок (broadcast.py create) отправляются ботом; JobQueue не запускает
+        # следующий прогон, пока идет предыдущий
+        job_queue.run_repeating(
+            send_broadcasts,
+            interval=BROADCAST_POLL_INTERVAL,
+            first=60,
+            name='send_broadcasts'
+        )
+
+        # Счетчики /stats читаются из БД в фоне, команда отвечает из памяти
+        job_queue.run_repeating(
+            refresh_stats_snapshot,
+            interval=STATS_REFRESH_INTERVAL,
+            first=10,
+            name='refresh_stats_snapshot'
         )
-        logger.info("Планировщик задач запущен. Проверка напоминаний каждую минуту")
     else:
         logger.error("JobQueue не доступен!")
     
@@ -360,8 +422,24 @@ def main() -> None:
     application.add_error_handler(error_handler)
     
     # Запускаем бота
-    logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        webhook_url = os.getenv('WEBHOOK_URL')
+        secret_token = os.getenv('WEBHOOK_SECRET')
+        if not webhook_url or not secret_token:
+            raise ValueError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET!")
+        logger.info("Бот запущен в режиме webhook!")
+        asyncio.run(serve_webhook(
+            application,
+            webhook_url,
+            secret_token,
+            listen=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+            port=int(os.getenv('PORT', '8443')),
+            path=urlparse(webhook_url).path or '/',
+            allowed_updates=Update.ALL_TYPES,
+        ))
+    else:
+        logger.info("Бот запущен!")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
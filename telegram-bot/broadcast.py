@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Рассылки по сегментам через очередь отправки (broadcast_outbox)
+
+Кампания хранит текст и критерии сегмента; enqueue_broadcast идемпотентно ставит в очередь
+пользователей из user_segments. BroadcastSender захватывает порции pending -> sending,
+отправляет их через DeliveryEngine (общий лимит ~25 сообщений/с, 1 сообщение/с в чат,
+повтор после 429 и сетевых ошибок, постоянные ошибки не повторяются) и записывает
+результат (доставленные — каждую секунду). Следующая порция захватывается, пока отправляется
+текущая, поэтому отправка идет без пауз между порциями. Прогон можно прервать и запустить
+снова: отправленные не повторяются, а зависшие в sending дольше LEASE_SECONDS возвращаются
+в очередь (сообщения, которые были в полете в момент падения, могут уйти повторно).
+
+Лимит DeliveryEngine действует в пределах процесса, поэтому кампании отправляет сам бот:
+задача send_active_campaigns (bot.py) отправляет активные кампании клиентом бота через
+NotificationService.delivery — общий лимитер с напоминаниями. CLI только создает кампании
+и ставит получателей в очередь. Команда send нужна, когда бот остановлен: она работает
+отдельным клиентом с пониженным общим лимитом CLI_GLOBAL_RATE, а одновременно должен
+работать только один отправитель.
+
+Пример:
+    python broadcast.py create --name engaged-oct --segment engaged --diagnostics-completed no --text "..."
+    python broadcast.py status --campaign 1
+    python broadcast.py send --campaign 1   # только при остановленном боте
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from db import Database
+from delivery import DeliveryEngine, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Сколько получателей захватывать за раз
+BROADCAST_BATCH_SIZE = 500
+# Сколько прогонов порций пробовать доставить сообщение при временных ошибках
+BROADCAST_MAX_ATTEMPTS = 3
+# Через сколько секунд захват без результата считается брошенным
+LEASE_SECONDS = 300
+# Как часто записывать доставленных во время отправки порции
+FLUSH_INTERVAL = 1.0
+# Общий лимит отправки из CLI (сообщений/с): запас на случай, если бот все же работает
+CLI_GLOBAL_RATE = 10
+
+
+class BroadcastSender:
+    """Возобновляемая отправка кампании из broadcast_outbox"""
+
+    def __init__(self, bot, db: Database, delivery: DeliveryEngine = None,
+                 batch_size: int = BROADCAST_BATCH_SIZE, max_attempts: int = BROADCAST_MAX_ATTEMPTS,
+                 lease_seconds: int = LEASE_SECONDS):
+        self.bot = bot
+        self.db = db
+        self.delivery = delivery or DeliveryEngine()
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+
+    def _sender(self, chat_id: int, text: str):
+        async def send():
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        return send
+
+    async def _claim(self, campaign_id: int) -> List[int]:
+        return await asyncio.to_thread(self.db.claim_broadcast_batch, campaign_id, self.batch_size)
+
+    async def _deliver_batch(self, campaign_id: int, batch: List[int], text: str) -> Dict[str, Any]:
+        """Отправить порцию, записывая доставленных каждые FLUSH_INTERVAL секунд.
+
+        Если прогон прерван (отмена, падение цикла), уже доставленные записываются в finally —
+        повторно при возобновлении уйдут только сообщения, которые были в полете.
+        """
+        delivered: List[int] = []
+
+        def on_result(chat_id, error, permanent):
+            if error is None:
+                delivered.append(chat_id)
+
+        async def flush():
+            if delivered:
+                ids = delivered[:]
+                del delivered[:]
+                await asyncio.to_thread(self.db.finish_broadcast_batch, campaign_id, ids)
+
+        task = asyncio.ensure_future(self.delivery.run(
+            [(user_id, self._sender(user_id, text)) for user_id in batch], on_result=on_result))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=FLUSH_INTERVAL)
+                await flush()
+            report = task.result()
+            await asyncio.to_thread(
+                self.db.finish_broadcast_batch, campaign_id, [], report['failed'],
+                report['permanent_failures'], self.max_attempts)
+            return report
+        finally:
+            if not task.done():
+                task.cancel()
+            if delivered:
+                self.db.finish_broadcast_batch(campaign_id, delivered)
+
+    async def run(self, campaign_id: int) -> Dict[str, Any]:
+        """Отправить все pending получателям кампании; возвращает итоги прогона и прогресс"""
+        campaign = self.db.get_broadcast_campaign(campaign_id)
+        if campaign is None:
+            raise ValueError(f"Кампания рассылки {campaign_id} не найдена")
+        self.db.requeue_stale_broadcast(campaign_id, self.lease_seconds)
+
+        totals = {'delivered': 0, 'failed': 0, 'permanent_failures': 0, 'retries': 0, 'rate_limited': 0}
+        started = time.monotonic()
+        batch = await self._claim(campaign_id)
+        while batch:
+            # Следующая порция захватывается в потоке, пока текущая отправляется
+            next_batch = asyncio.ensure_future(self._claim(campaign_id))
+            try:
+                report = await self._deliver_batch(campaign_id, batch, campaign['message_text'])
+            except BaseException:
+                next_batch.cancel()
+                raise
+
+            totals['delivered'] += len(report['delivered'])
+            totals['failed'] += len(report['failed'])
+            totals['permanent_failures'] += len(report['permanent_failures'])
+            totals['retries'] += report['retries']
+            totals['rate_limited'] += report['rate_limited']
+            progress = self.db.get_broadcast_progress(campaign_id)
+            logger.info(f"Рассылка {campaign_id}: отправлено {progress['sent']}/{progress['total']}, "
+                        f"в очереди {progress['pending']}, ошибок {progress['failed']}")
+
+            batch = await next_batch
+            if not batch:
+                # Временные ошибки последней порции вернулись в pending уже после захвата
+                batch = await self._claim(campaign_id)
+
+        elapsed = time.monotonic() - started
+        totals['elapsed_seconds'] = round(elapsed, 3)
+        totals['throughput'] = round(totals['delivered'] / elapsed, 2) if elapsed > 0 else 0.0
+        totals['progress'] = self.db.get_broadcast_progress(campaign_id)
+        totals['completed'] = self.db.complete_broadcast_campaign(campaign_id)
+        logger.info(f"Рассылка {campaign_id} ({campaign['name']}): {totals}")
+        return totals
+
+
+def _criteria_from_args(args) -> Dict[str, Any]:
+    criteria: Dict[str, Any] = {}
+    if args.segment:
+        criteria['segment'] = args.segment
+    if args.engagement_level:
+        criteria['engagement_level'] = args.engagement_level
+    if args.conversion_potential:
+        criteria['conversion_potential'] = args.conversion_potential
+    if args.diagnostics_completed:
+        criteria['diagnostics_completed'] = args.diagnostics_completed == 'yes'
+    return criteria
+
+
+async def send_active_campaigns(bot, db: Database, delivery: DeliveryEngine) -> Dict[int, Dict[str, Any]]:
+    """Отправить все активные кампании клиентом и лимитером бота; возвращает итоги по кампаниям"""
+    results = {}
+    for campaign_id in await asyncio.to_thread(db.get_active_broadcast_campaigns):
+        results[campaign_id] = await BroadcastSender(bot, db, delivery=delivery).run(campaign_id)
+    return results
+
+
+async def send_campaign(db: Database, token: str, campaign_id: int) -> Dict[str, Any]:
+    """Отправить кампанию отдельным процессом (собственный клиент Bot API), когда бот остановлен.
+
+    Лимит отправки не согласуется с ботом, поэтому общий лимит снижен до CLI_GLOBAL_RATE.
+    """
+    from telegram import Bot
+
+    async with Bot(token) as bot:
+        delivery = DeliveryEngine(RateLimiter(global_rate=CLI_GLOBAL_RATE))
+        return await BroadcastSender(bot, db, delivery=delivery).run(campaign_id)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Рассылки по сегментам пользователей')
+    parser.add_argument('--db', default='bot_users.db', help='путь к sqlite или DATABASE_URL')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help='создать кампанию и поставить сегмент в очередь')
+    create.add_argument('--name', required=True, help='уникальное имя кампании')
+    create.add_argument('--text', required=True, help='текст сообщения')
+    create.add_argument('--segment', help='newcomer, engaged, loyal, converter')
+    create.add_argument('--engagement-level')
+    create.add_argument('--conversion-potential')
+    create.add_argument('--diagnostics-completed', choices=('yes', 'no'))
+
+    for name, help_text in (('enqueue', 'добрать в очередь новых пользователей сегмента'),
+                            ('send', 'отправить кампанию из CLI, когда бот остановлен (обычно кампании отправляет бот)'),
+                            ('status', 'прогресс кампании')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--campaign', type=int, required=True)
+
+    args = parser.parse_args()
+    database = Database(args.db)
+    campaign_id = getattr(args, 'campaign', None)
+
+    if args.command == 'create':
+        campaign_id = database.create_broadcast_campaign(args.name, args.text, _criteria_from_args(args))
+        print(f"Кампания {campaign_id}: в очередь добавлено {database.enqueue_broadcast(campaign_id)}, "
+              f"бот отправит ее в течение минуты")
+    elif args.command == 'enqueue':
+        print(f"В очередь добавлено {database.enqueue_broadcast(campaign_id)}")
+    elif args.command == 'send':
+        bot_token: Optional[str] = os.getenv('TELEGRAM_BOT_TOKEN')
+        if not bot_token:
+            raise ValueError("TELEGRAM_BOT_TOKEN не найден в переменных окружения!")
+        print(f"Итоги: {asyncio.run(send_campaign(database, bot_token, campaign_id))}")
+    print(f"Прогресс: {database.get_broadcast_progress(campaign_id)}")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+In-process кеш сопоставления cookie_id -> tg_user_id для эндпоинтов by-cookie
+Хранит и отрицательные результаты (cookie без привязки) с более коротким TTL.
+Кеш не разделяется между процессами: invalidate() действует только в текущем,
+поэтому отрицательный TTL держим коротким — привязка, сделанная ботом, становится
+видна backend не позже чем через negative_ttl секунд.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 300
+DEFAULT_NEGATIVE_TTL_SECONDS = 5
+DEFAULT_MAX_ENTRIES = 100_000
+
+# Маркер промаха: None в кеше означает «cookie не привязан», а не «нет записи»
+MISS = object()
+
+
+class CookieUserCache:
+    """Потокобезопасный LRU кеш с TTL: cookie_id -> (tg_user_id | None, expires_at)"""
+
+    def __init__(self, ttl: float = DEFAULT_TTL_SECONDS, negative_ttl: float = DEFAULT_NEGATIVE_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, clock=time.monotonic):
+        if max_entries <= 0:
+            raise ValueError("max_entries должен быть положительным")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+
+        self._entries: 'OrderedDict[str, Tuple[Optional[int], float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, cookie_id: str) -> Any:
+        """tg_user_id, None (известно, что привязки нет) или MISS"""
+        with self._lock:
+            entry = self._entries.get(cookie_id)
+            if entry is None:
+                self.misses += 1
+                return MISS
+            if entry[1] <= self._clock():
+                del self._entries[cookie_id]
+                self.misses += 1
+                return MISS
+            self._entries.move_to_end(cookie_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, cookie_id: str, tg_user_id: Optional[int]) -> None:
+        ttl = self.ttl if tg_user_id is not None else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[cookie_id] = (tg_user_id, self._clock() + ttl)
+            self._entries.move_to_end(cookie_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, cookie_id: str) -> None:
+        with self._lock:
+            self._entries.pop(cookie_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
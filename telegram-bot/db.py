@@ -2,9 +2,17 @@ import logging
 import json
 import uuid
 import os
-from datetime import datetime
+import struct
+from pathlib import Path
+from datetime import datetime, timedelta
 from typing import Optional, Tuple, Dict, List, Any
 
+from hyperloglog import HyperLogLog
+from cookie_cache import CookieUserCache, MISS
+from funnel import FunnelEngine, FunnelStep, DEFAULT_WINDOW_SECONDS
+from recommendation_rules import ACTION_RULESET
+from navigation import NavigationAccumulator, PATH_KIND_ALL, PATH_KIND_TO_CTA, PATH_SEPARATOR, event_node
+
 logger = logging.getLogger(__name__)
 
 # Try to import SQLAlchemy for Postgres support; fall back to sqlite3
@@ -26,6 +34,99 @@ except Exception:
     dict_row = None
 
 
+# Измерения, по которым ведутся скетчи уникальных посетителей
+VISITOR_DIMENSIONS = ('all', 'source', 'utm_campaign')
+
+# Поля атрибуции сессии, которые денормализуются из визита в колонки site_sessions
+SESSION_ATTRIBUTION_FIELDS = ('source', 'utm_source', 'utm_medium', 'utm_campaign',
+                              'utm_term', 'utm_content', 'referrer')
+
+# Разделы персонального пути в отчете и сколько последних записей в каждом показывать
+JOURNEY_LIMITS = {
+    'miniapp_opens': 20,
+    'content_views': 50,
+    'ai_interactions': 30,
+    'diagnostics': 10,
+    'game_actions': 20,
+    'cta_clicks': 20,
+}
+
+# Формат времени записей персонального пути (как CURRENT_TIMESTAMP в sqlite)
+JOURNEY_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _journey_category(event_type: str, event_name: str) -> Optional[str]:
+    """Раздел персонального пути для события (None — событие в путь не попадает)"""
+    if event_type == 'content_view' or event_name == 'content_view':
+        return 'content_views'
+    if event_type == 'ai_interaction' or event_name == 'ai_interaction':
+        return 'ai_interactions'
+    if event_type == 'diagnostic':
+        return 'diagnostics'
+    if event_type in ('game', 'game_action'):
+        return 'game_actions'
+    if event_type in ('cta', 'cta_click'):
+        return 'cta_clicks'
+    return None
+
+
+# Гистограмма активности по часам: 24 счетчика uint32 (96 байт)
+HOUR_HISTOGRAM_FORMAT = '<24I'
+
+
+def _pack_hour_histogram(hours: List[int]) -> bytes:
+    return struct.pack(HOUR_HISTOGRAM_FORMAT, *hours)
+
+
+def _unpack_hour_histogram(data) -> List[int]:
+    if not data:
+        return [0] * 24
+    return list(struct.unpack(HOUR_HISTOGRAM_FORMAT, bytes(data)))
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    """Привести TIMESTAMP из sqlite (строка) или Postgres (datetime) к datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _activity_patterns(profile: Optional[dict]) -> List[str]:
+    """Паттерны времени активности и частоты визитов по профилю активности"""
+    patterns = []
+    if not profile:
+        return patterns
+
+    hours = profile['hour_histogram']
+    if any(hours):
+        hour = max(range(24), key=lambda h: hours[h])
+        if 6 <= hour <= 12:
+            patterns.append("active_morning")
+        elif 12 <= hour <= 18:
+            patterns.append("active_afternoon")
+        elif 18 <= hour <= 22:
+            patterns.append("active_evening")
+        else:
+            patterns.append("active_night")
+
+    first_session = _parse_timestamp(profile.get('first_session_at'))
+    if first_session and profile.get('sessions_count'):
+        days = (datetime.utcnow() - first_session).total_seconds() / 86400.0
+        if days > 0:
+            session_frequency = profile['sessions_count'] / days
+            if session_frequency >= 1:
+                patterns.append("frequent_visitor")
+            elif session_frequency >= 0.3:
+                patterns.append("regular_visitor")
+            else:
+                patterns.append("occasional_visitor")
+
+    return patterns
+
+
 class _PGCursorAdapter:
     """Адаптер курсора Postgres, обеспечивающий sqlite3-подобный интерфейс"""
     def __init__(self, cur, conn):
@@ -127,12 +228,19 @@ class _PGConnectionAdapter:
 
 
 class Database:
-    def __init__(self, db_path_or_url: str = "bot_users.db"):
+    def __init__(self, db_path_or_url: str = "bot_users.db", read_only: bool = False):
         """
         db_path_or_url: if contains 'postgres' or starts with 'postgresql://' -> treated as DATABASE_URL
                         otherwise treated as path to sqlite file
+        read_only: для sqlite — соединения только на чтение и без миграций (воркеры пакетных расчетов)
         """
         self.db_spec = db_path_or_url
+        self.read_only = read_only
+        # Кеш cookie_id -> tg_user_id для эндпоинтов by-cookie (в пределах процесса)
+        self.cookie_cache = CookieUserCache(
+            ttl=float(os.getenv('COOKIE_CACHE_TTL', '300')),
+            negative_ttl=float(os.getenv('COOKIE_CACHE_NEGATIVE_TTL', '5')),
+        )
 
         # Если указан URL к Postgres — используем Postgres через SQLAlchemy.
         # Важно: если DATABASE_URL задан, не делаем никаких попыток открыть локальный sqlite.
@@ -166,6 +274,8 @@ class Database:
         else:
             # fallback на sqlite
             self.db_path = db_path_or_url
+            if read_only:
+                return
             # Импортируем и запускаем миграции при инициализации
             try:
                 from migrations import run_database_migrations
@@ -194,7 +304,10 @@ class Database:
 
             return _PGConnectionAdapter(raw_conn)
         else:
-            conn = sqlite3.connect(self.db_path)
+            if self.read_only:
+                conn = sqlite3.connect(f"{Path(self.db_path).absolute().as_uri()}?mode=ro", uri=True)
+            else:
+                conn = sqlite3.connect(self.db_path)
             conn.row_factory = sqlite3.Row
             return conn
     
@@ -208,6 +321,8 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
 
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'")
+        created = cursor.fetchone() is None
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -219,6 +334,8 @@ class Database:
                 second_reminder_sent BOOLEAN DEFAULT 0,
                 started_at TIMESTAMP,
                 diagnostics_started_at TIMESTAMP,
+                diagnostics_completed_at TIMESTAMP,
+                next_reminder_at TIMESTAMP,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
@@ -226,6 +343,15 @@ class Database:
 
         conn.commit()
         conn.close()
+
+        if created and not self.read_only:
+            # Миграции из конструктора на пустой БД не нашли users (индексы напоминаний и т.п.) —
+            # применяем их еще раз, чтобы схема была полной без повторного запуска
+            try:
+                from migrations import run_database_migrations
+                run_database_migrations(self.db_path)
+            except ImportError:
+                logger.warning("Модуль migrations не найден. Убедитесь что migrations.py существует.")
         logger.info("База данных инициализирована")
     
     def create_or_update_user(self, user_id: int, username: str = None, 
@@ -241,15 +367,22 @@ class Database:
                         if not res['has_started_diagnostics']:
                             conn.execute(text('''
                                 UPDATE users SET username = :username, first_name = :first_name, last_name = :last_name,
-                                    started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid
+                                    started_at = CURRENT_TIMESTAMP,
+                                    next_reminder_at = CASE
+                                        WHEN NOT first_reminder_sent THEN CURRENT_TIMESTAMP + INTERVAL '10 minutes'
+                                        WHEN NOT second_reminder_sent THEN CURRENT_TIMESTAMP + INTERVAL '24 hours'
+                                    END,
+                                    updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid
                             '''), {'username': username, 'first_name': first_name, 'last_name': last_name, 'uid': user_id})
                             logger.info(f"Пользователь {user_id} обновлен. started_at установлен на CURRENT_TIMESTAMP")
                         else:
                             logger.info(f"Пользователь {user_id} уже начал диагностику, started_at не обновляется")
                     else:
                         conn.execute(text('''
-                            INSERT INTO users (user_id, username, first_name, last_name, has_started_diagnostics, started_at)
-                            VALUES (:uid, :username, :first_name, :last_name, 0, CURRENT_TIMESTAMP)
+                            INSERT INTO users (user_id, username, first_name, last_name, has_started_diagnostics, started_at,
+                                               next_reminder_at)
+                            VALUES (:uid, :username, :first_name, :last_name, false, CURRENT_TIMESTAMP,
+                                    CURRENT_TIMESTAMP + INTERVAL '10 minutes')
                         '''), {'uid': user_id, 'username': username, 'first_name': first_name, 'last_name': last_name})
                         logger.info(f"Новый пользователь {user_id} создан. started_at установлен на CURRENT_TIMESTAMP")
                 return
@@ -271,6 +404,10 @@ class Database:
                     UPDATE users 
                     SET username = ?, first_name = ?, last_name = ?,
                         started_at = CURRENT_TIMESTAMP,
+                        next_reminder_at = CASE
+                            WHEN first_reminder_sent = 0 THEN datetime('now', '+10 minutes')
+                            WHEN second_reminder_sent = 0 THEN datetime('now', '+24 hours')
+                        END,
                         updated_at = CURRENT_TIMESTAMP
                     WHERE user_id = ?
                 ''', (username, first_name, last_name, user_id))
@@ -281,8 +418,8 @@ class Database:
             # Создаем нового пользователя
             cursor.execute('''
                 INSERT INTO users (user_id, username, first_name, last_name, 
-                                 has_started_diagnostics, started_at)
-                VALUES (?, ?, ?, ?, 0, CURRENT_TIMESTAMP)
+                                 has_started_diagnostics, started_at, next_reminder_at)
+                VALUES (?, ?, ?, ?, 0, CURRENT_TIMESTAMP, datetime('now', '+10 minutes'))
             ''', (user_id, username, first_name, last_name))
             logger.info(f"Новый пользователь {user_id} создан. started_at установлен на CURRENT_TIMESTAMP")
 
@@ -297,7 +434,7 @@ class Database:
                 with self.engine.begin() as conn:
                     conn.execute(text('''
                         UPDATE users SET has_started_diagnostics = true, diagnostics_started_at = CURRENT_TIMESTAMP,
-                            updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid
+                            next_reminder_at = NULL, updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid
                     '''), {'uid': user_id})
                 return
             except Exception as e:
@@ -310,6 +447,7 @@ class Database:
             UPDATE users
             SET has_started_diagnostics = 1,
                 diagnostics_started_at = CURRENT_TIMESTAMP,
+                next_reminder_at = NULL,
                 updated_at = CURRENT_TIMESTAMP
             WHERE user_id = ?
         ''', (user_id,))
@@ -345,73 +483,46 @@ class Database:
         conn.close()
         logger.info(f"Пользователь {user_id} начал диагностику")
     
-    def get_users_for_reminder(self, reminder_type: str) -> list:
-        """Получить пользователей для отправки напоминания"""
-        if self.use_postgres:
-            try:
-                with self.engine.connect() as conn:
-                    if reminder_type == 'first':
-                        # 10 minutes
-                        rows = conn.execute(text('''
-                            SELECT user_id, username, first_name FROM users
-                            WHERE has_started_diagnostics = false AND first_reminder_sent = false
-                            AND started_at IS NOT NULL AND started_at + INTERVAL '10 minutes' <= now()
-                        ''')).fetchall()
-                    else:
-                        rows = conn.execute(text('''
-                            SELECT user_id, username, first_name FROM users
-                            WHERE has_started_diagnostics = false AND second_reminder_sent = false
-                            AND started_at IS NOT NULL AND started_at + INTERVAL '24 hours' <= now()
-                        ''')).fetchall()
-
-                    users = [dict(r) for r in rows]
-                    logger.info(f"Найдено пользователей для напоминания '{reminder_type}': {len(users)}")
-                    return users
-            except Exception as e:
-                logger.error(f"Ошибка get_users_for_reminder (Postgres): {e}")
+    # Задержки напоминаний относительно started_at
+    REMINDER_DELAYS = {'first': '10 minutes', 'second': '24 hours'}
 
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def _reminder_candidates_sql(self, reminder_type: str, columns: str) -> str:
+        """Запрос кандидатов на напоминание.
 
-        if reminder_type == "first":
-            # Первое напоминание через 10 минут
-            cursor.execute('''
-                SELECT user_id, username, first_name 
-                FROM users 
-                WHERE has_started_diagnostics = 0 
-                AND first_reminder_sent = 0
-                AND started_at IS NOT NULL
-                AND datetime(started_at, '+10 minutes') <= datetime('now')
-            ''')
-            logger.info(f"Запрос первого напоминания выполнен. Текущее время: {datetime.now()}")
-        elif reminder_type == "second":
-            # Второе напоминание через 24 часа
-            cursor.execute('''
-                SELECT user_id, username, first_name 
-                FROM users 
-                WHERE has_started_diagnostics = 0 
-                AND second_reminder_sent = 0
-                AND started_at IS NOT NULL
-                AND datetime(started_at, '+24 hours') <= datetime('now')
-            ''')
+        started_at сравнивается с готовой границей (сейчас минус задержка), а не оборачивается
+        в функцию, поэтому работают частичные индексы idx_users_*_reminder_pending.
+        """
+        if reminder_type not in self.REMINDER_DELAYS:
+            raise ValueError(f"Неизвестный тип напоминания: {reminder_type}")
+        delay = self.REMINDER_DELAYS[reminder_type]
+        if self.use_postgres:
+            false, cutoff = 'false', f"LOCALTIMESTAMP - INTERVAL '{delay}'"
+        else:
+            false, cutoff = '0', f"datetime('now', '-{delay}')"
+        return f'''
+            SELECT {columns}
+            FROM users
+            WHERE has_started_diagnostics = {false}
+            AND {reminder_type}_reminder_sent = {false}
+            AND started_at <= {cutoff}
+        '''
 
-        users = cursor.fetchall()
-        logger.info(f"Найдено пользователей для напоминания '{reminder_type}': {len(users)}")
-        if users:
-            for user in users:
-                logger.info(f"  - Пользователь {user['user_id']} ({user['username'] or user['first_name']})")
-        conn.close()
-        return users
-    
     def mark_reminder_sent(self, user_id: int, reminder_type: str) -> None:
         """Отметить, что напоминание отправлено"""
         if self.use_postgres:
             try:
                 with self.engine.begin() as conn:
                     if reminder_type == 'first':
-                        conn.execute(text('UPDATE users SET first_reminder_sent = true, updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid'), {'uid': user_id})
+                        conn.execute(text('''
+                            UPDATE users SET first_reminder_sent = true,
+                                next_reminder_at = CASE WHEN NOT second_reminder_sent THEN started_at + INTERVAL '24 hours' END,
+                                updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid
+                        '''), {'uid': user_id})
                     else:
-                        conn.execute(text('UPDATE users SET second_reminder_sent = true, updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid'), {'uid': user_id})
+                        conn.execute(text('''
+                            UPDATE users SET second_reminder_sent = true, next_reminder_at = NULL,
+                                updated_at = CURRENT_TIMESTAMP WHERE user_id = :uid
+                        '''), {'uid': user_id})
                 logger.info(f"Напоминание {reminder_type} отправлено пользователю {user_id} (Postgres)")
                 return
             except Exception as e:
@@ -424,6 +535,7 @@ class Database:
             cursor.execute('''
                 UPDATE users 
                 SET first_reminder_sent = 1,
+                    next_reminder_at = CASE WHEN second_reminder_sent = 0 THEN datetime(started_at, '+24 hours') END,
                     updated_at = CURRENT_TIMESTAMP
                 WHERE user_id = ?
             ''', (user_id,))
@@ -431,6 +543,7 @@ class Database:
             cursor.execute('''
                 UPDATE users 
                 SET second_reminder_sent = 1,
+                    next_reminder_at = NULL,
                     updated_at = CURRENT_TIMESTAMP
                 WHERE user_id = ?
             ''', (user_id,))
@@ -439,6 +552,185 @@ class Database:
         conn.close()
         logger.info(f"Напоминание {reminder_type} отправлено пользователю {user_id}")
     
+    def get_reminder_schedule(self, user_ids: Optional[List[int]] = None,
+                              within_seconds: Optional[int] = None) -> Tuple[datetime, Dict[int, datetime]]:
+        """Время БД и запланированные напоминания {user_id: next_reminder_at}.
+
+        user_ids — только указанные пользователи; within_seconds — только напоминания,
+        наступающие не позже чем через столько секунд (включая просроченные).
+        Время БД возвращается, чтобы задержки считались в той же шкале, что и next_reminder_at.
+        """
+        if self.use_postgres:
+            now_sql, horizon_sql = 'LOCALTIMESTAMP', "LOCALTIMESTAMP + :within * INTERVAL '1 second'"
+        else:
+            now_sql, horizon_sql = 'CURRENT_TIMESTAMP', "datetime('now', '+' || :within || ' seconds')"
+
+        conditions = ['next_reminder_at IS NOT NULL']
+        params: Dict[str, Any] = {}
+        if within_seconds is not None:
+            conditions.append(f'next_reminder_at <= {horizon_sql}')
+            params['within'] = int(within_seconds)
+        if user_ids is not None:
+            keys = {f'id{i}': uid for i, uid in enumerate(user_ids)} or {'id0': None}
+            conditions.append(f"user_id IN ({', '.join(':' + key for key in keys)})")
+            params.update(keys)
+        sql = f"SELECT user_id, next_reminder_at FROM users WHERE {' AND '.join(conditions)}"
+
+        def parse(value):
+            return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+        if self.use_postgres:
+            with self.engine.connect() as conn:
+                run = self._pg_runner(conn)
+                now = run(f'SELECT {now_sql}', {})[0][0]
+                rows = run(sql, params)
+        else:
+            conn = self.get_connection()
+            try:
+                run = self._sqlite_runner(conn.cursor())
+                now = run(f'SELECT {now_sql}', {})[0][0]
+                rows = run(sql, params)
+            finally:
+                conn.close()
+        return parse(now), {row[0]: parse(row[1]) for row in rows}
+
+    def get_due_reminders(self, limit: int = 500) -> List[dict]:
+        """Пользователи, у которых наступило время напоминания (диапазон по индексу next_reminder_at)"""
+        now_sql = 'LOCALTIMESTAMP' if self.use_postgres else 'CURRENT_TIMESTAMP'
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'''
+                SELECT user_id, username, first_name, first_reminder_sent, second_reminder_sent
+                FROM users
+                WHERE next_reminder_at IS NOT NULL AND next_reminder_at <= {now_sql}
+                ORDER BY next_reminder_at
+                LIMIT ?
+            ''', (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def claim_reminders(self, user_ids: List[int], reminder_type: str) -> List[dict]:
+        """Атомарно отметить напоминание отправленным до отправки и вернуть захваченных пользователей.
+
+        Одним UPDATE ... RETURNING на порцию: пользователь, которому напоминание уже отмечено
+        (другим процессом или прошлым проходом) или который начал диагностику, не захватывается,
+        поэтому одно напоминание не уходит дважды.
+        """
+        if reminder_type not in ('first', 'second'):
+            raise ValueError(f"Неизвестный тип напоминания: {reminder_type}")
+        if self.use_postgres:
+            false, later = 'false', "started_at + INTERVAL '24 hours'"
+        else:
+            false, later = '0', "datetime(started_at, '+24 hours')"
+        if reminder_type == 'first':
+            # После первого напоминания планируется второе (если еще не отправлено)
+            next_sql = f"CASE WHEN second_reminder_sent = {false} THEN {later} END"
+        else:
+            next_sql = 'NULL'
+        flag = f'{reminder_type}_reminder_sent'
+
+        claimed = []
+
+        def claim(run):
+            for offset in range(0, len(user_ids), 500):
+                keys = {f'id{i}': uid for i, uid in enumerate(user_ids[offset:offset + 500])}
+                rows = run(f'''
+                    UPDATE users
+                    SET {flag} = {'true' if self.use_postgres else '1'},
+                        next_reminder_at = {next_sql},
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id IN ({', '.join(':' + key for key in keys)})
+                      AND {flag} = {false} AND has_started_diagnostics = {false}
+                    RETURNING user_id, username, first_name
+                ''', keys)
+                claimed.extend({'user_id': row[0], 'username': row[1], 'first_name': row[2]} for row in rows)
+
+        try:
+            if self.use_postgres:
+                with self.engine.begin() as conn:
+                    claim(self._pg_runner(conn))
+            else:
+                conn = self.get_connection()
+                try:
+                    claim(self._sqlite_runner(conn.cursor()))
+                    conn.commit()
+                finally:
+                    conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при захвате напоминаний '{reminder_type}': {e}")
+            return []
+        return claimed
+
+    def release_reminder_claims(self, user_ids: List[int], reminder_type: str, retry_seconds: int = 60) -> int:
+        """Вернуть захват напоминаний, которые не удалось доставить, с повтором через retry_seconds"""
+        if reminder_type not in ('first', 'second') or not user_ids:
+            return 0
+        if self.use_postgres:
+            false, retry_sql = 'false', "LOCALTIMESTAMP + :retry * INTERVAL '1 second'"
+        else:
+            false, retry_sql = '0', "datetime('now', '+' || :retry || ' seconds')"
+        flag = f'{reminder_type}_reminder_sent'
+
+        released = 0
+
+        def release(run):
+            nonlocal released
+            for offset in range(0, len(user_ids), 500):
+                keys = {f'id{i}': uid for i, uid in enumerate(user_ids[offset:offset + 500])}
+                rows = run(f'''
+                    UPDATE users
+                    SET {flag} = {false}, next_reminder_at = {retry_sql}, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id IN ({', '.join(':' + key for key in keys)}) AND has_started_diagnostics = {false}
+                    RETURNING user_id
+                ''', dict(keys, retry=int(retry_seconds)))
+                released += len(rows)
+
+        try:
+            if self.use_postgres:
+                with self.engine.begin() as conn:
+                    release(self._pg_runner(conn))
+            else:
+                conn = self.get_connection()
+                try:
+                    release(self._sqlite_runner(conn.cursor()))
+                    conn.commit()
+                finally:
+                    conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при возврате захвата напоминаний '{reminder_type}': {e}")
+        return released
+
+    def drop_undeliverable_reminders(self, user_ids: List[int]) -> int:
+        """Снять оставшиеся напоминания пользователям, которым отправка невозможна.
+
+        Захват первого напоминания сразу планирует второе; после постоянной ошибки
+        (бот заблокирован, чат не найден) второе тоже не будет доставлено, поэтому оно
+        отмечается выполненным, а next_reminder_at очищается.
+        """
+        if not user_ids:
+            return 0
+        true = 'true' if self.use_postgres else '1'
+
+        def drop(run):
+            dropped = 0
+            for offset in range(0, len(user_ids), 500):
+                keys = {f'id{i}': uid for i, uid in enumerate(user_ids[offset:offset + 500])}
+                dropped += len(run(f'''
+                    UPDATE users
+                    SET second_reminder_sent = {true}, next_reminder_at = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id IN ({', '.join(':' + key for key in keys)})
+                    RETURNING user_id
+                ''', keys))
+            return dropped
+
+        try:
+            return self._in_transaction(drop)
+        except Exception as e:
+            logger.error(f"Ошибка при снятии недоставляемых напоминаний: {e}")
+            return 0
+
     def get_user_status(self, user_id: int) -> Optional[dict]:
         """Получить статус пользователя"""
         conn = self.get_connection()
@@ -465,6 +757,7 @@ class Database:
                         VALUES (:tg, :cookie, :source, CURRENT_TIMESTAMP)
                         ON CONFLICT (tg_user_id, cookie_id) DO UPDATE SET linked_at = CURRENT_TIMESTAMP
                     '''), {'tg': tg_user_id, 'cookie': cookie_id, 'source': source})
+                self.cookie_cache.invalidate(cookie_id)
                 logger.info(f"Связан tg_user_id {tg_user_id} с cookie_id {cookie_id} (Postgres)")
                 return True
             except Exception as e:
@@ -481,6 +774,7 @@ class Database:
             ''', (tg_user_id, cookie_id, source))
 
             conn.commit()
+            self.cookie_cache.invalidate(cookie_id)
             logger.info(f"Связан tg_user_id {tg_user_id} с cookie_id {cookie_id}")
             return True
         except Exception as e:
@@ -492,6 +786,10 @@ class Database:
 
     def get_user_by_cookie(self, cookie_id: str) -> Optional[dict]:
         """Найти пользователя по cookie_id"""
+        # Закешированный отрицательный результат — без JOIN; в остальных случаях один запрос
+        if self.cookie_cache.get(cookie_id) is None:
+            return None
+
         conn = self.get_connection()
         cursor = conn.cursor()
 
@@ -509,6 +807,58 @@ class Database:
 
         return dict(result) if result else None
 
+    def resolve_cookie_user(self, cookie_id: str) -> Optional[int]:
+        """tg_user_id для cookie_id: последняя сессия с привязкой, иначе user_identities.
+
+        Результат (и отсутствие привязки) кешируется в cookie_cache; при попадании
+        запрос к БД не выполняется. Кеш у каждого процесса свой: link_telegram_to_cookie
+        сбрасывает запись только в процессе, который выполнил привязку, поэтому в другом
+        процессе (бот / backend) устаревший результат живет до истечения TTL — для
+        отрицательных записей он короткий (COOKIE_CACHE_NEGATIVE_TTL).
+        """
+        cached = self.cookie_cache.get(cookie_id)
+        if cached is not MISS:
+            return cached
+
+        # Индекс idx_site_sessions_cookie_start (cookie_id, session_start DESC)
+        session_sql = '''
+            SELECT tg_user_id FROM site_sessions
+            WHERE cookie_id = :cookie AND tg_user_id IS NOT NULL
+            ORDER BY session_start DESC
+            LIMIT 1
+        '''
+        identity_sql = '''
+            SELECT tg_user_id FROM user_identities
+            WHERE cookie_id = :cookie
+            ORDER BY linked_at DESC
+            LIMIT 1
+        '''
+        params = {'cookie': cookie_id}
+        try:
+            if self.use_postgres:
+                with self.engine.connect() as conn:
+                    row = conn.execute(text(session_sql), params).fetchone()
+                    if not row:
+                        row = conn.execute(text(identity_sql), params).fetchone()
+            else:
+                conn = self.get_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute(session_sql, params)
+                    row = cursor.fetchone()
+                    if not row:
+                        cursor.execute(identity_sql, params)
+                        row = cursor.fetchone()
+                finally:
+                    conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при поиске пользователя по cookie_id {cookie_id}: {e}")
+            return None
+
+        tg_user_id = int(row[0]) if row else None
+        self.cookie_cache.put(cookie_id, tg_user_id)
+        return tg_user_id
+
     def get_user_by_telegram(self, tg_user_id: int) -> Optional[dict]:
         """Найти пользователя по telegram user_id"""
         conn = self.get_connection()
@@ -553,10 +903,20 @@ class Database:
                     res = conn.execute(text('''
                         INSERT INTO site_sessions (cookie_id, tg_user_id, user_agent, ip)
                         VALUES (:cookie, :tg, :ua, :ip)
-                        RETURNING id
+                        RETURNING id, session_start
                     '''), {'cookie': cookie_id, 'tg': tg_user_id, 'ua': user_agent, 'ip': ip}).fetchone()
                     session_id = int(res[0]) if res else None
+
+                    if tg_user_id and res:
+                        run = self._pg_runner(conn)
+                        self._touch_activity_profile(run, tg_user_id, new_session=True)
+                        self._bump_data_version(run, tg_user_id)
+                        self._append_journey_entry(run, tg_user_id, 'miniapp_opens', self._shape_journey_entry(
+                            'miniapp_opens', self._format_journey_timestamp(res[1]), session_id=session_id))
+                if tg_user_id:
+                    self.cookie_cache.invalidate(cookie_id)
                 logger.info(f"Создана сессия {session_id} для cookie_id {cookie_id} (Postgres)")
+                self._update_visitor_sketches(cookie_id, [('all', '')])
                 return session_id
             except Exception as e:
                 logger.error(f"Ошибка при создании сессии (Postgres): {e}")
@@ -571,10 +931,20 @@ class Database:
         ''', (cookie_id, tg_user_id, user_agent, ip))
 
         session_id = cursor.lastrowid
+        if tg_user_id:
+            run = self._sqlite_runner(cursor)
+            self._touch_activity_profile(run, tg_user_id, new_session=True)
+            self._bump_data_version(run, tg_user_id)
+            session_start = run('SELECT session_start FROM site_sessions WHERE id = :id', {'id': session_id})[0][0]
+            self._append_journey_entry(run, tg_user_id, 'miniapp_opens', self._shape_journey_entry(
+                'miniapp_opens', self._format_journey_timestamp(session_start), session_id=session_id))
         conn.commit()
         conn.close()
+        if tg_user_id:
+            self.cookie_cache.invalidate(cookie_id)
 
         logger.info(f"Создана сессия {session_id} для cookie_id {cookie_id}")
+        self._update_visitor_sketches(cookie_id, [('all', '')])
         return session_id
 
     def end_site_session(self, session_id: int) -> bool:
@@ -671,6 +1041,11 @@ class Database:
                 with self.engine.begin() as conn:
                     res = conn.execute(text(sql), params)
                     success = res.rowcount > 0
+                    if success:
+                        run = self._pg_runner(conn)
+                        self._bump_session_user_version(run, session_id)
+                        if 'page_id' in update_items or 'device_type' in update_items:
+                            self._refresh_miniapp_open_entry(run, session_id)
                 if success:
                     logger.info(f"Обновлена информация сессии {session_id} (Postgres)")
                 return success
@@ -696,6 +1071,11 @@ class Database:
             cursor.execute(sql, values)
 
             success = cursor.rowcount > 0
+            if success:
+                run = self._sqlite_runner(cursor)
+                self._bump_session_user_version(run, session_id)
+                if 'page_id' in update_items or 'device_type' in update_items:
+                    self._refresh_miniapp_open_entry(run, session_id)
             conn.commit()
 
             if success:
@@ -711,6 +1091,35 @@ class Database:
 
     # =============== МЕТОДЫ ДЛЯ РАБОТЫ С СОБЫТИЯМИ ===============
 
+    @staticmethod
+    def _attribution_from_visit(visit_data: dict) -> dict:
+        """Поля атрибуции сессии из данных визита (custom_data события source_visit)"""
+        attribution = {field: visit_data.get(field) for field in SESSION_ATTRIBUTION_FIELDS}
+        attribution['utm_params'] = {k: v for k, v in visit_data.items() if k.startswith('utm_')}
+        return attribution
+
+    @staticmethod
+    def _session_update(session_id: int, attribution: dict = None,
+                        count_event: bool = True) -> Tuple[Optional[str], dict]:
+        """UPDATE сессии: счетчик событий и атрибуция первого касания (только пустые колонки)"""
+        set_parts = ['events_count = COALESCE(events_count, 0) + 1'] if count_event else []
+        params = {'id': session_id}
+        attribution = attribution or {}
+
+        for field in SESSION_ATTRIBUTION_FIELDS:
+            if attribution.get(field):
+                set_parts.append(f'{field} = COALESCE({field}, :{field})')
+                params[field] = attribution[field]
+
+        utm_params = {k: v for k, v in (attribution.get('utm_params') or {}).items() if v}
+        if utm_params:
+            set_parts.append('utm_params = COALESCE(utm_params, :utm_params)')
+            params['utm_params'] = json.dumps(utm_params)
+
+        if not set_parts:
+            return None, params
+        return f"UPDATE site_sessions SET {', '.join(set_parts)} WHERE id = :id", params
+
     def log_event(self, session_id: int, event_type: str, event_name: str,
                   page: str = None, metadata: dict = None, tg_user_id: Optional[int] = None,
                   event_category: str = None, event_subtype: str = None, element_id: str = None,
@@ -718,10 +1127,15 @@ class Database:
                   time_spent: int = None, interaction_count: int = None,
                   previous_event_id: Optional[int] = None, step_number: int = None,
                   completion_rate: float = None, error_message: str = None,
-                  custom_data: dict = None) -> int:
-        """Логировать расширенное событие пользователя"""
+                  custom_data: dict = None, session_attribution: dict = None) -> int:
+        """Логировать расширенное событие пользователя.
+
+        session_attribution — поля источника (SESSION_ATTRIBUTION_FIELDS и utm_params),
+        которые в той же транзакции записываются в пустые колонки сессии.
+        """
         metadata_json = json.dumps(metadata) if metadata else None
         custom_data_json = json.dumps(custom_data) if custom_data else None
+        session_sql, session_params = self._session_update(session_id, session_attribution)
 
         if self.use_postgres:
             try:
@@ -736,7 +1150,7 @@ class Database:
                                   :event_category, :event_subtype, :element_id, :element_type, :section,
                                   :scroll_depth, :time_spent, :interaction_count, :previous_event_id,
                                   :step_number, :completion_rate, :error_message, :custom_data)
-                        RETURNING id
+                        RETURNING id, created_at
                     '''), {
                         'session_id': session_id, 'tg_user_id': tg_user_id, 'event_type': event_type,
                         'event_name': event_name, 'page': page, 'metadata': metadata_json,
@@ -750,8 +1164,15 @@ class Database:
                     row = res.fetchone()
                     event_id = int(row[0]) if row else 0
 
-                    # обновляем счетчик событий
-                    conn.execute(text('UPDATE site_sessions SET events_count = COALESCE(events_count,0) + 1 WHERE id = :id'), {'id': session_id})
+                    if tg_user_id and row:
+                        run = self._pg_runner(conn)
+                        self._touch_activity_profile(run, tg_user_id, event_hour=row[1].hour)
+                        self._bump_data_version(run, tg_user_id)
+                        self._record_journey_event(run, tg_user_id, row[1], event_type, event_name, page, section,
+                                                   time_spent, scroll_depth, metadata, custom_data)
+
+                    # обновляем счетчик событий (и атрибуцию сессии, если передана)
+                    conn.execute(text(session_sql), session_params)
 
                 logger.debug(f"Залогировано событие ID {event_id}: {event_type}.{event_name} в сессии {session_id} (Postgres)")
                 return event_id
@@ -776,14 +1197,17 @@ class Database:
                   step_number, completion_rate, error_message, custom_data_json))
 
             event_id = cursor.lastrowid
-            conn.commit()
-
-            # Обновляем счетчик событий в сессии
-            cursor.execute('''
-                UPDATE site_sessions
-                SET events_count = events_count + 1
-                WHERE id = ?
-            ''', (session_id,))
+            if tg_user_id:
+                # created_at = CURRENT_TIMESTAMP в sqlite — это UTC
+                now = datetime.utcnow()
+                run = self._sqlite_runner(cursor)
+                self._touch_activity_profile(run, tg_user_id, event_hour=now.hour)
+                self._bump_data_version(run, tg_user_id)
+                self._record_journey_event(run, tg_user_id, now, event_type, event_name, page, section,
+                                           time_spent, scroll_depth, metadata, custom_data)
+
+            # Обновляем счетчик событий (и атрибуцию) в сессии в той же транзакции
+            cursor.execute(session_sql, session_params)
 
             conn.commit()
             logger.debug(f"Залогировано событие ID {event_id}: {event_type}.{event_name} в сессии {session_id}")
@@ -908,28 +1332,40 @@ class Database:
         """Логирование источника посещения"""
         utm_params = utm_params or {}
 
+        dimensions = [('source', source)]
+        if utm_params.get('utm_campaign'):
+            dimensions.append(('utm_campaign', utm_params['utm_campaign']))
+        self._update_visitor_sketches(cookie_id, dimensions)
+
+        custom_data = {
+            'source': source,
+            'cookie_id': cookie_id,
+            'utm_source': utm_params.get('utm_source'),
+            'utm_medium': utm_params.get('utm_medium'),
+            'utm_campaign': utm_params.get('utm_campaign'),
+            'utm_term': utm_params.get('utm_term'),
+            'utm_content': utm_params.get('utm_content'),
+            'referrer': referrer
+        }
+
         return self.log_event(
             session_id=session_id,
             event_type='visit',
             event_name='source_visit',
             event_category='acquisition',
             tg_user_id=tg_user_id,
-            custom_data={
-                'source': source,
-                'cookie_id': cookie_id,
-                'utm_source': utm_params.get('utm_source'),
-                'utm_medium': utm_params.get('utm_medium'),
-                'utm_campaign': utm_params.get('utm_campaign'),
-                'utm_term': utm_params.get('utm_term'),
-                'utm_content': utm_params.get('utm_content'),
-                'referrer': referrer
-            }
+            custom_data=custom_data,
+            session_attribution=self._attribution_from_visit(custom_data)
         )
 
     def log_miniapp_open(self, session_id: int, device: str, page_id: str,
                         cookie_id: str, tg_user_id: Optional[int] = None) -> int:
-        """Логирование открытия MiniApp"""
-        return self.log_event(
+        """Логирование открытия MiniApp.
+
+        Страница и устройство записываются в пустые колонки сессии и в запись пути
+        miniapp_opens этой сессии (так же их берет построение пути по истории).
+        """
+        event_id = self.log_event(
             session_id=session_id,
             event_type='app',
             event_name='miniapp_open',
@@ -942,6 +1378,20 @@ class Database:
             }
         )
 
+        def record_open(run):
+            run('''
+                UPDATE site_sessions
+                SET page_id = COALESCE(page_id, :page), device_type = COALESCE(device_type, :device)
+                WHERE id = :id
+            ''', {'id': session_id, 'page': page_id, 'device': device})
+            self._refresh_miniapp_open_entry(run, session_id)
+
+        try:
+            self._in_transaction(record_open)
+        except Exception as e:
+            logger.error(f"Ошибка при записи страницы и устройства сессии {session_id}: {e}")
+        return event_id
+
     def log_content_view(self, session_id: int, content_type: str, content_id: str,
                         content_title: str = None, section: str = None, time_spent: int = None,
                         scroll_depth: int = None, cookie_id: str = None,
@@ -1103,6 +1553,19 @@ class Database:
 
     # =============== ВСПОМОГАТЕЛЬНЫЕ МЕТОДЫ ДЛЯ СПЕЦИАЛИЗИРОВАННЫХ ТАБЛИЦ ===============
 
+    @staticmethod
+    def _increment_preference_counter(run, tg_user_id: int, kind: str, value: Optional[str]) -> None:
+        """Увеличить счетчик предпочтений пользователя в уже открытой транзакции"""
+        if value is None:
+            return
+        run('''
+            INSERT INTO user_preference_counters (tg_user_id, kind, value, count, updated_at)
+            VALUES (:tg, :kind, :value, 1, CURRENT_TIMESTAMP)
+            ON CONFLICT (tg_user_id, kind, value) DO UPDATE SET
+                count = user_preference_counters.count + 1,
+                updated_at = CURRENT_TIMESTAMP
+        ''', {'tg': tg_user_id, 'kind': kind, 'value': value})
+
     def _save_content_view(self, session_id: int, content_type: str, content_id: str,
                           content_title: str = None, section: str = None, time_spent: int = None,
                           scroll_depth: int = None, cookie_id: str = None,
@@ -1123,6 +1586,9 @@ class Database:
                         'content_title': content_title, 'section': section,
                         'time_spent': time_spent, 'scroll_depth': scroll_depth
                     })
+                    if tg_user_id:
+                        self._increment_preference_counter(self._pg_runner(conn), tg_user_id,
+                                                           'content_type', content_type)
                 return True
             except Exception as e:
                 logger.error(f"Ошибка при сохранении просмотра контента (Postgres): {e}")
@@ -1139,6 +1605,9 @@ class Database:
                 ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (session_id, tg_user_id, cookie_id, content_type, content_id,
                   content_title, section, time_spent, scroll_depth))
+            if tg_user_id:
+                self._increment_preference_counter(self._sqlite_runner(cursor), tg_user_id,
+                                                   'content_type', content_type)
 
             conn.commit()
             return True
@@ -1168,6 +1637,9 @@ class Database:
                         'messages_count': messages_count, 'topics': topics_json,
                         'interaction_duration': duration, 'conversation_type': conversation_type
                     })
+                    if tg_user_id:
+                        self._increment_preference_counter(self._pg_runner(conn), tg_user_id,
+                                                           'conversation_type', conversation_type)
                 return True
             except Exception as e:
                 logger.error(f"Ошибка при сохранении AI взаимодействия (Postgres): {e}")
@@ -1186,6 +1658,9 @@ class Database:
                 ) VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (session_id, tg_user_id, cookie_id, messages_count, topics_json,
                   duration, conversation_type))
+            if tg_user_id:
+                self._increment_preference_counter(self._sqlite_runner(cursor), tg_user_id,
+                                                   'conversation_type', conversation_type)
 
             conn.commit()
             return True
@@ -1305,6 +1780,7 @@ class Database:
                             result_json = EXCLUDED.result_json,
                             completed_at = CURRENT_TIMESTAMP
                     '''), {'tg': tg_user_id, 'cookie': cookie_id, 'result_json': result_json})
+                    self._bump_data_version(self._pg_runner(conn), tg_user_id)
                 logger.info(f"Сохранены результаты диагностики для пользователя {tg_user_id} (Postgres)")
                 return True
             except Exception as e:
@@ -1319,6 +1795,7 @@ class Database:
                 INSERT OR REPLACE INTO diagnostics_results (tg_user_id, cookie_id, result_json, completed_at)
                 VALUES (?, ?, ?, CURRENT_TIMESTAMP)
             ''', (tg_user_id, cookie_id, result_json))
+            self._bump_data_version(self._sqlite_runner(cursor), tg_user_id)
 
             conn.commit()
             logger.info(f"Сохранены результаты диагностики для пользователя {tg_user_id}")
@@ -1442,6 +1919,449 @@ class Database:
         conn.close()
         return analytics
 
+    # =============== ПЕРСОНАЛЬНЫЙ ОТЧЕТ ===============
+
+    _REPORT_STATS_SQL = '''
+        SELECT
+            (SELECT COUNT(*) FROM site_sessions WHERE tg_user_id = :tg) AS total_sessions,
+            (SELECT COUNT(*) FROM site_events WHERE tg_user_id = :tg) AS total_events,
+            (SELECT MAX(session_start) FROM site_sessions WHERE tg_user_id = :tg) AS last_session,
+            (SELECT COUNT(*) FROM diagnostics_results WHERE tg_user_id = :tg) AS diagnostics_count,
+            first_visit.cookie_id, first_visit.source, first_visit.utm_params,
+            first_visit.referrer, first_visit.session_start
+        FROM (SELECT 1 AS one) AS base
+        LEFT JOIN (
+            SELECT cookie_id, source, utm_params, referrer, session_start
+            FROM site_sessions
+            WHERE tg_user_id = :tg
+            ORDER BY session_start ASC
+            LIMIT 1
+        ) AS first_visit ON 1 = 1
+    '''
+
+    # Построение пути по истории (однократно для пользователя без user_journeys): последние N записей
+    # каждого раздела через ROW_NUMBER(). Разделы те же, что в _journey_category()
+    _REPORT_JOURNEY_SQL = '''
+        WITH journey AS (
+            SELECT
+                CASE
+                    WHEN event_type = 'content_view' OR event_name = 'content_view' THEN 'content_views'
+                    WHEN event_type = 'ai_interaction' OR event_name = 'ai_interaction' THEN 'ai_interactions'
+                    WHEN event_type = 'diagnostic' THEN 'diagnostics'
+                    WHEN event_type IN ('game', 'game_action') THEN 'game_actions'
+                    ELSE 'cta_clicks'
+                END AS category,
+                created_at, event_name, page, section, time_spent, scroll_depth,
+                metadata, custom_data, NULL AS device_type, NULL AS session_id
+            FROM site_events
+            WHERE tg_user_id = :tg
+              AND (event_type IN ('content_view', 'ai_interaction', 'diagnostic', 'game',
+                                  'game_action', 'cta', 'cta_click')
+                   OR event_name IN ('content_view', 'ai_interaction'))
+            UNION ALL
+            SELECT 'miniapp_opens', session_start, NULL, page_id, NULL, NULL, NULL,
+                   NULL, NULL, device_type, id
+            FROM site_sessions
+            WHERE tg_user_id = :tg
+        ), ranked AS (
+            SELECT journey.*,
+                   ROW_NUMBER() OVER (PARTITION BY category ORDER BY created_at DESC, session_id DESC) AS rn
+            FROM journey
+        )
+        SELECT category, created_at, event_name, page, section, time_spent, scroll_depth,
+               metadata, custom_data, device_type, session_id
+        FROM ranked
+        WHERE rn <= CASE category
+            WHEN 'miniapp_opens' THEN :lim_miniapp_opens
+            WHEN 'content_views' THEN :lim_content_views
+            WHEN 'ai_interactions' THEN :lim_ai_interactions
+            WHEN 'diagnostics' THEN :lim_diagnostics
+            WHEN 'game_actions' THEN :lim_game_actions
+            ELSE :lim_cta_clicks
+        END
+        ORDER BY category, created_at DESC, session_id DESC
+    '''
+
+    @staticmethod
+    def _json_field(value) -> dict:
+        """JSON колонка: строка в sqlite, dict в Postgres (JSONB)"""
+        if isinstance(value, dict):
+            return value
+        if not value:
+            return {}
+        try:
+            data = json.loads(value)
+        except (TypeError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    @classmethod
+    def _shape_journey_entry(cls, category: str, timestamp, event_name: str = None, page: str = None,
+                             section: str = None, time_spent: int = None, scroll_depth: int = None,
+                             data: dict = None, device_type: str = None, session_id: int = None) -> dict:
+        """Запись персонального пути в том виде, в котором ее отдает отчет"""
+        data = data or {}
+
+        if category == 'miniapp_opens':
+            # session_id — ключ, по которому запись уточняется: у сессий одной секунды совпадает время
+            return {
+                'session_id': session_id,
+                'timestamp': timestamp,
+                'page': page or 'Главная',
+                'device': device_type or 'Не определено',
+                'timestamp_formatted': timestamp
+            }
+        if category == 'content_views':
+            return {
+                'section': data.get('content_type') or section or event_name,
+                'time_spent': time_spent or data.get('time_spent', 0),
+                'scroll_depth': scroll_depth or data.get('scroll_depth', 0),
+                'timestamp': timestamp
+            }
+        if category == 'ai_interactions':
+            return {
+                'messages_count': data.get('messages_count', 0),
+                'topics': data.get('topics', []),
+                'duration': data.get('duration') or time_spent or 0,
+                'timestamp': timestamp
+            }
+        if category == 'diagnostics':
+            start, end = _parse_timestamp(data.get('start_time')), _parse_timestamp(data.get('end_time'))
+            return {
+                'progress': data.get('progress', 0),
+                'results': data.get('results'),
+                'time_spent': int((end - start).total_seconds()) if start and end else 0,
+                'timestamp': timestamp
+            }
+        if category == 'game_actions':
+            return {
+                'game_type': data.get('game_type', 'Неизвестно'),
+                'action_type': data.get('action_type', 'Неизвестно'),
+                'achievements': data.get('achievement') or [],
+                'scores': data.get('score') or 0,
+                'timestamp': timestamp
+            }
+        return {
+            'location': data.get('cta_location') or 'Неизвестно',
+            'previous_step': data.get('previous_step') or 'Неизвестно',
+            'duration': data.get('step_duration') or time_spent or 0,
+            'timestamp': timestamp
+        }
+
+    @staticmethod
+    def _json_list(value) -> list:
+        """JSON массив: строка в sqlite, list в Postgres (JSONB)"""
+        if isinstance(value, list):
+            return value
+        try:
+            data = json.loads(value) if value else []
+        except (TypeError, ValueError):
+            return []
+        return data if isinstance(data, list) else []
+
+    @staticmethod
+    def _format_journey_timestamp(value) -> Optional[str]:
+        if isinstance(value, datetime):
+            return value.strftime(JOURNEY_TIMESTAMP_FORMAT)
+        return value
+
+    def _append_journey_entry(self, run, tg_user_id: int, category: str, entry: dict) -> None:
+        """Добавить запись в кольцевой буфер раздела пути в уже открытой транзакции.
+
+        Буфер хранит не более JOURNEY_LIMITS[category] последних записей (новые — первыми).
+        Если пути у пользователя еще нет, он один раз строится по истории — новое событие
+        к этому моменту уже вставлено в той же транзакции.
+        """
+        lock = ' FOR UPDATE' if self.use_postgres else ''
+        rows = run('SELECT entries FROM user_journeys WHERE tg_user_id = :tg AND category = :category' + lock,
+                   {'tg': tg_user_id, 'category': category})
+        if not rows:
+            self._rebuild_journey(run, tg_user_id)
+            return
+
+        entries = self._json_list(rows[0][0])
+        entries.insert(0, entry)
+        del entries[JOURNEY_LIMITS[category]:]
+        run('''
+            UPDATE user_journeys SET entries = :entries, updated_at = CURRENT_TIMESTAMP
+            WHERE tg_user_id = :tg AND category = :category
+        ''', {'tg': tg_user_id, 'category': category, 'entries': json.dumps(entries, ensure_ascii=False)})
+
+    def _record_journey_event(self, run, tg_user_id: int, created_at, event_type: str, event_name: str,
+                              page: str = None, section: str = None, time_spent: int = None,
+                              scroll_depth: int = None, metadata: dict = None, custom_data: dict = None) -> None:
+        """Добавить событие в путь пользователя, если оно относится к одному из разделов"""
+        category = _journey_category(event_type, event_name)
+        if not category:
+            return
+        data = dict(metadata or {})
+        data.update(custom_data or {})
+        entry = self._shape_journey_entry(
+            category, self._format_journey_timestamp(created_at), event_name=event_name, page=page,
+            section=section, time_spent=time_spent, scroll_depth=scroll_depth, data=data
+        )
+        self._append_journey_entry(run, tg_user_id, category, entry)
+
+    def _refresh_miniapp_open_entry(self, run, session_id: int) -> None:
+        """Обновить страницу и устройство в записи пути miniapp_opens сессии (в открытой транзакции)"""
+        rows = run('SELECT tg_user_id, session_start, page_id, device_type FROM site_sessions WHERE id = :id',
+                   {'id': session_id})
+        if not rows or not rows[0][0]:
+            return
+        tg_user_id, session_start, page_id, device_type = rows[0]
+        timestamp = self._format_journey_timestamp(session_start)
+
+        lock = ' FOR UPDATE' if self.use_postgres else ''
+        journey = run("SELECT entries FROM user_journeys WHERE tg_user_id = :tg AND category = 'miniapp_opens'" + lock,
+                      {'tg': tg_user_id})
+        if not journey:
+            return
+        entries = self._json_list(journey[0][0])
+        for i, entry in enumerate(entries):
+            # Записи, сохраненные до появления session_id, находим по времени начала сессии
+            key = entry['session_id'] if 'session_id' in entry else None
+            if key == session_id or (key is None and entry.get('timestamp') == timestamp):
+                entries[i] = self._shape_journey_entry('miniapp_opens', timestamp, page=page_id,
+                                                       device_type=device_type, session_id=session_id)
+                run('''
+                    UPDATE user_journeys SET entries = :entries, updated_at = CURRENT_TIMESTAMP
+                    WHERE tg_user_id = :tg AND category = 'miniapp_opens'
+                ''', {'tg': tg_user_id, 'entries': json.dumps(entries, ensure_ascii=False)})
+                return
+
+    def _rebuild_journey(self, run, tg_user_id: int) -> Dict[str, list]:
+        """Построить путь по site_events/site_sessions и сохранить все разделы (существующие не трогаем)"""
+        params = {'tg': tg_user_id}
+        params.update({f'lim_{category}': limit for category, limit in JOURNEY_LIMITS.items()})
+
+        journey = {category: [] for category in JOURNEY_LIMITS}
+        for row in run(self._REPORT_JOURNEY_SQL, params):
+            data = self._json_field(row[7])
+            data.update(self._json_field(row[8]))
+            journey[row[0]].append(self._shape_journey_entry(
+                row[0], self._format_journey_timestamp(row[1]), event_name=row[2], page=row[3],
+                section=row[4], time_spent=row[5], scroll_depth=row[6], data=data, device_type=row[9],
+                session_id=row[10]
+            ))
+
+        for category, entries in journey.items():
+            run('''
+                INSERT INTO user_journeys (tg_user_id, category, entries, updated_at)
+                VALUES (:tg, :category, :entries, CURRENT_TIMESTAMP)
+                ON CONFLICT (tg_user_id, category) DO NOTHING
+            ''', {'tg': tg_user_id, 'category': category, 'entries': json.dumps(entries, ensure_ascii=False)})
+        return journey
+
+    def get_user_journey(self, tg_user_id: int) -> Dict[str, list]:
+        """Персональный путь пользователя (строится по истории, если еще не сохранен)"""
+        if self.use_postgres:
+            with self.engine.begin() as conn:
+                rows = conn.execute(text('SELECT category, entries FROM user_journeys WHERE tg_user_id = :tg'),
+                                    {'tg': tg_user_id}).fetchall()
+                return self._journey_from_rows(rows) if rows else self._rebuild_journey(self._pg_runner(conn), tg_user_id)
+
+        conn = self.get_connection()
+        try:
+            cursor = conn.cursor()
+            rows = cursor.execute('SELECT category, entries FROM user_journeys WHERE tg_user_id = ?',
+                                  (tg_user_id,)).fetchall()
+            if rows:
+                return self._journey_from_rows(rows)
+            journey = self._rebuild_journey(self._sqlite_runner(cursor), tg_user_id)
+            conn.commit()
+            return journey
+        finally:
+            conn.close()
+
+    def _journey_from_rows(self, rows) -> Dict[str, list]:
+        journey = {category: [] for category in JOURNEY_LIMITS}
+        for row in rows:
+            if row[0] in journey:
+                journey[row[0]] = self._json_list(row[1])
+        return journey
+
+    def get_personal_report_data(self, tg_user_id: int) -> dict:
+        """Данные персонального отчета за одно соединение: запрос агрегатов и чтение пути по ключу.
+
+        В Postgres оба запроса отправляются в pipeline mode psycopg3 — один сетевой round-trip.
+        Путь берется из кольцевых буферов user_journeys, которые обновляются при записи событий.
+        """
+        params = {'tg': tg_user_id}
+        journey_sql = 'SELECT category, entries FROM user_journeys WHERE tg_user_id = :tg'
+
+        if self.use_postgres:
+            with self.engine.connect() as sa_conn:
+                raw = sa_conn.connection.driver_connection
+                # Плейсхолдеры :name переводит компилятор SQLAlchemy диалекта psycopg (с экранированием %)
+                stats = text(self._REPORT_STATS_SQL).compile(dialect=sa_conn.dialect)
+                journey = text(journey_sql).compile(dialect=sa_conn.dialect)
+                with raw.pipeline():
+                    stats_cur = raw.execute(str(stats), stats.construct_params(params))
+                    journey_cur = raw.execute(str(journey), journey.construct_params(params))
+                stats_row = stats_cur.fetchone()
+                journey_rows = journey_cur.fetchall()
+        else:
+            conn = self.get_connection()
+            try:
+                stats_row = conn.execute(self._REPORT_STATS_SQL, params).fetchone()
+                journey_rows = conn.execute(journey_sql, params).fetchall()
+            finally:
+                conn.close()
+
+        if journey_rows:
+            journey = self._journey_from_rows(journey_rows)
+        elif stats_row[0] or stats_row[1]:
+            # Пользователь с историей до появления user_journeys
+            journey = self.get_user_journey(tg_user_id)
+        else:
+            journey = {category: [] for category in JOURNEY_LIMITS}
+
+        analytics = {
+            'total_sessions': int(stats_row[0] or 0),
+            'total_events': int(stats_row[1] or 0),
+            'last_session': stats_row[2],
+            'diagnostics_completed': int(stats_row[3] or 0) > 0
+        }
+
+        return {
+            'user': {
+                'tg_user_id': tg_user_id,
+                'cookie_id': stats_row[4],
+                'traffic_source': stats_row[5] or 'Не определен',
+                'utm_params': self._json_field(stats_row[6]),
+                'referrer': stats_row[7],
+                'first_visit_date': stats_row[8]
+            },
+            'journey': journey,
+            'segmentation': self._classify_segment(analytics)
+        }
+
+    # Агрегаты отчета сразу для диапазона пользователей (массовая выгрузка): сгруппированные
+    # подзапросы по tg_user_id BETWEEN :lo AND :hi вместо запросов на каждого пользователя
+    _REPORT_STATS_RANGE_SQL = '''
+        SELECT u.user_id AS tg_user_id,
+               COALESCE(s.total_sessions, 0) AS total_sessions,
+               COALESCE(e.total_events, 0) AS total_events,
+               s.last_session,
+               COALESCE(d.diagnostics_count, 0) AS diagnostics_count,
+               fv.cookie_id, fv.source, fv.utm_params, fv.referrer, fv.session_start
+        FROM users u
+        LEFT JOIN (
+            SELECT tg_user_id, COUNT(*) AS total_sessions, MAX(session_start) AS last_session
+            FROM site_sessions WHERE tg_user_id BETWEEN :lo AND :hi GROUP BY tg_user_id
+        ) s ON s.tg_user_id = u.user_id
+        LEFT JOIN (
+            SELECT tg_user_id, COUNT(*) AS total_events
+            FROM site_events WHERE tg_user_id BETWEEN :lo AND :hi GROUP BY tg_user_id
+        ) e ON e.tg_user_id = u.user_id
+        LEFT JOIN (
+            SELECT tg_user_id, COUNT(*) AS diagnostics_count
+            FROM diagnostics_results WHERE tg_user_id BETWEEN :lo AND :hi GROUP BY tg_user_id
+        ) d ON d.tg_user_id = u.user_id
+        LEFT JOIN (
+            SELECT tg_user_id, cookie_id, source, utm_params, referrer, session_start,
+                   ROW_NUMBER() OVER (PARTITION BY tg_user_id ORDER BY session_start ASC, id ASC) AS rn
+            FROM site_sessions WHERE tg_user_id BETWEEN :lo AND :hi
+        ) fv ON fv.tg_user_id = u.user_id AND fv.rn = 1
+        WHERE u.user_id BETWEEN :lo AND :hi
+        ORDER BY u.user_id
+    '''
+
+    # Критерии массовой выгрузки — поля результата _classify_segment
+    REPORT_SEGMENT_CRITERIA = ('segment', 'engagement_level', 'conversion_potential', 'diagnostics_completed')
+
+    def iter_segment_report_data(self, segment_criteria: dict, chunk_size: int = 500):
+        """Данные персональных отчетов всех пользователей, подходящих под критерии сегмента.
+
+        Пользователи обходятся диапазонами user_id по chunk_size; на диапазон — три запроса
+        (границы диапазона, агрегаты, пути). Генератор отдает пары (просмотрено пользователей,
+        список данных в формате get_personal_report_data) по одной на диапазон, поэтому
+        память ограничена размером порции.
+        """
+        unknown = set(segment_criteria) - set(self.REPORT_SEGMENT_CRITERIA)
+        if unknown:
+            raise ValueError(f"Неподдерживаемые критерии сегмента: {', '.join(sorted(unknown))}")
+        if chunk_size <= 0:
+            raise ValueError("chunk_size должен быть положительным")
+
+        journey_sql = '''
+            SELECT tg_user_id, category, entries FROM user_journeys
+            WHERE tg_user_id BETWEEN :lo AND :hi
+        '''
+        after = None
+        while True:
+            id_sql = 'SELECT user_id FROM users'
+            params = {'n': chunk_size}
+            if after is not None:
+                id_sql += ' WHERE user_id > :after'
+                params['after'] = after
+            id_sql += ' ORDER BY user_id LIMIT :n'
+
+            if self.use_postgres:
+                with self.engine.connect() as conn:
+                    run = self._pg_runner(conn)
+                    stats_rows, journey_rows = self._report_range_rows(run, id_sql, params, journey_sql)
+            else:
+                conn = self.get_connection()
+                try:
+                    run = self._sqlite_runner(conn.cursor())
+                    stats_rows, journey_rows = self._report_range_rows(run, id_sql, params, journey_sql)
+                finally:
+                    conn.close()
+
+            if stats_rows is None:
+                return
+            after = stats_rows[-1][0]
+
+            journeys: Dict[int, list] = {}
+            for row in journey_rows:
+                journeys.setdefault(row[0], []).append((row[1], row[2]))
+
+            batch = []
+            for row in stats_rows:
+                analytics = {
+                    'total_sessions': int(row[1] or 0),
+                    'total_events': int(row[2] or 0),
+                    'last_session': row[3],
+                    'diagnostics_completed': int(row[4] or 0) > 0
+                }
+                segmentation = self._classify_segment(analytics)
+                if any(segmentation.get(key) != value for key, value in segment_criteria.items()):
+                    continue
+
+                tg_user_id = row[0]
+                if tg_user_id in journeys:
+                    journey = self._journey_from_rows(journeys[tg_user_id])
+                elif analytics['total_sessions'] or analytics['total_events']:
+                    # Пользователь с историей до появления user_journeys
+                    journey = self.get_user_journey(tg_user_id)
+                else:
+                    journey = {category: [] for category in JOURNEY_LIMITS}
+
+                batch.append({
+                    'user': {
+                        'tg_user_id': tg_user_id,
+                        'cookie_id': row[5],
+                        'traffic_source': row[6] or 'Не определен',
+                        'utm_params': self._json_field(row[7]),
+                        'referrer': row[8],
+                        'first_visit_date': row[9]
+                    },
+                    'journey': journey,
+                    'segmentation': segmentation
+                })
+
+            logger.info(f"Выгрузка отчетов: диапазон user_id {stats_rows[0][0]}..{after}, подходит {len(batch)} из {len(stats_rows)}")
+            yield len(stats_rows), batch
+
+    def _report_range_rows(self, run, id_sql: str, params: dict, journey_sql: str):
+        """Агрегаты и пути для следующей порции user_id; (None, None), если пользователи закончились"""
+        ids = [row[0] for row in run(id_sql, params)]
+        if not ids:
+            return None, None
+        bounds = {'lo': ids[0], 'hi': ids[-1]}
+        return run(self._REPORT_STATS_RANGE_SQL, bounds), run(journey_sql, bounds)
+
     def get_site_stats(self) -> dict:
         """Получить общую статистику сайта"""
         stats = {
@@ -1491,49 +2411,372 @@ class Database:
         conn.close()
         return stats
 
-    # =============== МЕТОДЫ СЕГМЕНТАЦИИ ПОЛЬЗОВАТЕЛЕЙ ===============
+    def get_bot_stats_counters(self, recent_limit: int = 5) -> dict:
+        """Счетчики для /stats одним проходом по users (запросы работают на обоих бэкендах).
 
-    def get_user_segment(self, tg_user_id: int) -> dict:
-        """Определить сегмент пользователя на основе его действий"""
-        analytics = self.get_user_analytics(tg_user_id)
+        events_total — MAX(id) site_events (берется по первичному ключу, без COUNT по таблице);
+        по разнице между замерами StatsSnapshot считает события в минуту. segmentation_dirty и
+        segmentation_lag_seconds — пользователи, чьи данные изменились после расчета сегмента,
+        и возраст самого старого такого изменения.
+        """
+        true = 'true' if self.use_postgres else '1'
+        now_sql = 'LOCALTIMESTAMP' if self.use_postgres else 'CURRENT_TIMESTAMP'
+        users_sql = f'''
+            SELECT COUNT(*),
+                   COALESCE(SUM(CASE WHEN has_started_diagnostics = {true} THEN 1 ELSE 0 END), 0),
+                   COALESCE(SUM(CASE WHEN first_reminder_sent = {true} THEN 1 ELSE 0 END), 0),
+                   COALESCE(SUM(CASE WHEN second_reminder_sent = {true} THEN 1 ELSE 0 END), 0)
+            FROM users
+        '''
+        dirty_sql = '''
+            SELECT COUNT(*), MIN(v.updated_at)
+            FROM user_data_versions v
+            LEFT JOIN user_segments s ON s.tg_user_id = v.tg_user_id
+            WHERE s.tg_user_id IS NULL OR s.data_version <> v.version
+        '''
+        recent_sql = '''
+            SELECT user_id, first_name, username, has_started_diagnostics, first_reminder_sent, started_at
+            FROM users
+            ORDER BY created_at DESC
+            LIMIT :limit
+        '''
+
+        def collect(run):
+            now = run(f'SELECT {now_sql}', {})[0][0]
+            total, started, first_sent, second_sent = run(users_sql, {})[0]
+            pending_first = run(self._reminder_candidates_sql('first', 'COUNT(*)'), {})[0][0]
+            events_total = run('SELECT COALESCE(MAX(id), 0) FROM site_events', {})[0][0]
+            dirty, oldest_dirty = run(dirty_sql, {})[0]
+            recent = run(recent_sql, {'limit': recent_limit})
+            return now, total, started, first_sent, second_sent, pending_first, events_total, dirty, oldest_dirty, recent
 
-        segment = {
-            'segment': 'newcomer',  # newcomer, engaged, converter, loyal
-            'engagement_level': 'low',  # low, medium, high
-            'conversion_potential': 'unknown',  # low, medium, high, converted
-            'content_preference': [],  # список предпочитаемых типов контента
-            'behavior_patterns': [],  # паттерны поведения
-            'last_activity': analytics.get('last_session'),
-            'total_sessions': analytics.get('total_sessions', 0),
-            'diagnostics_completed': analytics.get('diagnostics_completed', False)
+        if self.use_postgres:
+            with self.engine.connect() as conn:
+                result = collect(self._pg_runner(conn))
+        else:
+            conn = self.get_connection()
+            try:
+                result = collect(self._sqlite_runner(conn.cursor()))
+            finally:
+                conn.close()
+        now, total, started, first_sent, second_sent, pending_first, events_total, dirty, oldest_dirty, recent = result
+
+        def parse(value):
+            return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+        lag = (parse(now) - parse(oldest_dirty)).total_seconds() if oldest_dirty is not None else 0.0
+        return {
+            'total_users': int(total),
+            'started_diagnostics': int(started),
+            'first_reminders_sent': int(first_sent),
+            'second_reminders_sent': int(second_sent),
+            'pending_first_reminder': int(pending_first),
+            'events_total': int(events_total),
+            'segmentation_dirty': int(dirty),
+            'segmentation_lag_seconds': max(0.0, lag),
+            'recent_users': [{
+                'user_id': row[0], 'first_name': row[1], 'username': row[2],
+                'has_started_diagnostics': bool(row[3]), 'first_reminder_sent': bool(row[4]),
+                'started_at': row[5],
+            } for row in recent],
         }
 
-        # Логика сегментации
-        sessions = analytics.get('total_sessions', 0)
-        events = analytics.get('total_events', 0)
-        has_diagnostic = analytics.get('diagnostics_completed', False)
+    # =============== ПРОФИЛЬ АКТИВНОСТИ ПОЛЬЗОВАТЕЛЯ ===============
+
+    @staticmethod
+    def _sqlite_runner(cursor):
+        """Выполнение запросов с именованными параметрами на курсоре sqlite"""
+        return lambda sql, params: cursor.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _pg_runner(conn):
+        """Выполнение запросов с именованными параметрами в SQLAlchemy соединении"""
+        def run(sql, params):
+            res = conn.execute(text(sql), params)
+            return res.fetchall() if res.returns_rows else []
+        return run
+
+    @staticmethod
+    def _bump_data_version(run, tg_user_id: Optional[int]) -> None:
+        """Увеличить версию данных пользователя в уже открытой транзакции (инвалидирует кеш отчета)"""
+        if not tg_user_id:
+            return
+        run('''
+            INSERT INTO user_data_versions (tg_user_id, version, updated_at)
+            VALUES (:tg, 1, CURRENT_TIMESTAMP)
+            ON CONFLICT (tg_user_id) DO UPDATE SET
+                version = user_data_versions.version + 1,
+                updated_at = CURRENT_TIMESTAMP
+        ''', {'tg': tg_user_id})
+
+    @staticmethod
+    def _bump_session_user_version(run, session_id: int) -> None:
+        """Увеличить версию данных владельца сессии (если сессия связана с пользователем)"""
+        run('''
+            INSERT INTO user_data_versions (tg_user_id, version, updated_at)
+            SELECT tg_user_id, 1, CURRENT_TIMESTAMP FROM site_sessions
+            WHERE id = :id AND tg_user_id IS NOT NULL
+            ON CONFLICT (tg_user_id) DO UPDATE SET
+                version = user_data_versions.version + 1,
+                updated_at = CURRENT_TIMESTAMP
+        ''', {'id': session_id})
 
-        # Определение уровня вовлеченности
-        if sessions >= 10 and events >= 50:
-            segment['engagement_level'] = 'high'
-            segment['segment'] = 'loyal'
-        elif sessions >= 3 and events >= 15:
-            segment['engagement_level'] = 'medium'
-            segment['segment'] = 'engaged'
-        elif sessions >= 1:
-            segment['engagement_level'] = 'low'
-            if has_diagnostic:
-                segment['segment'] = 'converter'
+    def get_user_data_version(self, tg_user_id: int) -> int:
+        """Текущая версия данных пользователя (0 — данных еще не было)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT version FROM user_data_versions WHERE tg_user_id = ?', (tg_user_id,))
+            row = cursor.fetchone()
+            return int(row['version']) if row else 0
+        except Exception as e:
+            logger.error(f"Ошибка при получении версии данных пользователя {tg_user_id}: {e}")
+            return 0
+        finally:
+            conn.close()
 
-        # Определение потенциала конверсии
-        if has_diagnostic:
-            segment['conversion_potential'] = 'converted'
-        elif events >= 10 and sessions >= 2:
-            segment['conversion_potential'] = 'high'
-        elif events >= 5:
-            segment['conversion_potential'] = 'medium'
-        else:
-            segment['conversion_potential'] = 'low'
+    def _touch_activity_profile(self, run, tg_user_id: int, event_hour: int = None,
+                                new_session: bool = False) -> None:
+        """Инкрементально обновить профиль активности в уже открытой транзакции.
+
+        Если профиля еще нет, он один раз строится по истории пользователя —
+        новое событие или сессия к этому моменту уже вставлены в той же транзакции.
+        """
+        lock = ' FOR UPDATE' if self.use_postgres else ''
+        rows = run('SELECT hour_histogram FROM user_activity_profiles WHERE tg_user_id = :tg' + lock,
+                   {'tg': tg_user_id})
+        if not rows:
+            self._build_activity_profile(run, tg_user_id)
+            return
+
+        if event_hour is not None:
+            hours = _unpack_hour_histogram(rows[0][0])
+            hours[event_hour] += 1
+            run('''
+                UPDATE user_activity_profiles
+                SET hour_histogram = :hist,
+                    first_seen_at = COALESCE(first_seen_at, CURRENT_TIMESTAMP),
+                    last_seen_at = CURRENT_TIMESTAMP,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE tg_user_id = :tg
+            ''', {'hist': _pack_hour_histogram(hours), 'tg': tg_user_id})
+
+        if new_session:
+            run('''
+                UPDATE user_activity_profiles
+                SET sessions_count = sessions_count + 1,
+                    first_session_at = COALESCE(first_session_at, CURRENT_TIMESTAMP),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE tg_user_id = :tg
+            ''', {'tg': tg_user_id})
+
+    def _build_activity_profile(self, run, tg_user_id: int) -> Optional[dict]:
+        """Построить профиль активности по site_events/site_sessions (однократно для пользователя)"""
+        hour_expr = "EXTRACT(HOUR FROM created_at)" if self.use_postgres else "strftime('%H', created_at)"
+        hours = [0] * 24
+        first_seen, last_seen = None, None
+
+        for row in run(f'''
+            SELECT {hour_expr} AS hour, COUNT(*), MIN(created_at), MAX(created_at)
+            FROM site_events
+            WHERE tg_user_id = :tg AND created_at IS NOT NULL
+            GROUP BY hour
+        ''', {'tg': tg_user_id}):
+            hours[int(row[0])] += int(row[1])
+            first_seen = row[2] if first_seen is None or row[2] < first_seen else first_seen
+            last_seen = row[3] if last_seen is None or row[3] > last_seen else last_seen
+
+        sessions = run('''
+            SELECT COUNT(*), MIN(session_start)
+            FROM site_sessions
+            WHERE tg_user_id = :tg AND session_start IS NOT NULL
+        ''', {'tg': tg_user_id})
+        sessions_count, first_session = (int(sessions[0][0]), sessions[0][1]) if sessions else (0, None)
+
+        # Для пользователя без истории профиль не создаем
+        if not any(hours) and not sessions_count:
+            return None
+
+        profile = {
+            'tg': tg_user_id,
+            'hist': _pack_hour_histogram(hours),
+            'first_seen': first_seen,
+            'last_seen': last_seen,
+            'sessions_count': sessions_count,
+            'first_session': first_session
+        }
+        run('''
+            INSERT INTO user_activity_profiles (
+                tg_user_id, hour_histogram, first_seen_at, last_seen_at, sessions_count, first_session_at
+            ) VALUES (:tg, :hist, :first_seen, :last_seen, :sessions_count, :first_session)
+            ON CONFLICT (tg_user_id) DO NOTHING
+        ''', profile)
+        return profile
+
+    def get_activity_profile(self, tg_user_id: int) -> Optional[dict]:
+        """Профиль активности пользователя: гистограмма по часам, первый/последний визит, число сессий"""
+        columns = 'hour_histogram, first_seen_at, last_seen_at, sessions_count, first_session_at'
+
+        if self.use_postgres:
+            with self.engine.begin() as conn:
+                run = self._pg_runner(conn)
+                rows = run(f'SELECT {columns} FROM user_activity_profiles WHERE tg_user_id = :tg', {'tg': tg_user_id})
+                if not rows:
+                    self._build_activity_profile(run, tg_user_id)
+                    rows = run(f'SELECT {columns} FROM user_activity_profiles WHERE tg_user_id = :tg', {'tg': tg_user_id})
+        else:
+            conn = self.get_connection()
+            try:
+                run = self._sqlite_runner(conn.cursor())
+                rows = run(f'SELECT {columns} FROM user_activity_profiles WHERE tg_user_id = :tg', {'tg': tg_user_id})
+                if not rows:
+                    self._build_activity_profile(run, tg_user_id)
+                    conn.commit()
+                    rows = run(f'SELECT {columns} FROM user_activity_profiles WHERE tg_user_id = :tg', {'tg': tg_user_id})
+            finally:
+                conn.close()
+
+        if not rows:
+            return None
+
+        row = rows[0]
+        return {
+            'hour_histogram': _unpack_hour_histogram(row[0]),
+            'first_seen_at': row[1],
+            'last_seen_at': row[2],
+            'sessions_count': row[3] or 0,
+            'first_session_at': row[4]
+        }
+
+    # =============== УНИКАЛЬНЫЕ ПОСЕТИТЕЛИ (HyperLogLog) ===============
+
+    def _update_visitor_sketches(self, cookie_id: str, dimensions: List[Tuple[str, str]],
+                                 day: str = None) -> bool:
+        """Добавить посетителя в дневные скетчи по списку (dimension, value)"""
+        if not cookie_id or not dimensions:
+            return False
+
+        day = day or datetime.utcnow().strftime('%Y-%m-%d')
+
+        if self.use_postgres:
+            try:
+                with self.engine.begin() as conn:
+                    for dimension, value in dimensions:
+                        key = {'day': day, 'dim': dimension, 'val': str(value)}
+                        conn.execute(text('''
+                            INSERT INTO visitor_sketches (day, dimension, value, sketch)
+                            VALUES (:day, :dim, :val, :sketch)
+                            ON CONFLICT (day, dimension, value) DO NOTHING
+                        '''), {**key, 'sketch': HyperLogLog().to_bytes()})
+                        row = conn.execute(text('''
+                            SELECT sketch FROM visitor_sketches
+                            WHERE day = :day AND dimension = :dim AND value = :val
+                            FOR UPDATE
+                        '''), key).fetchone()
+                        sketch = HyperLogLog.from_bytes(row[0])
+                        if sketch.add(cookie_id):
+                            conn.execute(text('''
+                                UPDATE visitor_sketches SET sketch = :sketch, updated_at = CURRENT_TIMESTAMP
+                                WHERE day = :day AND dimension = :dim AND value = :val
+                            '''), {**key, 'sketch': sketch.to_bytes()})
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении скетчей посетителей (Postgres): {e}")
+                return False
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            # Блокируем запись сразу, чтобы read-modify-write скетча не терял обновления
+            cursor.execute('BEGIN IMMEDIATE')
+            for dimension, value in dimensions:
+                cursor.execute('''
+                    SELECT sketch FROM visitor_sketches
+                    WHERE day = ? AND dimension = ? AND value = ?
+                ''', (day, dimension, str(value)))
+                row = cursor.fetchone()
+                sketch = HyperLogLog.from_bytes(row[0]) if row else HyperLogLog()
+
+                # Повторный визит обычно не меняет регистры — пропускаем запись
+                if sketch.add(cookie_id) or not row:
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO visitor_sketches (day, dimension, value, sketch, updated_at)
+                        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ''', (day, dimension, str(value), sketch.to_bytes()))
+
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении скетчей посетителей: {e}")
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+
+    def get_unique_visitors(self, start_date: str = None, end_date: str = None,
+                            dimension: str = 'all', value: str = None) -> dict:
+        """Оценка уникальных посетителей за период по объединению дневных скетчей.
+
+        start_date/end_date — даты YYYY-MM-DD (по умолчанию последние 30 дней).
+        Для dimension != 'all' дополнительно возвращается разбивка по значениям.
+        """
+        if dimension not in VISITOR_DIMENSIONS:
+            raise ValueError(f"Неизвестное измерение: {dimension}")
+
+        end = datetime.strptime(end_date, '%Y-%m-%d') if end_date else datetime.utcnow()
+        start = datetime.strptime(start_date, '%Y-%m-%d') if start_date else end - timedelta(days=29)
+        start_day, end_day = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+        sql = '''
+            SELECT value, sketch FROM visitor_sketches
+            WHERE dimension = ? AND day BETWEEN ? AND ?
+        '''
+        params = [dimension, start_day, end_day]
+        if value is not None:
+            sql += ' AND value = ?'
+            params.append(str(value))
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        total = HyperLogLog()
+        by_value: Dict[str, HyperLogLog] = {}
+        for row in rows:
+            sketch = HyperLogLog.from_bytes(row['sketch'])
+            row_value = row['value']
+            total.merge(sketch)
+            if row_value in by_value:
+                by_value[row_value].merge(sketch)
+            else:
+                by_value[row_value] = sketch
+
+        result = {
+            'dimension': dimension,
+            'start_date': start_day,
+            'end_date': end_day,
+            'unique_visitors': total.count(),
+            'relative_error': round(total.relative_error, 4)
+        }
+        if dimension != 'all':
+            result['breakdown'] = sorted(
+                ({'value': v, 'unique_visitors': s.count()} for v, s in by_value.items()),
+                key=lambda x: x['unique_visitors'],
+                reverse=True
+            )
+        return result
+
+    # =============== МЕТОДЫ СЕГМЕНТАЦИИ ПОЛЬЗОВАТЕЛЕЙ ===============
+
+    def get_user_segment(self, tg_user_id: int) -> dict:
+        """Определить сегмент пользователя на основе его действий"""
+        analytics = self.get_user_analytics(tg_user_id)
+        segment = self._classify_segment(analytics)
 
         # Анализ предпочтений контента
         content_prefs = self._analyze_content_preferences(tg_user_id)
@@ -1545,71 +2788,509 @@ class Database:
 
         return segment
 
+    @staticmethod
+    def _classify_segment(analytics: dict) -> dict:
+        """Сегмент, вовлеченность и потенциал конверсии по агрегатам пользователя"""
+        segment = {
+            'segment': 'newcomer',  # newcomer, engaged, converter, loyal
+            'engagement_level': 'low',  # low, medium, high
+            'conversion_potential': 'unknown',  # low, medium, high, converted
+            'content_preference': [],  # список предпочитаемых типов контента
+            'behavior_patterns': [],  # паттерны поведения
+            'last_activity': analytics.get('last_session'),
+            'total_sessions': analytics.get('total_sessions', 0),
+            'diagnostics_completed': analytics.get('diagnostics_completed', False)
+        }
+
+        # Логика сегментации
+        sessions = analytics.get('total_sessions', 0)
+        events = analytics.get('total_events', 0)
+        has_diagnostic = analytics.get('diagnostics_completed', False)
+
+        # Определение уровня вовлеченности
+        if sessions >= 10 and events >= 50:
+            segment['engagement_level'] = 'high'
+            segment['segment'] = 'loyal'
+        elif sessions >= 3 and events >= 15:
+            segment['engagement_level'] = 'medium'
+            segment['segment'] = 'engaged'
+        elif sessions >= 1:
+            segment['engagement_level'] = 'low'
+            if has_diagnostic:
+                segment['segment'] = 'converter'
+
+        # Определение потенциала конверсии
+        if has_diagnostic:
+            segment['conversion_potential'] = 'converted'
+        elif events >= 10 and sessions >= 2:
+            segment['conversion_potential'] = 'high'
+        elif events >= 5:
+            segment['conversion_potential'] = 'medium'
+        else:
+            segment['conversion_potential'] = 'low'
+
+        return segment
+
     def _analyze_content_preferences(self, tg_user_id: int) -> list:
         """Анализ предпочтений контента пользователя"""
+        return self.get_content_preferences_batch([tg_user_id]).get(tg_user_id, [])
+
+    def get_content_preferences_batch(self, tg_user_ids: List[int]) -> Dict[int, list]:
+        """Предпочтения контента сразу для многих пользователей.
+
+        Читает счетчики user_preference_counters (обновляются при записи просмотров
+        контента и AI взаимодействий): топ-3 типа контента и топ-2 типа разговоров.
+        """
+        tg_user_ids = list(dict.fromkeys(uid for uid in tg_user_ids if uid is not None))
+        counters: Dict[int, Dict[str, list]] = {
+            uid: {'content_type': [], 'conversation_type': []} for uid in tg_user_ids
+        }
+
         conn = self.get_connection()
         cursor = conn.cursor()
 
-        preferences = []
+        try:
+            # Ограничиваем размер IN (...) — лимит параметров sqlite
+            for offset in range(0, len(tg_user_ids), 500):
+                chunk = tg_user_ids[offset:offset + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                    SELECT tg_user_id, kind, value
+                    FROM user_preference_counters
+                    WHERE tg_user_id IN ({placeholders})
+                    ORDER BY tg_user_id, kind, count DESC, value
+                ''', chunk)
+                for row in cursor.fetchall():
+                    counters[row[0]][row[1]].append(row[2])
+        except Exception as e:
+            logger.error(f"Ошибка при анализе предпочтений контента: {e}")
+        finally:
+            conn.close()
+
+        preferences = {}
+        for uid, kinds in counters.items():
+            preferences[uid] = (
+                [f"likes_{ctype}" for ctype in kinds['content_type'][:3]] +
+                [f"ai_{ai_type}" for ai_type in kinds['conversation_type'][:2]]
+            )
+        return preferences
+
+    def get_segments_batch(self, tg_user_ids: List[int], include_preferences: bool = True) -> Dict[int, dict]:
+        """Сегменты сразу для многих пользователей: сгруппированные запросы вместо get_user_segment на каждого.
 
+        Возвращает то же, что _classify_segment, плюс content_preference, если include_preferences
+        (behavior_patterns не заполняется).
+        """
+        tg_user_ids = list(dict.fromkeys(uid for uid in tg_user_ids if uid is not None))
+        analytics = {
+            uid: {'total_sessions': 0, 'total_events': 0, 'last_session': None, 'diagnostics_completed': False}
+            for uid in tg_user_ids
+        }
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
         try:
-            if self.use_postgres:
-                with self.engine.connect() as conn:
-                    rows = conn.execute(text('''
-                        SELECT content_type, COUNT(*) as views
-                        FROM content_views
-                        WHERE tg_user_id = :tg
-                        GROUP BY content_type
-                        ORDER BY views DESC
-                        LIMIT 3
-                    '''), {'tg': tg_user_id}).fetchall()
-                    content_types = [r[0] for r in rows]
+            for offset in range(0, len(tg_user_ids), 500):
+                chunk = tg_user_ids[offset:offset + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                    SELECT tg_user_id, COUNT(*) AS total_sessions, MAX(session_start) AS last_session
+                    FROM site_sessions WHERE tg_user_id IN ({placeholders}) GROUP BY tg_user_id
+                ''', chunk)
+                for row in cursor.fetchall():
+                    analytics[row['tg_user_id']]['total_sessions'] = int(row['total_sessions'])
+                    analytics[row['tg_user_id']]['last_session'] = row['last_session']
 
-                    rows = conn.execute(text('''
-                        SELECT conversation_type, COUNT(*) as interactions
-                        FROM ai_interactions
-                        WHERE tg_user_id = :tg
-                        GROUP BY conversation_type
-                        ORDER BY interactions DESC
-                        LIMIT 2
-                    '''), {'tg': tg_user_id}).fetchall()
-                    ai_types = [r[0] for r in rows]
+                cursor.execute(f'''
+                    SELECT tg_user_id, COUNT(*) AS total_events
+                    FROM site_events WHERE tg_user_id IN ({placeholders}) GROUP BY tg_user_id
+                ''', chunk)
+                for row in cursor.fetchall():
+                    analytics[row['tg_user_id']]['total_events'] = int(row['total_events'])
+
+                cursor.execute(f'''
+                    SELECT DISTINCT tg_user_id FROM diagnostics_results WHERE tg_user_id IN ({placeholders})
+                ''', chunk)
+                for row in cursor.fetchall():
+                    analytics[row['tg_user_id']]['diagnostics_completed'] = True
+        finally:
+            conn.close()
+
+        preferences = self.get_content_preferences_batch(tg_user_ids) if include_preferences else {}
+        segments = {}
+        for uid, user_analytics in analytics.items():
+            segment = self._classify_segment(user_analytics)
+            segment['content_preference'] = preferences.get(uid, [])
+            segments[uid] = segment
+        return segments
+
+    def save_user_segments(self, segments: Dict[int, dict], versions: Dict[int, int] = None) -> bool:
+        """Сохранить рассчитанные сегменты в user_segments и записать смены сегмента в user_segment_history.
+
+        versions — версии данных пользователей (user_data_versions), прочитанные до расчета;
+        без них сохраняется -1, и сегмент будет пересчитан следующим инкрементальным проходом.
+        """
+        versions = versions or {}
+        upsert_sql = '''
+            INSERT INTO user_segments
+                (tg_user_id, segment, engagement_level, conversion_potential, diagnostics_completed,
+                 data_version, updated_at)
+            VALUES (:tg, :segment, :engagement, :potential, :diagnostics, :version, CURRENT_TIMESTAMP)
+            ON CONFLICT (tg_user_id) DO UPDATE SET
+                segment = excluded.segment,
+                engagement_level = excluded.engagement_level,
+                conversion_potential = excluded.conversion_potential,
+                diagnostics_completed = excluded.diagnostics_completed,
+                data_version = excluded.data_version,
+                updated_at = CURRENT_TIMESTAMP
+        '''
+        history_sql = '''
+            INSERT INTO user_segment_history
+                (tg_user_id, previous_segment, segment, previous_engagement_level, engagement_level, data_version)
+            VALUES (:tg, :previous_segment, :segment, :previous_engagement, :engagement, :version)
+        '''
+        params = [{
+            'tg': tg_user_id,
+            'segment': segment['segment'],
+            'engagement': segment['engagement_level'],
+            'potential': segment.get('conversion_potential'),
+            'diagnostics': bool(segment.get('diagnostics_completed')),
+            'version': versions.get(tg_user_id, -1)
+        } for tg_user_id, segment in segments.items()]
+        if not params:
+            return True
+
+        def save(run, executemany):
+            for offset in range(0, len(params), 500):
+                chunk = params[offset:offset + 500]
+                ids = {f'id{i}': item['tg'] for i, item in enumerate(chunk)}
+                previous = {row[0]: (row[1], row[2]) for row in run(
+                    f"SELECT tg_user_id, segment, engagement_level FROM user_segments "
+                    f"WHERE tg_user_id IN ({', '.join(':' + key for key in ids)})", ids)}
+
+                changes = []
+                for item in chunk:
+                    old_segment, old_engagement = previous.get(item['tg'], (None, None))
+                    if (old_segment, old_engagement) != (item['segment'], item['engagement']):
+                        changes.append(dict(item, previous_segment=old_segment, previous_engagement=old_engagement))
+                if changes:
+                    executemany(history_sql, changes)
+                executemany(upsert_sql, chunk)
+
+        try:
+            if self.use_postgres:
+                with self.engine.begin() as conn:
+                    save(self._pg_runner(conn), lambda sql, rows: conn.execute(text(sql), rows))
             else:
-                # sqlite path
-                cursor.execute('''
-                    SELECT content_type, COUNT(*) as views
-                    FROM content_views
-                    WHERE tg_user_id = ?
-                    GROUP BY content_type
-                    ORDER BY views DESC
-                    LIMIT 3
-                ''', (tg_user_id,))
-                content_types = [row[0] for row in cursor.fetchall()]
+                conn = self.get_connection()
+                try:
+                    cursor = conn.cursor()
+                    save(self._sqlite_runner(cursor), cursor.executemany)
+                    conn.commit()
+                finally:
+                    conn.close()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении сегментов: {e}")
+            return False
 
+    def get_user_data_versions(self, tg_user_ids: List[int]) -> Dict[int, int]:
+        """Версии данных пользователей (0 — данных еще не было)"""
+        versions = {uid: 0 for uid in tg_user_ids}
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            for offset in range(0, len(tg_user_ids), 500):
+                chunk = tg_user_ids[offset:offset + 500]
+                placeholders = ', '.join('?' for _ in chunk)
+                cursor.execute(f'''
+                    SELECT tg_user_id, version FROM user_data_versions WHERE tg_user_id IN ({placeholders})
+                ''', chunk)
+                for row in cursor.fetchall():
+                    versions[row['tg_user_id']] = int(row['version'])
+        finally:
+            conn.close()
+        return versions
+
+    def iter_dirty_segment_users(self, chunk_size: int = 500):
+        """Порции {tg_user_id: version} пользователей, данные которых изменились с прошлого расчета сегмента.
+
+        «Грязные» пользователи — те, у кого user_data_versions.version (увеличивается при каждой
+        записи событий, сессий и диагностики) не совпадает с user_segments.data_version.
+        Пользователи из users без строки в user_segments тоже грязные (версия 0, если данных
+        не было): так сегмент получают все пользователи, включая накопивших данные до
+        появления версий.
+        """
+        after = 0
+        while True:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            try:
                 cursor.execute('''
-                    SELECT conversation_type, COUNT(*) as interactions
-                    FROM ai_interactions
-                    WHERE tg_user_id = ?
-                    GROUP BY conversation_type
-                    ORDER BY interactions DESC
-                    LIMIT 2
-                ''', (tg_user_id,))
-                ai_types = [row[0] for row in cursor.fetchall()]
+                    SELECT d.tg_user_id, d.version
+                    FROM (
+                        SELECT tg_user_id, version FROM user_data_versions
+                        UNION ALL
+                        SELECT u.user_id, 0 FROM users u
+                        WHERE NOT EXISTS (SELECT 1 FROM user_data_versions v WHERE v.tg_user_id = u.user_id)
+                    ) d
+                    LEFT JOIN user_segments s ON s.tg_user_id = d.tg_user_id
+                    WHERE d.tg_user_id > ? AND (s.tg_user_id IS NULL OR s.data_version <> d.version)
+                    ORDER BY d.tg_user_id
+                    LIMIT ?
+                ''', (after, chunk_size))
+                versions = {row['tg_user_id']: int(row['version']) for row in cursor.fetchall()}
+            finally:
+                conn.close()
+            if not versions:
+                return
+            after = max(versions)
+            yield versions
 
-            if content_types:
-                preferences.extend([f"likes_{ctype}" for ctype in content_types])
-            if ai_types:
-                preferences.extend([f"ai_{ai_type}" for ai_type in ai_types])
+    def refresh_dirty_segments(self, chunk_size: int = 500) -> Dict[str, Any]:
+        """Пересчитать сегменты только у «грязных» пользователей (см. iter_dirty_segment_users).
 
-        except Exception as e:
-            logger.error(f"Ошибка при анализе предпочтений контента: {e}")
+        Смены сегмента записываются в user_segment_history.
+        """
+        result = {'processed': 0, 'segments': {}}
+        for versions in self.iter_dirty_segment_users(chunk_size):
+            segments = self.get_segments_batch(list(versions), include_preferences=False)
+            if not self.save_user_segments(segments, versions):
+                break
+            result['processed'] += len(segments)
+            for segment in segments.values():
+                result['segments'][segment['segment']] = result['segments'].get(segment['segment'], 0) + 1
+
+        logger.info(f"Инкрементальная сегментация: пересчитано {result['processed']} пользователей")
+        return result
+
+    def get_segment_history(self, tg_user_id: int, limit: int = 50) -> List[dict]:
+        """Смены сегмента пользователя, новые первыми"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT previous_segment, segment, previous_engagement_level, engagement_level,
+                       data_version, changed_at
+                FROM user_segment_history
+                WHERE tg_user_id = ?
+                ORDER BY changed_at DESC, id DESC
+                LIMIT ?
+            ''', (tg_user_id, limit))
+            return [dict(row) for row in cursor.fetchall()]
         finally:
+            conn.close()
+
+    def iter_user_ids(self, chunk_size: int = 500):
+        """Все user_id из users порциями по возрастанию (keyset по первичному ключу)"""
+        after = None
+        while True:
+            conn = self.get_connection()
+            cursor = conn.cursor()
             try:
+                if after is None:
+                    cursor.execute('SELECT user_id FROM users ORDER BY user_id LIMIT ?', (chunk_size,))
+                else:
+                    cursor.execute('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                                   (after, chunk_size))
+                ids = [row['user_id'] for row in cursor.fetchall()]
+            finally:
                 conn.close()
-            except Exception:
-                pass
+            if not ids:
+                return
+            after = ids[-1]
+            yield ids
 
-        return preferences
+    def save_segment_snapshot(self, segment_counts: Dict[str, int], users_count: int,
+                              duration_ms: int = None) -> Optional[int]:
+        """Записать снимок сегментации; возвращает id снимка"""
+        params = {'users': users_count, 'counts': json.dumps(segment_counts), 'duration': duration_ms}
+        try:
+            if self.use_postgres:
+                with self.engine.begin() as conn:
+                    row = conn.execute(text('''
+                        INSERT INTO segment_snapshots (users_count, segment_counts, duration_ms)
+                        VALUES (:users, :counts, :duration)
+                        RETURNING id
+                    '''), params).fetchone()
+                    return int(row[0])
+
+            conn = self.get_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO segment_snapshots (users_count, segment_counts, duration_ms)
+                    VALUES (:users, :counts, :duration)
+                ''', params)
+                conn.commit()
+                return cursor.lastrowid
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении снимка сегментов: {e}")
+            return None
+
+    # Участники сегментов: пользователи из users с их строкой user_segments. Общее определение
+    # для get_segment_memberships (снимок), get_segment_insights и выборки рассылок
+    SEGMENT_MEMBERS_SQL = '''
+        SELECT s.tg_user_id, s.segment, s.engagement_level, s.conversion_potential, s.diagnostics_completed
+        FROM users u
+        JOIN user_segments s ON s.tg_user_id = u.user_id
+    '''
+
+    def get_segment_memberships(self) -> Dict[int, dict]:
+        """Сегмент и статус диагностики всех пользователей из users одним чтением user_segments.
+
+        Пользователям без строки в user_segments (например, появившимся после последнего
+        пересчета) сегмент рассчитывается по их данным и сохраняется; новичком без диагностики
+        такой пользователь становится, только если данных у него действительно нет.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT u.user_id, s.segment, s.diagnostics_completed
+                FROM users u
+                LEFT JOIN user_segments s ON s.tg_user_id = u.user_id
+                ORDER BY u.user_id
+            ''')
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        memberships = {}
+        missing = []
+        for row in rows:
+            if row['segment'] is None:
+                missing.append(row['user_id'])
+            memberships[row['user_id']] = {'segment': row['segment'],
+                                           'diagnostics_completed': bool(row['diagnostics_completed'])}
+
+        for offset in range(0, len(missing), 500):
+            chunk = missing[offset:offset + 500]
+            # Версии читаются до расчета: запись, пришедшая во время расчета, оставит пользователя «грязным»
+            versions = self.get_user_data_versions(chunk)
+            segments = self.get_segments_batch(chunk, include_preferences=False)
+            self.save_user_segments(segments, versions)
+            for user_id, segment in segments.items():
+                memberships[user_id] = {'segment': segment['segment'],
+                                        'diagnostics_completed': bool(segment['diagnostics_completed'])}
+        return memberships
+
+    def get_segment_insights(self, segment: str) -> dict:
+        """Аналитика по всем пользователям сегмента фиксированным числом сгруппированных запросов.
+
+        Принадлежность к сегменту — SEGMENT_MEMBERS_SQL (пользователи из users и их строка
+        user_segments, как в get_segment_memberships); агрегаты считаются соединением с ней,
+        поэтому число запросов не зависит от размера сегмента.
+        """
+        insights = {
+            'avg_sessions': 0,
+            'avg_events': 0,
+            'conversion_rate': 0,
+            'top_sources': [],
+            'top_content_types': [],
+            'engagement_distribution': {},
+            'behavior_patterns': []
+        }
+
+        members = self.SEGMENT_MEMBERS_SQL
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'''
+                SELECT engagement_level, COUNT(*) AS users,
+                       SUM(CASE WHEN diagnostics_completed THEN 1 ELSE 0 END) AS converted
+                FROM ({members}) us
+                WHERE segment = ?
+                GROUP BY engagement_level
+            ''', (segment,))
+            users_count = converted = 0
+            for row in cursor.fetchall():
+                insights['engagement_distribution'][row['engagement_level']] = int(row['users'])
+                users_count += int(row['users'])
+                converted += int(row['converted'] or 0)
+
+            if not users_count:
+                return {'segment': segment, 'users_count': 0, 'insights': {}}
+
+            cursor.execute(f'''
+                SELECT COUNT(*) AS total FROM site_sessions ss
+                JOIN ({members}) us ON us.tg_user_id = ss.tg_user_id
+                WHERE us.segment = ?
+            ''', (segment,))
+            total_sessions = int(cursor.fetchone()['total'])
+
+            cursor.execute(f'''
+                SELECT COUNT(*) AS total FROM site_events se
+                JOIN ({members}) us ON us.tg_user_id = se.tg_user_id
+                WHERE us.segment = ?
+            ''', (segment,))
+            total_events = int(cursor.fetchone()['total'])
+
+            # Основной источник пользователя — самый частый source его сессий
+            cursor.execute(f'''
+                SELECT source, COUNT(*) AS users
+                FROM (
+                    SELECT ss.tg_user_id, ss.source,
+                           ROW_NUMBER() OVER (PARTITION BY ss.tg_user_id
+                                              ORDER BY COUNT(*) DESC, MAX(ss.session_start) DESC) AS rn
+                    FROM site_sessions ss
+                    JOIN ({members}) us ON us.tg_user_id = ss.tg_user_id
+                    WHERE us.segment = ? AND ss.source IS NOT NULL
+                    GROUP BY ss.tg_user_id, ss.source
+                ) main_sources
+                WHERE rn = 1
+                GROUP BY source
+                ORDER BY users DESC, source
+            ''', (segment,))
+            patterns: Dict[str, int] = {}
+            for row in cursor.fetchall():
+                patterns[f"source_{row['source']}"] = int(row['users'])
+            insights['top_sources'] = list(patterns.items())[:5]
+
+            # Топ-3 типа контента каждого пользователя, как в get_content_preferences_batch
+            cursor.execute(f'''
+                SELECT value, COUNT(*) AS users
+                FROM (
+                    SELECT upc.value,
+                           ROW_NUMBER() OVER (PARTITION BY upc.tg_user_id
+                                              ORDER BY upc.count DESC, upc.value) AS rn
+                    FROM user_preference_counters upc
+                    JOIN ({members}) us ON us.tg_user_id = upc.tg_user_id
+                    WHERE us.segment = ? AND upc.kind = 'content_type'
+                ) ranked
+                WHERE rn <= 3
+                GROUP BY value
+                ORDER BY users DESC, value
+                LIMIT 5
+            ''', (segment,))
+            insights['top_content_types'] = [(f"likes_{row['value']}", int(row['users'])) for row in cursor.fetchall()]
+
+            # Паттерны времени активности и частоты визитов — по профилям активности
+            cursor.execute(f'''
+                SELECT p.hour_histogram, p.sessions_count, p.first_session_at
+                FROM user_activity_profiles p
+                JOIN ({members}) us ON us.tg_user_id = p.tg_user_id
+                WHERE us.segment = ?
+            ''', (segment,))
+            for row in cursor.fetchall():
+                profile = {
+                    'hour_histogram': _unpack_hour_histogram(row['hour_histogram']),
+                    'sessions_count': row['sessions_count'],
+                    'first_session_at': row['first_session_at']
+                }
+                for pattern in _activity_patterns(profile):
+                    patterns[pattern] = patterns.get(pattern, 0) + 1
+        finally:
+            conn.close()
+
+        insights['avg_sessions'] = total_sessions / users_count
+        insights['avg_events'] = total_events / users_count
+        insights['conversion_rate'] = converted / users_count
+        insights['behavior_patterns'] = sorted(patterns.items(), key=lambda x: x[1], reverse=True)[:10]
+
+        return {'segment': segment, 'users_count': users_count, 'insights': insights}
 
     def _analyze_behavior_patterns(self, tg_user_id: int) -> list:
         """Анализ паттернов поведения пользователя"""
@@ -1642,45 +3323,6 @@ class Database:
                     if sources:
                         main_source = max(set(sources), key=sources.count)
                         patterns.append(f"source_{main_source}")
-
-                    # Время активности
-                    tp = conn.execute(text('''
-                        SELECT EXTRACT(HOUR FROM created_at) as hour, COUNT(*) as events
-                        FROM site_events
-                        WHERE tg_user_id = :tg
-                        GROUP BY hour
-                        ORDER BY events DESC
-                        LIMIT 1
-                    '''), {'tg': tg_user_id}).fetchone()
-                    if tp:
-                        hour = int(tp[0])
-                        if 6 <= hour <= 12:
-                            patterns.append("active_morning")
-                        elif 12 <= hour <= 18:
-                            patterns.append("active_afternoon")
-                        elif 18 <= hour <= 22:
-                            patterns.append("active_evening")
-                        else:
-                            patterns.append("active_night")
-
-                    # Частота сессий
-                    freq = conn.execute(text('''
-                        SELECT COUNT(*) as sessions,
-                               EXTRACT(EPOCH FROM (now() - MIN(session_start)))/86400.0 as days_active
-                        FROM site_sessions
-                        WHERE tg_user_id = :tg AND session_start IS NOT NULL
-                    '''), {'tg': tg_user_id}).fetchone()
-                    if freq and freq[1] and float(freq[1]) > 0:
-                        sessions = int(freq[0])
-                        days = float(freq[1])
-                        session_frequency = sessions / days
-                        if session_frequency >= 1:
-                            patterns.append("frequent_visitor")
-                        elif session_frequency >= 0.3:
-                            patterns.append("regular_visitor")
-                        else:
-                            patterns.append("occasional_visitor")
-
             else:
                 # sqlite path
                 cursor.execute('''
@@ -1705,48 +3347,8 @@ class Database:
                     main_source = max(set(sources), key=sources.count)
                     patterns.append(f"source_{main_source}")
 
-                # Время активности
-                cursor.execute('''
-                    SELECT strftime('%H', created_at) as hour, COUNT(*) as events
-                    FROM site_events
-                    WHERE tg_user_id = ?
-                    GROUP BY hour
-                    ORDER BY events DESC
-                    LIMIT 1
-                ''', (tg_user_id,))
-
-                time_pattern = cursor.fetchone()
-                if time_pattern:
-                    hour = int(time_pattern[0])
-                    if 6 <= hour <= 12:
-                        patterns.append("active_morning")
-                    elif 12 <= hour <= 18:
-                        patterns.append("active_afternoon")
-                    elif 18 <= hour <= 22:
-                        patterns.append("active_evening")
-                    else:
-                        patterns.append("active_night")
-
-                # Частота сессий
-                cursor.execute('''
-                    SELECT COUNT(*) as sessions,
-                           julianday('now') - julianday(MIN(session_start)) as days_active
-                    FROM site_sessions
-                    WHERE tg_user_id = ? AND session_start IS NOT NULL
-                ''', (tg_user_id,))
-
-                frequency_data = cursor.fetchone()
-                if frequency_data and frequency_data[1] > 0:
-                    sessions = frequency_data[0]
-                    days = frequency_data[1]
-                    session_frequency = sessions / days
-
-                    if session_frequency >= 1:
-                        patterns.append("frequent_visitor")
-                    elif session_frequency >= 0.3:
-                        patterns.append("regular_visitor")
-                    else:
-                        patterns.append("occasional_visitor")
+            # Время активности и частота сессий — из инкрементального профиля, без сканирования событий
+            patterns.extend(_activity_patterns(self.get_activity_profile(tg_user_id)))
 
         except Exception as e:
             logger.error(f"Ошибка при анализе паттернов поведения: {e}")
@@ -1758,6 +3360,130 @@ class Database:
 
         return patterns
 
+    # =============== ПРЕДРАСЧИТАННЫЕ РЕКОМЕНДАЦИИ ===============
+
+    @staticmethod
+    def _recommendations_payload(tg_user_id: int, segment: dict, actions: dict) -> dict:
+        """Ответ get_personalized_recommendations по сегменту и результату ACTION_RULESET"""
+        return {
+            'user_id': tg_user_id,
+            'segment': segment['segment'],
+            'engagement_level': segment['engagement_level'],
+            'recommendations': actions['recommendations'],
+            'next_best_actions': actions['next_best_actions'],
+            'content_suggestions': actions['content_suggestions']
+        }
+
+    def get_user_recommendations(self, tg_user_id: int) -> dict:
+        """Рекомендации пользователя: сохраненные, если они рассчитаны для текущей версии данных,
+        иначе расчет по таблице правил с сохранением"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT r.segment, r.engagement_level, r.recommendations, r.data_version,
+                       COALESCE(v.version, 0) AS current_version
+                FROM user_recommendations r
+                LEFT JOIN user_data_versions v ON v.tg_user_id = r.tg_user_id
+                WHERE r.tg_user_id = ?
+            ''', (tg_user_id,))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+
+        if row and row['data_version'] == row['current_version']:
+            actions = self._json_field(row['recommendations'])
+            return self._recommendations_payload(
+                tg_user_id, {'segment': row['segment'], 'engagement_level': row['engagement_level']}, actions)
+
+        version = self.get_user_data_version(tg_user_id)
+        segment = self.get_segments_batch([tg_user_id])[tg_user_id]
+        actions = ACTION_RULESET.evaluate(segment)
+        self._save_user_recommendations([(tg_user_id, segment, actions, version)])
+        return self._recommendations_payload(tg_user_id, segment, actions)
+
+    def refresh_user_recommendations(self, chunk_size: int = 500) -> int:
+        """Пересчитать рекомендации пользователей, чьи данные изменились с прошлого расчета.
+
+        Устаревшие определяются сравнением user_recommendations.data_version с user_data_versions;
+        сегменты считаются пакетно (get_segments_batch), правила — ACTION_RULESET.evaluate_many.
+        Возвращает число обновленных пользователей.
+        """
+        stale_sql = '''
+            SELECT v.tg_user_id, v.version
+            FROM user_data_versions v
+            LEFT JOIN user_recommendations r ON r.tg_user_id = v.tg_user_id
+            WHERE v.tg_user_id > ? AND (r.tg_user_id IS NULL OR r.data_version <> v.version)
+            ORDER BY v.tg_user_id
+            LIMIT ?
+        '''
+        refreshed = 0
+        after = 0
+        while True:
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            try:
+                cursor.execute(stale_sql, (after, chunk_size))
+                versions = {row['tg_user_id']: row['version'] for row in cursor.fetchall()}
+            except Exception as e:
+                logger.error(f"Ошибка при поиске устаревших рекомендаций: {e}")
+                return refreshed
+            finally:
+                conn.close()
+
+            if not versions:
+                break
+            after = max(versions)
+
+            segments = self.get_segments_batch(list(versions))
+            actions = ACTION_RULESET.evaluate_many(segments.items())
+            if not self._save_user_recommendations(
+                    [(uid, segments[uid], actions[uid], versions[uid]) for uid in versions]):
+                break
+            refreshed += len(versions)
+
+        logger.info(f"Рекомендации обновлены для {refreshed} пользователей")
+        return refreshed
+
+    def _save_user_recommendations(self, rows: List[tuple]) -> bool:
+        """Сохранить рекомендации: строки (tg_user_id, segment, actions, data_version)"""
+        sql = '''
+            INSERT INTO user_recommendations
+                (tg_user_id, segment, engagement_level, recommendations, data_version, updated_at)
+            VALUES (:tg, :segment, :engagement, :recommendations, :version, CURRENT_TIMESTAMP)
+            ON CONFLICT (tg_user_id) DO UPDATE SET
+                segment = excluded.segment,
+                engagement_level = excluded.engagement_level,
+                recommendations = excluded.recommendations,
+                data_version = excluded.data_version,
+                updated_at = CURRENT_TIMESTAMP
+        '''
+        params = [{
+            'tg': tg_user_id,
+            'segment': segment['segment'],
+            'engagement': segment['engagement_level'],
+            'recommendations': json.dumps(actions, ensure_ascii=False),
+            'version': version
+        } for tg_user_id, segment, actions, version in rows]
+        if not params:
+            return True
+
+        try:
+            if self.use_postgres:
+                with self.engine.begin() as conn:
+                    conn.execute(text(sql), params)
+            else:
+                conn = self.get_connection()
+                try:
+                    conn.executemany(sql, params)
+                    conn.commit()
+                finally:
+                    conn.close()
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении рекомендаций: {e}")
+            return False
+
     def get_segment_users(self, segment_criteria: dict) -> List[int]:
         """Получить пользователей по критериям сегмента"""
         conn = self.get_connection()
@@ -1868,3 +3594,626 @@ class Database:
             conn.close()
 
         return funnel
+
+    def get_funnel(self, steps: List[FunnelStep], window_seconds: int = DEFAULT_WINDOW_SECONDS,
+                   start_date: str = None, end_date: str = None) -> dict:
+        """Произвольная воронка по site_events за один потоковый проход.
+
+        Из базы читаются только события, подходящие хотя бы под один шаг,
+        в порядке (tg_user_id, created_at) — по индексу idx_site_events_user_created.
+        start_date/end_date — даты YYYY-MM-DD (UTC), end_date включительно.
+        """
+        engine = FunnelEngine(steps, window_seconds)
+
+        end = datetime.strptime(end_date, '%Y-%m-%d') if end_date else datetime.utcnow()
+        start = datetime.strptime(start_date, '%Y-%m-%d') if start_date else end - timedelta(days=29)
+        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = end.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+        if self.use_postgres:
+            ts_expr = 'CAST(EXTRACT(EPOCH FROM created_at) AS DOUBLE PRECISION)'
+            cta_expr = "custom_data->>'cta_location'"
+        else:
+            ts_expr = '(julianday(created_at) - 2440587.5) * 86400.0'
+            cta_expr = "json_extract(custom_data, '$.cta_location')"
+
+        params: Dict[str, Any] = {}
+        predicates = []
+        for i, step in enumerate(steps):
+            conditions = []
+            for field, value in step.conditions.items():
+                column = cta_expr if field == 'cta_location' else field
+                params[f's{i}_{field}'] = value
+                conditions.append(f'{column} = :s{i}_{field}')
+            predicates.append('(' + ' AND '.join(conditions) + ')')
+
+        sql = f'''
+            SELECT tg_user_id, {ts_expr} AS ts, event_type, event_name, section, {cta_expr} AS cta_location
+            FROM site_events
+            WHERE tg_user_id IS NOT NULL
+              AND created_at >= :start AND created_at < :end
+              AND ({' OR '.join(predicates)})
+            ORDER BY tg_user_id, created_at, id
+        '''
+
+        try:
+            if self.use_postgres:
+                params.update({'start': start, 'end': end})
+                with self.engine.connect() as conn:
+                    result = conn.execution_options(stream_results=True, yield_per=5000).execute(text(sql), params)
+                    report = engine.evaluate(result)
+            else:
+                params.update({'start': start.strftime('%Y-%m-%d %H:%M:%S'),
+                               'end': end.strftime('%Y-%m-%d %H:%M:%S')})
+                conn = self.get_connection()
+                try:
+                    report = engine.evaluate(conn.execute(sql, params))
+                finally:
+                    conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при расчете воронки: {e}")
+            return {}
+
+        report['start_date'] = start.strftime('%Y-%m-%d')
+        report['end_date'] = (end - timedelta(days=1)).strftime('%Y-%m-%d')
+        return report
+
+    # =============== АТРИБУЦИЯ ИСТОЧНИКОВ ===============
+
+    def backfill_session_attribution(self, chunk_size: int = 1000) -> int:
+        """Заполнить колонки источника/UTM в site_sessions из JSON старых событий source_visit.
+
+        События читаются порциями по id (keyset), каждая порция — отдельная транзакция.
+        Заполняются только пустые колонки, поэтому повторный запуск безопасен.
+        Возвращает количество обновленных сессий.
+        """
+        select_sql = '''
+            SELECT id, session_id, custom_data FROM site_events
+            WHERE event_name = 'source_visit' AND id > :last_id
+            ORDER BY id
+            LIMIT :chunk
+        '''
+        updated = set()
+        last_id = 0
+
+        while True:
+            try:
+                if self.use_postgres:
+                    with self.engine.begin() as conn:
+                        rows = conn.execute(text(select_sql), {'last_id': last_id, 'chunk': chunk_size}).fetchall()
+                        updated |= self._apply_visit_attribution(
+                            rows, lambda sql, params: conn.execute(text(sql), params).rowcount)
+                else:
+                    conn = self.get_connection()
+                    try:
+                        cursor = conn.cursor()
+                        rows = cursor.execute(select_sql, {'last_id': last_id, 'chunk': chunk_size}).fetchall()
+                        updated |= self._apply_visit_attribution(
+                            rows, lambda sql, params: cursor.execute(sql, params).rowcount)
+                        conn.commit()
+                    finally:
+                        conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка при заполнении атрибуции сессий (после события {last_id}): {e}")
+                break
+
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            logger.info(f"Атрибуция сессий: обработаны события до id {last_id}, обновлено сессий {len(updated)}")
+
+        return len(updated)
+
+    def _apply_visit_attribution(self, rows, execute) -> set:
+        """Записать атрибуцию из порции событий source_visit; возвращает id обновленных сессий"""
+        updated = set()
+        for row in rows:
+            visit_data = row[2]
+            if isinstance(visit_data, str):
+                try:
+                    visit_data = json.loads(visit_data)
+                except ValueError:
+                    continue
+            if not isinstance(visit_data, dict):
+                continue
+
+            sql, params = self._session_update(row[1], self._attribution_from_visit(visit_data), count_event=False)
+            if sql:
+                # Считаем только сессии, где была заполнена хотя бы одна пустая колонка
+                conditions = ' OR '.join(f'{field} IS NULL' for field in params if field != 'id')
+                if execute(f'{sql} AND ({conditions})', params) > 0:
+                    updated.add(row[1])
+        return updated
+
+    def get_source_attribution(self, start_date: str = None, end_date: str = None) -> dict:
+        """Сессии, диагностики и клики CTA по источнику и UTM кампании.
+
+        Использует только денормализованные колонки site_sessions и индексы по session_id,
+        без разбора JSON событий. Период — по началу сессии, end_date включительно.
+        """
+        start_day, end_day = self._day_range(start_date, end_date)
+        start = start_day + ' 00:00:00'
+        end = (datetime.strptime(end_day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
+
+        queries = {
+            'sessions': '''
+                SELECT source, utm_campaign, COUNT(*) AS total, COUNT(DISTINCT cookie_id) AS visitors
+                FROM site_sessions
+                WHERE session_start >= ? AND session_start < ?
+                GROUP BY source, utm_campaign
+            ''',
+            'diagnostics': '''
+                SELECT s.source, s.utm_campaign, COUNT(*) AS total
+                FROM site_sessions s
+                JOIN site_events e ON e.session_id = s.id
+                WHERE s.session_start >= ? AND s.session_start < ?
+                  AND e.event_type = 'diagnostic' AND e.event_name = 'diagnostic_completed'
+                GROUP BY s.source, s.utm_campaign
+            ''',
+            'cta_clicks': '''
+                SELECT s.source, s.utm_campaign, COUNT(*) AS total
+                FROM site_sessions s
+                JOIN cta_clicks c ON c.session_id = s.id
+                WHERE s.session_start >= ? AND s.session_start < ?
+                GROUP BY s.source, s.utm_campaign
+            ''',
+        }
+
+        groups: Dict[Tuple[str, str], dict] = {}
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            for metric, sql in queries.items():
+                cursor.execute(sql, (start, end))
+                for row in cursor.fetchall():
+                    key = (row['source'] or 'unknown', row['utm_campaign'] or '')
+                    group = groups.setdefault(key, {
+                        'source': key[0], 'utm_campaign': key[1] or None,
+                        'sessions': 0, 'visitors': 0, 'diagnostics': 0, 'cta_clicks': 0
+                    })
+                    group[metric] += int(row['total'])
+                    if metric == 'sessions':
+                        group['visitors'] += int(row['visitors'])
+        except Exception as e:
+            logger.error(f"Ошибка при получении атрибуции источников: {e}")
+        finally:
+            conn.close()
+
+        rows = sorted(groups.values(), key=lambda g: (-g['sessions'], g['source'], g['utm_campaign'] or ''))
+        for group in rows:
+            group['cta_conversion'] = round(group['cta_clicks'] / group['sessions'], 4) if group['sessions'] else 0.0
+
+        return {'start_date': start_day, 'end_date': end_day, 'attribution': rows}
+
+    # =============== НАВИГАЦИЯ: МАТРИЦА ПЕРЕХОДОВ И ПУТИ ===============
+
+    @staticmethod
+    def _day_range(start_date: str = None, end_date: str = None, days: int = 30) -> Tuple[str, str]:
+        """Диапазон дат YYYY-MM-DD (по умолчанию последние days дней)"""
+        end = datetime.strptime(end_date, '%Y-%m-%d') if end_date else datetime.utcnow()
+        start = datetime.strptime(start_date, '%Y-%m-%d') if start_date else end - timedelta(days=days - 1)
+        return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+    def update_navigation_stats(self, max_days: int = 31) -> Dict[str, int]:
+        """Инкрементально пересчитать навигацию по дням.
+
+        Обрабатываются дни после последнего завершенного (не более max_days за запуск);
+        текущий день пересчитывается при каждом запуске, пока не закончится.
+        """
+        stats = {'days_built': 0, 'events_processed': 0}
+        today = datetime.utcnow().date()
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT MAX(day) AS last_day FROM navigation_days WHERE is_complete = 1')
+            row = cursor.fetchone()
+            last_complete = row['last_day'] if row else None
+            if last_complete:
+                first_day = datetime.strptime(last_complete, '%Y-%m-%d').date() + timedelta(days=1)
+            else:
+                cursor.execute('SELECT MIN(created_at) AS first_event FROM site_events')
+                row = cursor.fetchone()
+                first_event = _parse_timestamp(row['first_event']) if row else None
+                if not first_event:
+                    return stats
+                first_day = first_event.date()
+        except Exception as e:
+            logger.error(f"Ошибка при определении дней для пересчета навигации: {e}")
+            return stats
+        finally:
+            conn.close()
+
+        day = first_day
+        while day <= today and stats['days_built'] < max_days:
+            events = self.build_navigation_day(day.strftime('%Y-%m-%d'), is_complete=day < today)
+            if events < 0:
+                break
+            stats['days_built'] += 1
+            stats['events_processed'] += events
+            day += timedelta(days=1)
+
+        logger.info(f"Навигация пересчитана: дней {stats['days_built']}, событий {stats['events_processed']}")
+        return stats
+
+    def build_navigation_day(self, day: str, is_complete: bool = False) -> int:
+        """Пересчитать переходы и пути за один день одним проходом по событиям.
+
+        Возвращает количество учтенных событий или -1 при ошибке.
+        """
+        start = datetime.strptime(day, '%Y-%m-%d')
+        end = start + timedelta(days=1)
+        cta_expr = "custom_data->>'cta_location'" if self.use_postgres else "json_extract(custom_data, '$.cta_location')"
+        sql = f'''
+            SELECT id, session_id, event_type, page, section, previous_event_id, {cta_expr} AS cta_location
+            FROM site_events
+            WHERE created_at >= :start AND created_at < :end
+            ORDER BY session_id, created_at, id
+        '''
+
+        accumulator = NavigationAccumulator()
+
+        def consume(rows):
+            for row in rows:
+                accumulator.add(row[1], row[0], event_node(row[2], row[3], row[4], row[6]), row[5])
+
+        transitions_sql = '''
+            INSERT INTO navigation_transitions (day, from_node, to_node, count)
+            VALUES (:day, :from_node, :to_node, :count)
+        '''
+        paths_sql = '''
+            INSERT INTO navigation_paths (day, kind, path, count)
+            VALUES (:day, :kind, :path, :count)
+        '''
+        day_sql = '''
+            INSERT INTO navigation_days (day, events_count, is_complete, built_at)
+            VALUES (:day, :events_count, :is_complete, CURRENT_TIMESTAMP)
+            ON CONFLICT (day) DO UPDATE SET events_count = excluded.events_count,
+                is_complete = excluded.is_complete, built_at = excluded.built_at
+        '''
+
+        try:
+            if self.use_postgres:
+                with self.engine.connect() as conn:
+                    consume(conn.execution_options(stream_results=True, yield_per=5000)
+                            .execute(text(sql), {'start': start, 'end': end}))
+            else:
+                conn = self.get_connection()
+                try:
+                    consume(conn.execute(sql, {'start': start.strftime('%Y-%m-%d %H:%M:%S'),
+                                               'end': end.strftime('%Y-%m-%d %H:%M:%S')}))
+                finally:
+                    conn.close()
+
+            transitions = [{'day': day, 'from_node': src, 'to_node': dst, 'count': count}
+                           for src, dst, count in accumulator.transition_rows()]
+            paths = [{'day': day, 'kind': kind, 'path': path, 'count': count}
+                     for kind, path, count in accumulator.path_rows()]
+            day_row = {'day': day, 'events_count': accumulator.events_count, 'is_complete': int(is_complete)}
+
+            if self.use_postgres:
+                with self.engine.begin() as conn:
+                    conn.execute(text('DELETE FROM navigation_transitions WHERE day = :day'), {'day': day})
+                    conn.execute(text('DELETE FROM navigation_paths WHERE day = :day'), {'day': day})
+                    if transitions:
+                        conn.execute(text(transitions_sql), transitions)
+                    if paths:
+                        conn.execute(text(paths_sql), paths)
+                    conn.execute(text(day_sql), day_row)
+            else:
+                conn = self.get_connection()
+                try:
+                    cursor = conn.cursor()
+                    cursor.execute('DELETE FROM navigation_transitions WHERE day = :day', {'day': day})
+                    cursor.execute('DELETE FROM navigation_paths WHERE day = :day', {'day': day})
+                    cursor.executemany(transitions_sql, transitions)
+                    cursor.executemany(paths_sql, paths)
+                    cursor.execute(day_sql, day_row)
+                    conn.commit()
+                finally:
+                    conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка при пересчете навигации за {day}: {e}")
+            return -1
+
+        return accumulator.events_count
+
+    def get_navigation_next(self, node: str, start_date: str = None, end_date: str = None,
+                            limit: int = 10) -> dict:
+        """Куда пользователи переходят из узла (по предрасчитанной матрице переходов)"""
+        start_day, end_day = self._day_range(start_date, end_date)
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT to_node, SUM(count) AS total
+                FROM navigation_transitions
+                WHERE from_node = ? AND day BETWEEN ? AND ?
+                GROUP BY to_node
+                ORDER BY total DESC, to_node
+            ''', (node, start_day, end_day))
+            rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при получении переходов навигации: {e}")
+            rows = []
+        finally:
+            conn.close()
+
+        total = sum(int(row['total']) for row in rows)
+        return {
+            'node': node,
+            'start_date': start_day,
+            'end_date': end_day,
+            'transitions_total': total,
+            'next': [
+                {'node': row['to_node'], 'count': int(row['total']), 'share': round(int(row['total']) / total, 4)}
+                for row in rows[:limit]
+            ]
+        }
+
+    def get_navigation_paths(self, kind: str = PATH_KIND_TO_CTA, start_date: str = None,
+                             end_date: str = None, limit: int = 10) -> dict:
+        """Самые частые пути (kind='path') или пути к клику по CTA (kind='to_cta')"""
+        if kind not in (PATH_KIND_ALL, PATH_KIND_TO_CTA):
+            raise ValueError(f"Неизвестный тип путей: {kind}")
+        start_day, end_day = self._day_range(start_date, end_date)
+
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT path, SUM(count) AS total
+                FROM navigation_paths
+                WHERE kind = ? AND day BETWEEN ? AND ?
+                GROUP BY path
+                ORDER BY total DESC, path
+                LIMIT ?
+            ''', (kind, start_day, end_day, limit))
+            rows = cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Ошибка при получении путей навигации: {e}")
+            rows = []
+        finally:
+            conn.close()
+
+        return {
+            'kind': kind,
+            'start_date': start_day,
+            'end_date': end_day,
+            'paths': [{'path': row['path'].split(PATH_SEPARATOR), 'count': int(row['total'])} for row in rows]
+        }
+
+    # =============== РАССЫЛКИ ПО СЕГМЕНТАМ ===============
+
+    # Критерии сегмента, по которым можно отбирать получателей (колонки user_segments)
+    BROADCAST_CRITERIA = ('segment', 'engagement_level', 'conversion_potential', 'diagnostics_completed')
+
+    def _in_transaction(self, work):
+        """Выполнить work(run) в одной транзакции на любом бэкенде и вернуть результат"""
+        if self.use_postgres:
+            with self.engine.begin() as conn:
+                return work(self._pg_runner(conn))
+        conn = self.get_connection()
+        try:
+            result = work(self._sqlite_runner(conn.cursor()))
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def create_broadcast_campaign(self, name: str, message_text: str,
+                                  segment_criteria: Dict[str, Any] = None) -> Optional[int]:
+        """Создать кампанию рассылки (идемпотентно по имени); возвращает id кампании"""
+        unknown = set(segment_criteria or {}) - set(self.BROADCAST_CRITERIA)
+        if unknown:
+            raise ValueError(f"Неизвестные критерии сегмента: {', '.join(sorted(unknown))}")
+        params = {'name': name, 'text': message_text,
+                  'criteria': json.dumps(segment_criteria or {}, ensure_ascii=False)}
+
+        def create(run):
+            run('''
+                INSERT INTO broadcast_campaigns (name, message_text, segment_criteria)
+                VALUES (:name, :text, :criteria)
+                ON CONFLICT (name) DO NOTHING
+            ''', params)
+            return int(run('SELECT id FROM broadcast_campaigns WHERE name = :name', params)[0][0])
+
+        try:
+            return self._in_transaction(create)
+        except Exception as e:
+            logger.error(f"Ошибка при создании кампании рассылки '{name}': {e}")
+            return None
+
+    def get_broadcast_campaign(self, campaign_id: int) -> Optional[dict]:
+        """Кампания рассылки по id"""
+        rows = self._in_transaction(lambda run: run('''
+            SELECT id, name, message_text, segment_criteria, status, created_at, completed_at
+            FROM broadcast_campaigns WHERE id = :id
+        ''', {'id': campaign_id}))
+        if not rows:
+            return None
+        row = rows[0]
+        return {
+            'id': row[0], 'name': row[1], 'message_text': row[2],
+            'segment_criteria': self._json_field(row[3]), 'status': row[4],
+            'created_at': row[5], 'completed_at': row[6],
+        }
+
+    def get_active_broadcast_campaigns(self) -> List[int]:
+        """id незавершенных кампаний рассылки по порядку создания"""
+        try:
+            rows = self._in_transaction(lambda run: run(
+                "SELECT id FROM broadcast_campaigns WHERE status = 'active' ORDER BY id", {}))
+        except Exception as e:
+            logger.error(f"Ошибка при получении активных рассылок: {e}")
+            return []
+        return [int(row[0]) for row in rows]
+
+    def enqueue_broadcast(self, campaign_id: int, segment_criteria: Dict[str, Any] = None) -> int:
+        """Поставить в очередь кампании пользователей сегмента; возвращает число новых записей.
+
+        Перед отбором пересчитываются сегменты пользователей, данные которых изменились
+        (refresh_dirty_segments; пользователи без строки в user_segments тоже получают сегмент).
+        Получатели отбираются одним INSERT ... SELECT из SEGMENT_MEMBERS_SQL (как снимок и аналитика),
+        уже поставленные пропускаются (ON CONFLICT DO NOTHING), поэтому повторный вызов
+        не дублирует сообщения и добирает пользователей, попавших в сегмент позже.
+        По умолчанию используются критерии, сохраненные в кампании.
+        """
+        if segment_criteria is None:
+            campaign = self.get_broadcast_campaign(campaign_id)
+            if campaign is None:
+                raise ValueError(f"Кампания рассылки {campaign_id} не найдена")
+            segment_criteria = campaign['segment_criteria']
+        unknown = set(segment_criteria) - set(self.BROADCAST_CRITERIA)
+        if unknown:
+            raise ValueError(f"Неизвестные критерии сегмента: {', '.join(sorted(unknown))}")
+
+        conditions = ['1 = 1']
+        params: Dict[str, Any] = {'campaign': campaign_id}
+        for key in self.BROADCAST_CRITERIA:
+            if key in segment_criteria:
+                conditions.append(f's.{key} = :{key}')
+                params[key] = segment_criteria[key]
+
+        self.refresh_dirty_segments()
+
+        # WHERE перед ON CONFLICT обязателен для INSERT ... SELECT в sqlite
+        def enqueue(run):
+            return len(run(f'''
+                INSERT INTO broadcast_outbox (campaign_id, tg_user_id, status)
+                SELECT :campaign, s.tg_user_id, 'pending'
+                FROM ({self.SEGMENT_MEMBERS_SQL}) s
+                WHERE {' AND '.join(conditions)}
+                ON CONFLICT (campaign_id, tg_user_id) DO NOTHING
+                RETURNING tg_user_id
+            ''', params))
+
+        try:
+            added = self._in_transaction(enqueue)
+        except Exception as e:
+            logger.error(f"Ошибка при постановке рассылки {campaign_id} в очередь: {e}")
+            return 0
+        logger.info(f"Рассылка {campaign_id}: в очередь добавлено {added} получателей")
+        return added
+
+    def claim_broadcast_batch(self, campaign_id: int, limit: int = 500) -> List[int]:
+        """Захватить порцию получателей (pending -> sending) и вернуть их id.
+
+        В Postgres строки выбираются с FOR UPDATE SKIP LOCKED, поэтому несколько отправителей
+        одной кампании не захватывают одних и тех же получателей.
+        """
+        lock = 'FOR UPDATE SKIP LOCKED' if self.use_postgres else ''
+
+        def claim(run):
+            rows = run(f'''
+                UPDATE broadcast_outbox
+                SET status = 'sending', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE campaign_id = :campaign AND tg_user_id IN (
+                    SELECT tg_user_id FROM broadcast_outbox
+                    WHERE campaign_id = :campaign AND status = 'pending'
+                    ORDER BY tg_user_id
+                    LIMIT :limit
+                    {lock}
+                )
+                RETURNING tg_user_id
+            ''', {'campaign': campaign_id, 'limit': limit})
+            return sorted(row[0] for row in rows)
+
+        try:
+            return self._in_transaction(claim)
+        except Exception as e:
+            logger.error(f"Ошибка при захвате порции рассылки {campaign_id}: {e}")
+            return []
+
+    def requeue_stale_broadcast(self, campaign_id: int, older_than_seconds: int = 300) -> int:
+        """Вернуть в pending получателей, захваченных давно и не отмеченных (отправитель упал)"""
+        if self.use_postgres:
+            cutoff = "LOCALTIMESTAMP - :age * INTERVAL '1 second'"
+        else:
+            cutoff = "datetime('now', '-' || :age || ' seconds')"
+        try:
+            requeued = self._in_transaction(lambda run: len(run(f'''
+                UPDATE broadcast_outbox
+                SET status = 'pending', updated_at = CURRENT_TIMESTAMP
+                WHERE campaign_id = :campaign AND status = 'sending' AND updated_at <= {cutoff}
+                RETURNING tg_user_id
+            ''', {'campaign': campaign_id, 'age': int(older_than_seconds)})))
+        except Exception as e:
+            logger.error(f"Ошибка при возврате зависших получателей рассылки {campaign_id}: {e}")
+            return 0
+        if requeued:
+            logger.warning(f"Рассылка {campaign_id}: {requeued} зависших получателей возвращены в очередь")
+        return requeued
+
+    def finish_broadcast_batch(self, campaign_id: int, delivered: List[int], failed: Dict[int, str] = None,
+                               permanent_failures: List[int] = None, max_attempts: int = 3) -> bool:
+        """Записать результат порции.
+
+        delivered — sent; permanent_failures (бот заблокирован, чат не найден) — failed сразу;
+        остальные из failed возвращаются в pending, пока attempts < max_attempts, затем failed.
+        """
+        failed = failed or {}
+        permanent = set(permanent_failures or [])
+
+        def finish(run):
+            for offset in range(0, len(delivered), 500):
+                keys = {f'id{i}': uid for i, uid in enumerate(delivered[offset:offset + 500])}
+                run(f'''
+                    UPDATE broadcast_outbox
+                    SET status = 'sent', last_error = NULL,
+                        sent_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                    WHERE campaign_id = :campaign AND tg_user_id IN ({', '.join(':' + key for key in keys)})
+                ''', dict(keys, campaign=campaign_id))
+            for user_id, error in failed.items():
+                status_sql = ("'failed'" if user_id in permanent
+                              else "CASE WHEN attempts >= :max_attempts THEN 'failed' ELSE 'pending' END")
+                run(f'''
+                    UPDATE broadcast_outbox
+                    SET status = {status_sql}, last_error = :error, updated_at = CURRENT_TIMESTAMP
+                    WHERE campaign_id = :campaign AND tg_user_id = :user_id
+                ''', {'campaign': campaign_id, 'user_id': user_id, 'error': str(error)[:500],
+                      'max_attempts': max_attempts})
+
+        try:
+            self._in_transaction(finish)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при записи результатов рассылки {campaign_id}: {e}")
+            return False
+
+    def get_broadcast_progress(self, campaign_id: int) -> Dict[str, int]:
+        """Счетчики получателей кампании по статусам (по индексу campaign_id, status)"""
+        progress = {'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0}
+        try:
+            rows = self._in_transaction(lambda run: run('''
+                SELECT status, COUNT(*) FROM broadcast_outbox
+                WHERE campaign_id = :campaign
+                GROUP BY status
+            ''', {'campaign': campaign_id}))
+        except Exception as e:
+            logger.error(f"Ошибка при получении прогресса рассылки {campaign_id}: {e}")
+            rows = []
+        for status, count in rows:
+            progress[status] = int(count)
+        progress['total'] = sum(progress.values())
+        return progress
+
+    def complete_broadcast_campaign(self, campaign_id: int) -> bool:
+        """Отметить кампанию завершенной, если в очереди не осталось pending и sending"""
+        def complete(run):
+            return len(run('''
+                UPDATE broadcast_campaigns
+                SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                WHERE id = :campaign AND status <> 'completed' AND NOT EXISTS (
+                    SELECT 1 FROM broadcast_outbox
+                    WHERE campaign_id = :campaign AND status IN ('pending', 'sending')
+                )
+                RETURNING id
+            ''', {'campaign': campaign_id})) > 0
+
+        try:
+            return self._in_transaction(complete)
+        except Exception as e:
+            logger.error(f"Ошибка при завершении рассылки {campaign_id}: {e}")
+            return False
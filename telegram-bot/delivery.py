@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Конкурентная доставка сообщений бота с ограничением частоты
+
+Лимиты Telegram Bot API: около 30 сообщений в секунду на бота и не чаще
+1 сообщения в секунду в один чат. Лимитер резервирует «токены» (ведро токенов для
+общего лимита и время следующей отправки для каждого чата), поэтому в одном цикле
+событий обходится без блокировок. Ответ 429 (RetryAfter) приостанавливает всю
+отправку на retry_after секунд и снижает общий лимит (затем он постепенно
+восстанавливается), после чего сообщение повторяется.
+"""
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError
+
+logger = logging.getLogger(__name__)
+
+# Запас относительно 30 сообщений/с: сообщения доходят до Telegram с разбросом задержек
+GLOBAL_RATE = 25
+PER_CHAT_RATE = 1
+DEFAULT_CONCURRENCY = 20
+DEFAULT_MAX_RETRIES = 3
+# Пауза перед повтором при сетевой ошибке (удваивается с каждой попыткой)
+NETWORK_RETRY_DELAY = 1.0
+# Сколько чатов хранить в лимитере, прежде чем удалять устаревшие записи
+MAX_TRACKED_CHATS = 10_000
+# После 429 общий лимит снижается в RATE_DECREASE раз и восстанавливается на RATE_RECOVERY за доставку
+RATE_DECREASE = 0.8
+RATE_RECOVERY = 0.05
+MIN_RATE = 1.0
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: reserve() забирает токен и возвращает, сколько ждать"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate должен быть положительным")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0.0
+
+    def reserve(self) -> float:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # Токенов может стать меньше нуля — это очередь уже выданных резервов
+        self._tokens -= 1
+        wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        return max(wait, self._paused_until - now)
+
+    def paused_for(self) -> float:
+        return max(0.0, self._paused_until - self._clock())
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (ответ 429), накопленный запас сгорает"""
+        now = self._clock()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = min(self._tokens, 0.0)
+        self._updated = max(self._updated, now)
+
+
+class RateLimiter:
+    """Общий лимит бота и лимит на чат"""
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.bucket = TokenBucket(global_rate, clock=clock)
+        self.global_rate = global_rate
+        self.chat_interval = 1.0 / per_chat_rate
+        self._clock = clock
+        self._sleep = sleep
+        # chat_id -> ближайшее время, когда в чат можно отправить следующее сообщение
+        self._next_chat_slot: Dict[Hashable, float] = {}
+
+    def _reserve_chat(self, chat_id: Hashable) -> float:
+        now = self._clock()
+        if len(self._next_chat_slot) > MAX_TRACKED_CHATS:
+            self._next_chat_slot = {chat: slot for chat, slot in self._next_chat_slot.items() if slot > now}
+        slot = max(now, self._next_chat_slot.get(chat_id, now))
+        self._next_chat_slot[chat_id] = slot + self.chat_interval
+        return slot - now
+
+    async def acquire(self, chat_id: Hashable) -> None:
+        wait = self._reserve_chat(chat_id)
+        if wait > 0:
+            await self._sleep(wait)
+        wait = self.bucket.reserve()
+        if wait > 0:
+            await self._sleep(wait)
+        # Пауза после 429 могла начаться, пока ждали своего резерва
+        while self.bucket.paused_for() > 0:
+            await self._sleep(self.bucket.paused_for())
+
+    def pause(self, seconds: float) -> None:
+        """Ответ 429: пауза и снижение общего лимита"""
+        self.bucket.pause(seconds)
+        self.bucket.rate = max(MIN_RATE, self.bucket.rate * RATE_DECREASE)
+
+    def record_success(self) -> None:
+        if self.bucket.rate < self.global_rate:
+            self.bucket.rate = min(self.global_rate, self.bucket.rate + RATE_RECOVERY)
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class DeliveryEngine:
+    """Отправка пачки сообщений пулом из concurrency корутин через общий RateLimiter"""
+
+    def __init__(self, limiter: Optional[RateLimiter] = None, concurrency: int = DEFAULT_CONCURRENCY,
+                 max_retries: int = DEFAULT_MAX_RETRIES, clock=time.monotonic, sleep=asyncio.sleep):
+        if concurrency <= 0:
+            raise ValueError("concurrency должен быть положительным")
+        self.limiter = limiter or RateLimiter(clock=clock, sleep=sleep)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._clock = clock
+        self._sleep = sleep
+
+    async def run(self, jobs: Iterable[Tuple[Hashable, Callable[[], Awaitable[Any]]]],
+                  on_result: Optional[Callable[[Hashable, Optional[str], bool], None]] = None) -> Dict[str, Any]:
+        """Выполнить задания (chat_id, send) и вернуть отчет.
+
+        send() вызывается заново при каждой попытке. on_result(chat_id, ошибка или None, ошибка
+        постоянная) вызывается сразу после каждого задания. Отчет: delivered — chat_id доставленных,
+        failed — {chat_id: ошибка}, permanent_failures — chat_id, которым отправка невозможна
+        (бот заблокирован, чат не найден), retries, throughput (сообщений/с), latency_ms (от начала
+        прогона до доставки) и send_ms (длительность успешного вызова send) — p50/p95/max.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        started = self._clock()
+        delivered: List[Hashable] = []
+        failed: Dict[Hashable, str] = {}
+        permanent_failures: List[Hashable] = []
+        latencies: List[float] = []
+        send_times: List[float] = []
+        counters = {'retries': 0, 'rate_limited': 0}
+
+        async def worker():
+            while True:
+                try:
+                    chat_id, send = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                error, permanent = await self._deliver_one(chat_id, send, counters, send_times)
+                if error is None:
+                    delivered.append(chat_id)
+                    latencies.append(self._clock() - started)
+                else:
+                    failed[chat_id] = error
+                    if permanent:
+                        permanent_failures.append(chat_id)
+                if on_result is not None:
+                    on_result(chat_id, error, permanent)
+
+        total = queue.qsize()
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, total))))
+
+        elapsed = self._clock() - started
+        report = {
+            'total': total,
+            'delivered': delivered,
+            'failed': failed,
+            'permanent_failures': permanent_failures,
+            'retries': counters['retries'],
+            'rate_limited': counters['rate_limited'],
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput': round(len(delivered) / elapsed, 2) if elapsed > 0 else float(len(delivered)),
+            'latency_ms': self._summary(latencies),
+            'send_ms': self._summary(send_times),
+        }
+        if total:
+            logger.info(
+                f"Доставка: {len(delivered)}/{total} за {report['elapsed_seconds']} с "
+                f"({report['throughput']} сообщ./с), ошибок {len(failed)}, повторов {counters['retries']}, "
+                f"429: {counters['rate_limited']}, задержка p95 {report['latency_ms']['p95']} мс"
+            )
+        return report
+
+    @staticmethod
+    def _summary(values: List[float]) -> Dict[str, float]:
+        return {
+            'p50': round(_percentile(values, 0.5) * 1000, 1),
+            'p95': round(_percentile(values, 0.95) * 1000, 1),
+            'max': round(max(values, default=0.0) * 1000, 1),
+        }
+
+    async def _deliver_one(self, chat_id: Hashable, send: Callable[[], Awaitable[Any]],
+                           counters: Dict[str, int], send_times: List[float]) -> Tuple[Optional[str], bool]:
+        """(None, False) при успехе, иначе (текст последней ошибки, ошибка постоянная)"""
+        attempt = 0
+        while True:
+            await self.limiter.acquire(chat_id)
+            call_started = self._clock()
+            try:
+                await send()
+                send_times.append(self._clock() - call_started)
+                self.limiter.record_success()
+                return None, False
+            except (BadRequest, Forbidden) as e:
+                # Бот заблокирован, чат не найден и т.п. — повтор не поможет
+                logger.warning(f"Сообщение в чат {chat_id} не доставлено: {e}")
+                return str(e), True
+            except Exception as e:
+                retry_after = getattr(e, 'retry_after', None)
+                if attempt >= self.max_retries or (retry_after is None and not isinstance(e, NetworkError)):
+                    logger.error(f"Сообщение в чат {chat_id} не доставлено: {e}")
+                    return str(e), False
+                attempt += 1
+                counters['retries'] += 1
+                if retry_after is not None:
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    counters['rate_limited'] += 1
+                    logger.warning(f"429 от Telegram: пауза отправки на {retry_after} с")
+                    self.limiter.pause(float(retry_after))
+                else:
+                    await self._sleep(NETWORK_RETRY_DELAY * 2 ** (attempt - 1))
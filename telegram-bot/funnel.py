@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Движок многошаговых воронок по упорядоченным во времени событиям пользователей
+Все пользователи обрабатываются за один потоковый проход по событиям,
+отсортированным по (tg_user_id, created_at), с конечным автоматом на пользователя
+"""
+import logging
+from statistics import median
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Порядок полей события, которое принимает FunnelEngine.evaluate():
+# (tg_user_id, timestamp в секундах, event_type, event_name, section, cta_location)
+EVENT_FIELDS = ('tg_user_id', 'ts', 'event_type', 'event_name', 'section', 'cta_location')
+STEP_FIELDS = ('event_type', 'event_name', 'section', 'cta_location')
+
+_FIELD_INDEX = {name: i for i, name in enumerate(EVENT_FIELDS)}
+
+DEFAULT_WINDOW_SECONDS = 7 * 24 * 3600
+MAX_STEPS = 20
+
+
+class FunnelStep:
+    """Шаг воронки — предикат по полям события (заданные поля должны совпасть)"""
+
+    def __init__(self, name: str = None, event_type: str = None, event_name: str = None,
+                 section: str = None, cta_location: str = None):
+        self.conditions = {
+            field: value for field, value in (
+                ('event_type', event_type),
+                ('event_name', event_name),
+                ('section', section),
+                ('cta_location', cta_location),
+            ) if value is not None
+        }
+        if not self.conditions:
+            raise ValueError("Шаг воронки должен задавать хотя бы одно из полей: " + ', '.join(STEP_FIELDS))
+
+        self.name = name or ':'.join(str(v) for v in self.conditions.values())
+        self._checks = tuple((_FIELD_INDEX[field], value) for field, value in self.conditions.items())
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'FunnelStep':
+        """Создать шаг из JSON-описания"""
+        if not isinstance(data, dict):
+            raise ValueError("Шаг воронки должен быть объектом")
+        unknown = set(data) - set(STEP_FIELDS) - {'name'}
+        if unknown:
+            raise ValueError(f"Неизвестные поля шага воронки: {', '.join(sorted(unknown))}")
+        return cls(**{key: (str(value) if value is not None else None) for key, value in data.items()})
+
+    def matches(self, event: Sequence) -> bool:
+        for index, value in self._checks:
+            if event[index] != value:
+                return False
+        return True
+
+
+class FunnelEngine:
+    """Оценка воронки: число пользователей на шагах, отток и медианное время между шагами.
+
+    Пользователь входит в воронку на событии первого шага и продвигается строго по
+    порядку; все шаги должны уложиться в окно конверсии от момента входа. Каждое событие
+    первого шага — новый вход, при этом более ранние попытки не отбрасываются: для каждого
+    шага хранится дошедшая до него попытка с самым поздним входом (у нее больше всего
+    времени в окне). В отчет попадает самая глубокая попытка пользователя.
+    """
+
+    def __init__(self, steps: List[FunnelStep], window_seconds: int = DEFAULT_WINDOW_SECONDS):
+        if not steps:
+            raise ValueError("Воронка должна содержать хотя бы один шаг")
+        if len(steps) > MAX_STEPS:
+            raise ValueError(f"Воронка может содержать не более {MAX_STEPS} шагов")
+        if window_seconds <= 0:
+            raise ValueError("Окно конверсии должно быть положительным")
+
+        self.steps = steps
+        self.window_seconds = window_seconds
+
+    def _finish_user(self, chains: List[Optional[tuple]], top: int,
+                     reached: List[int], deltas: List[List[float]]) -> None:
+        """Учесть самую глубокую попытку пользователя (chains[top]) в агрегатах"""
+        if top < 0:
+            return
+        reached[top] += 1
+        node = chains[top]
+        # Узел попытки — (время входа, время шага, узел предыдущего шага)
+        while node[2] is not None:
+            deltas[top].append(node[1] - node[2][1])
+            node = node[2]
+            top -= 1
+
+    def evaluate(self, events: Iterable[Tuple]) -> Dict[str, Any]:
+        """Один проход по событиям, отсортированным по (tg_user_id, ts)"""
+        steps = self.steps
+        n = len(steps)
+        first_step = steps[0]
+        window = self.window_seconds
+
+        # reached[i] — сколько пользователей остановились ровно на шаге i
+        reached = [0] * n
+        deltas: List[List[float]] = [[] for _ in range(n)]
+
+        user_id = None
+        # chains[k] — попытка, дошедшая до шага k, с самым поздним входом; top — самый глубокий шаг
+        chains: List[Optional[tuple]] = [None] * n
+        top = -1
+
+        for event in events:
+            if event[0] != user_id:
+                if user_id is not None:
+                    self._finish_user(chains, top, reached, deltas)
+                user_id = event[0]
+                chains = [None] * n
+                top = -1
+
+            if top == n - 1:
+                # Воронка пройдена — остальные события пользователя не нужны
+                continue
+
+            ts = event[1]
+            # Сверху вниз, чтобы одно событие не продвинуло попытку на два шага сразу
+            for k in range(top + 1, 0, -1):
+                chain = chains[k - 1]
+                if chain is not None and ts - chain[0] <= window and steps[k].matches(event):
+                    chains[k] = (chain[0], ts, chain)
+                    if k > top:
+                        top = k
+            if first_step.matches(event):
+                chains[0] = (ts, ts, None)
+                if top < 0:
+                    top = 0
+
+        if user_id is not None:
+            self._finish_user(chains, top, reached, deltas)
+
+        return self._build_report(reached, deltas)
+
+    def _build_report(self, reached: List[int], deltas: List[List[float]]) -> Dict[str, Any]:
+        n = len(self.steps)
+        users_at_step = [0] * n
+        running = 0
+        for i in range(n - 1, -1, -1):
+            running += reached[i]
+            users_at_step[i] = running
+
+        entered = users_at_step[0]
+        report_steps = []
+        for i, step in enumerate(self.steps):
+            users = users_at_step[i]
+            previous = users_at_step[i - 1] if i else users
+            report_steps.append({
+                'step': i + 1,
+                'name': step.name,
+                'users': users,
+                'drop_off': previous - users,
+                'conversion_from_previous': round(users / previous, 4) if previous else 0.0,
+                'conversion_from_start': round(users / entered, 4) if entered else 0.0,
+                'median_seconds_from_previous': median(deltas[i]) if deltas[i] else None,
+            })
+
+        return {
+            'window_seconds': self.window_seconds,
+            'users_entered': entered,
+            'users_completed': users_at_step[-1],
+            'steps': report_steps,
+        }
+
+
+def parse_steps(raw_steps: Optional[list]) -> List[FunnelStep]:
+    """Разобрать список шагов из JSON запроса"""
+    if not isinstance(raw_steps, list) or not raw_steps:
+        raise ValueError("steps должен быть непустым списком")
+    return [FunnelStep.from_dict(item) for item in raw_steps]
@@ -20,6 +20,7 @@ def init_base_tables():
             second_reminder_sent BOOLEAN DEFAULT 0,
             started_at TIMESTAMP,
             diagnostics_started_at TIMESTAMP,
+            next_reminder_at TIMESTAMP,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
@@ -44,6 +44,45 @@ class DatabaseMigrations:
         # Миграция 8: Добавление поля diagnostics_completed_at
         self.add_diagnostics_completed_at_column()
 
+        # Миграция 9: Скетчи HyperLogLog для уникальных посетителей
+        self.create_visitor_sketches_table()
+
+        # Миграция 10: Инкрементальные профили активности пользователей
+        self.create_user_activity_profiles_table()
+
+        # Миграция 11: Счетчики предпочтений контента
+        self.create_user_preference_counters_table()
+
+        # Миграция 12: Предрасчитанная матрица переходов и частые пути навигации
+        self.create_navigation_tables()
+
+        # Миграция 13: Версии данных пользователей для кеша персональных отчетов
+        self.create_user_data_versions_table()
+
+        # Миграция 14: Кольцевые буферы персонального пути пользователя
+        self.create_user_journeys_table()
+
+        # Миграция 15: Предрасчитанные рекомендации пользователей
+        self.create_user_recommendations_table()
+
+        # Миграция 16: Принадлежность пользователей к сегментам
+        self.create_user_segments_table()
+
+        # Миграция 17: Снимки сегментов для прогонов автоматических действий
+        self.create_segment_snapshots_table()
+
+        # Миграция 18: История смены сегментов и версия данных расчета сегмента
+        self.create_user_segment_history_table()
+
+        # Миграция 19: Время следующего напоминания для планировщика
+        self.add_next_reminder_at_column()
+
+        # Миграция 20: Частичные индексы для выборки кандидатов на напоминания
+        self.create_reminder_indexes()
+
+        # Миграция 21: Кампании рассылок и очередь отправки (outbox)
+        self.create_broadcast_tables()
+
         logger.info("Все миграции выполнены успешно!")
 
     def create_user_identities_table(self):
@@ -379,6 +418,8 @@ class DatabaseMigrations:
             "CREATE INDEX IF NOT EXISTS idx_site_sessions_tg_user ON site_sessions(tg_user_id)",
             "CREATE INDEX IF NOT EXISTS idx_site_sessions_start ON site_sessions(session_start)",
             "CREATE INDEX IF NOT EXISTS idx_site_sessions_source ON site_sessions(source)",
+            "CREATE INDEX IF NOT EXISTS idx_site_sessions_source_campaign ON site_sessions(source, utm_campaign)",
+            "CREATE INDEX IF NOT EXISTS idx_site_sessions_cookie_start ON site_sessions(cookie_id, session_start DESC)",
             "CREATE INDEX IF NOT EXISTS idx_site_sessions_device ON site_sessions(device_type)",
 
             # Индексы для site_events
@@ -387,6 +428,7 @@ class DatabaseMigrations:
             "CREATE INDEX IF NOT EXISTS idx_site_events_type ON site_events(event_type)",
             "CREATE INDEX IF NOT EXISTS idx_site_events_category ON site_events(event_category)",
             "CREATE INDEX IF NOT EXISTS idx_site_events_created ON site_events(created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_site_events_user_created ON site_events(tg_user_id, created_at)",
 
             # Индексы для диагностики
             "CREATE INDEX IF NOT EXISTS idx_diagnostics_tg_user ON diagnostics_results(tg_user_id)",
@@ -447,6 +489,391 @@ class DatabaseMigrations:
 
         conn.close()
 
+    def add_next_reminder_at_column(self):
+        """Добавление поля next_reminder_at в таблицу users (время следующего напоминания)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute("PRAGMA table_info(users)")
+            columns = [column[1] for column in cursor.fetchall()]
+
+            if 'next_reminder_at' not in columns:
+                cursor.execute('''
+                    ALTER TABLE users ADD COLUMN next_reminder_at TIMESTAMP
+                ''')
+                # Заполняем для пользователей, которым еще положены напоминания
+                cursor.execute('''
+                    UPDATE users
+                    SET next_reminder_at = CASE
+                        WHEN first_reminder_sent = 0 THEN datetime(started_at, '+10 minutes')
+                        WHEN second_reminder_sent = 0 THEN datetime(started_at, '+24 hours')
+                    END
+                    WHERE has_started_diagnostics = 0 AND started_at IS NOT NULL
+                ''')
+                logger.info("Добавлен столбец next_reminder_at в таблицу users")
+            else:
+                logger.info("Столбец next_reminder_at уже существует")
+
+            # Частичный индекс: в нем только пользователи с запланированным напоминанием
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_next_reminder
+                ON users(next_reminder_at) WHERE next_reminder_at IS NOT NULL
+            ''')
+            conn.commit()
+
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении столбца next_reminder_at: {e}")
+
+        conn.close()
+
+    def create_reminder_indexes(self):
+        """Частичные индексы users(started_at) для пользователей, ожидающих напоминаний"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            # Условия индексов совпадают с WHERE в Database._reminder_candidates_sql
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_first_reminder_pending
+                ON users(started_at) WHERE has_started_diagnostics = 0 AND first_reminder_sent = 0
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_second_reminder_pending
+                ON users(started_at) WHERE has_started_diagnostics = 0 AND second_reminder_sent = 0
+            ''')
+            conn.commit()
+            logger.info("Индексы напоминаний созданы")
+        except Exception as e:
+            logger.error(f"Ошибка при создании индексов напоминаний: {e}")
+
+        conn.close()
+
+    def create_visitor_sketches_table(self):
+        """Таблица скетчей HyperLogLog уникальных посетителей по дням и измерениям"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS visitor_sketches (
+                day TEXT NOT NULL,        -- Дата (UTC) в формате YYYY-MM-DD
+                dimension TEXT NOT NULL,  -- 'all', 'source', 'utm_campaign'
+                value TEXT NOT NULL,      -- Значение измерения ('' для 'all')
+                sketch BLOB NOT NULL,     -- Сериализованный HyperLogLog
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                PRIMARY KEY (day, dimension, value)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_visitor_sketches_dimension
+            ON visitor_sketches(dimension, day)
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица visitor_sketches создана")
+
+    def create_user_activity_profiles_table(self):
+        """Компактный профиль активности пользователя, обновляемый при записи событий"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_activity_profiles (
+                tg_user_id INTEGER PRIMARY KEY,
+                hour_histogram BLOB NOT NULL,  -- 24 счетчика uint32 (little-endian) событий по часам UTC
+                first_seen_at TIMESTAMP,       -- Первое событие
+                last_seen_at TIMESTAMP,        -- Последнее событие
+                sessions_count INTEGER DEFAULT 0,
+                first_session_at TIMESTAMP,    -- Начало первой сессии
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                FOREIGN KEY (tg_user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица user_activity_profiles создана")
+
+    def create_user_preference_counters_table(self):
+        """Счетчики просмотров по типам контента и AI разговоров, обновляемые при записи"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_preference_counters (
+                    tg_user_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,   -- 'content_type' или 'conversation_type'
+                    value TEXT NOT NULL,  -- Тип контента / тип разговора
+                    count INTEGER NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                    PRIMARY KEY (tg_user_id, kind, value)
+                )
+            ''')
+
+            # Заполняем счетчики по уже накопленным данным (один раз для каждого вида)
+            backfill = {
+                'content_type': ('content_views', 'content_type'),
+                'conversation_type': ('ai_interactions', 'conversation_type')
+            }
+            for kind, (table, column) in backfill.items():
+                cursor.execute("SELECT COUNT(*) FROM user_preference_counters WHERE kind = ?", (kind,))
+                if cursor.fetchone()[0] == 0:
+                    cursor.execute(f'''
+                        INSERT INTO user_preference_counters (tg_user_id, kind, value, count)
+                        SELECT tg_user_id, '{kind}', {column}, COUNT(*)
+                        FROM {table}
+                        WHERE tg_user_id IS NOT NULL AND {column} IS NOT NULL
+                        GROUP BY tg_user_id, {column}
+                    ''')
+
+            conn.commit()
+            logger.info("Таблица user_preference_counters создана")
+        except Exception as e:
+            logger.error(f"Ошибка при создании user_preference_counters: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def create_navigation_tables(self):
+        """Таблицы предрасчитанной навигации по дням: переходы, пути и отметки о пересчете"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS navigation_transitions (
+                day TEXT NOT NULL,        -- Дата (UTC) в формате YYYY-MM-DD
+                from_node TEXT NOT NULL,  -- 'section:...', 'page:...' или 'cta:...'
+                to_node TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+
+                PRIMARY KEY (day, from_node, to_node)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_navigation_transitions_from
+            ON navigation_transitions(from_node, day)
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS navigation_paths (
+                day TEXT NOT NULL,
+                kind TEXT NOT NULL,       -- 'path' или 'to_cta'
+                path TEXT NOT NULL,       -- Узлы через ' > '
+                count INTEGER NOT NULL DEFAULT 0,
+
+                PRIMARY KEY (day, kind, path)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS navigation_days (
+                day TEXT PRIMARY KEY,
+                events_count INTEGER NOT NULL DEFAULT 0,
+                is_complete INTEGER NOT NULL DEFAULT 0,  -- 1, если день закончился и больше не пересчитывается
+                built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблицы навигации созданы")
+
+    def create_user_data_versions_table(self):
+        """Версия данных пользователя: увеличивается при записи его событий, сессий и диагностик"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_data_versions'")
+        created = cursor.fetchone() is None
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_data_versions (
+                tg_user_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        if created:
+            # Данные, накопленные до появления таблицы, получают версию 1 — иначе такие
+            # пользователи не попадут в инкрементальный пересчет сегментов до следующей записи
+            cursor.execute('''
+                INSERT OR IGNORE INTO user_data_versions (tg_user_id, version)
+                SELECT tg_user_id, 1 FROM (
+                    SELECT tg_user_id FROM site_sessions WHERE tg_user_id IS NOT NULL
+                    UNION
+                    SELECT tg_user_id FROM site_events WHERE tg_user_id IS NOT NULL
+                    UNION
+                    SELECT tg_user_id FROM diagnostics_results WHERE tg_user_id IS NOT NULL
+                )
+            ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица user_data_versions создана")
+
+    def create_user_journeys_table(self):
+        """Последние записи персонального пути по разделам (кольцевой буфер, обновляется при записи)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_journeys (
+                tg_user_id INTEGER NOT NULL,
+                category TEXT NOT NULL,         -- miniapp_opens, content_views, ai_interactions, ...
+                entries TEXT NOT NULL,          -- JSON массив записей, новые первыми
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                PRIMARY KEY (tg_user_id, category)
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица user_journeys создана")
+
+    def create_user_recommendations_table(self):
+        """Рекомендации по таблице правил, рассчитанные для версии данных пользователя"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_recommendations (
+                tg_user_id INTEGER PRIMARY KEY,
+                segment TEXT,
+                engagement_level TEXT,
+                recommendations TEXT NOT NULL,  -- JSON: recommendations, next_best_actions, content_suggestions
+                data_version INTEGER NOT NULL DEFAULT 0,  -- user_data_versions.version на момент расчета
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица user_recommendations создана")
+
+    def create_user_segments_table(self):
+        """Последний рассчитанный сегмент пользователя (для агрегатов по сегменту одним запросом)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_segments (
+                tg_user_id INTEGER PRIMARY KEY,
+                segment TEXT NOT NULL,          -- newcomer, engaged, converter, loyal
+                engagement_level TEXT NOT NULL, -- low, medium, high
+                conversion_potential TEXT,
+                diagnostics_completed BOOLEAN DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_segments_segment ON user_segments(segment)")
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица user_segments создана")
+
+    def create_segment_snapshots_table(self):
+        """Снимки сегментации: один на прогон автоматических действий"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS segment_snapshots (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                users_count INTEGER NOT NULL DEFAULT 0,
+                segment_counts TEXT NOT NULL,   -- JSON: сегмент -> число пользователей
+                duration_ms INTEGER             -- Время расчета снимка
+            )
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица segment_snapshots создана")
+
+    def create_user_segment_history_table(self):
+        """Журнал переходов пользователей между сегментами и версия данных в user_segments"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        # Версия данных пользователя (user_data_versions), для которой рассчитан сегмент;
+        # -1 — неизвестна, сегмент будет пересчитан инкрементальным проходом
+        cursor.execute("PRAGMA table_info(user_segments)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if 'data_version' not in columns:
+            try:
+                cursor.execute('ALTER TABLE user_segments ADD COLUMN data_version INTEGER NOT NULL DEFAULT -1')
+                logger.info("Добавлена колонка data_version в user_segments")
+            except sqlite3.OperationalError as e:
+                logger.warning(f"Не удалось добавить колонку data_version: {e}")
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_segment_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_user_id INTEGER NOT NULL,
+                previous_segment TEXT,          -- NULL — первое назначение сегмента
+                segment TEXT NOT NULL,
+                previous_engagement_level TEXT,
+                engagement_level TEXT NOT NULL,
+                data_version INTEGER,
+                changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_user_segment_history_user
+            ON user_segment_history(tg_user_id, changed_at)
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблица user_segment_history создана")
+
+    def create_broadcast_tables(self):
+        """Кампании рассылок по сегментам и очередь отправки (campaign, user, status)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                message_text TEXT NOT NULL,
+                segment_criteria TEXT,          -- JSON критериев user_segments
+                status TEXT NOT NULL DEFAULT 'active',  -- active, completed
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                completed_at TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_outbox (
+                campaign_id INTEGER NOT NULL,
+                tg_user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',  -- pending, sending, sent, failed
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP,
+                PRIMARY KEY (campaign_id, tg_user_id)
+            )
+        ''')
+        # Выборка очередной порции pending и счетчики прогресса по статусам
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_broadcast_outbox_status
+            ON broadcast_outbox(campaign_id, status, tg_user_id)
+        ''')
+
+        conn.commit()
+        conn.close()
+        logger.info("Таблицы рассылок созданы")
+
 # Функция для запуска миграций
 def run_database_migrations(db_path: str = "bot_users.db"):
     """Запуск всех миграций базы данных"""
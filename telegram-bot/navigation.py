@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Анализ навигации: матрица переходов между страницами/разделами и частые пути
+Считается за один проход по событиям, отсортированным по (session_id, created_at)
+"""
+import logging
+from collections import Counter, deque
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Длина сохраняемых путей (количество узлов)
+PATH_LENGTH = 3
+PATH_SEPARATOR = ' > '
+
+PATH_KIND_ALL = 'path'     # Все последовательности из PATH_LENGTH узлов
+PATH_KIND_TO_CTA = 'to_cta'  # Пути, заканчивающиеся кликом по CTA
+
+CTA_NODE_PREFIX = 'cta:'
+
+
+def event_node(event_type: str, page: Optional[str], section: Optional[str],
+               cta_location: Optional[str] = None) -> Optional[str]:
+    """Узел навигации для события: CTA, раздел или страница (None — событие без места)"""
+    if event_type == 'cta':
+        return CTA_NODE_PREFIX + (cta_location or 'unknown')
+    if section:
+        return 'section:' + section
+    if page:
+        return 'page:' + page
+    return None
+
+
+class NavigationAccumulator:
+    """Разреженные счетчики переходов и путей.
+
+    События одной сессии должны идти подряд и по времени. Переход строится от события,
+    указанного в previous_event_id, а если его нет — от предыдущего узла сессии.
+    Повторы одного узла подряд схлопываются.
+    """
+
+    def __init__(self, path_length: int = PATH_LENGTH):
+        if path_length < 2:
+            raise ValueError("Длина пути должна быть не меньше 2")
+        self.path_length = path_length
+        self.transitions: Counter = Counter()
+        self.paths: Counter = Counter()
+        self.events_count = 0
+
+        self._session_id = None
+        self._recent: deque = deque(maxlen=path_length)
+        self._nodes_by_event: Dict[int, str] = {}
+
+    def add(self, session_id, event_id: int, node: Optional[str],
+            previous_event_id: Optional[int] = None) -> None:
+        if session_id != self._session_id:
+            self._session_id = session_id
+            self._recent.clear()
+            self._nodes_by_event = {}
+
+        if node is None:
+            return
+        self.events_count += 1
+        self._nodes_by_event[event_id] = node
+
+        previous = self._nodes_by_event.get(previous_event_id) if previous_event_id else None
+        if previous is None and self._recent:
+            previous = self._recent[-1]
+
+        if previous is not None and previous != node:
+            self.transitions[(previous, node)] += 1
+
+        if self._recent and self._recent[-1] == node:
+            return
+        self._recent.append(node)
+
+        if len(self._recent) == self.path_length:
+            self.paths[(PATH_KIND_ALL, PATH_SEPARATOR.join(self._recent))] += 1
+        if node.startswith(CTA_NODE_PREFIX) and len(self._recent) > 1:
+            self.paths[(PATH_KIND_TO_CTA, PATH_SEPARATOR.join(self._recent))] += 1
+
+    def transition_rows(self):
+        """Строки (from_node, to_node, count)"""
+        return [(src, dst, count) for (src, dst), count in self.transitions.items()]
+
+    def path_rows(self):
+        """Строки (kind, path, count)"""
+        return [(kind, path, count) for (kind, path), count in self.paths.items()]
+
@@ -1,14 +1,50 @@
 import logging
+from typing import Tuple
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from db import Database
+from delivery import DeliveryEngine
 
 logger = logging.getLogger(__name__)
 
+# Через сколько повторить напоминание, не доставленное из-за временной ошибки
+REMINDER_RETRY_SECONDS = 60
+
 class NotificationService:
-    def __init__(self, bot, db: Database, miniapp_url: str):
+    def __init__(self, bot, db: Database, miniapp_url: str, delivery: DeliveryEngine = None):
         self.bot = bot
         self.db = db
         self.miniapp_url = miniapp_url
+        # Общий лимитер отправки для напоминаний и рассылок (кампании бот отправляет сам, см. broadcast.py)
+        self.delivery = delivery or DeliveryEngine()
+
+    def _first_reminder_message(self) -> Tuple[str, InlineKeyboardMarkup]:
+        keyboard = [
+            [InlineKeyboardButton(
+                "🛠 Пройти бесплатную диагностику",
+                url=f"{self.miniapp_url}#diagnostics"
+            )]
+        ]
+        message_text = (
+            "Ваша система готова к анализу 🔍\n\n"
+            "Напоминаю, что это бесплатный этап, который занимает всего 5 минут. "
+            "За это время вы обнаружите «протечки» прибыли и поймете, как вырасти до 1-2 млн ₽.\n\n"
+            "Начните сейчас!"
+        )
+        return message_text, InlineKeyboardMarkup(keyboard)
+
+    def _second_reminder_message(self) -> Tuple[str, InlineKeyboardMarkup]:
+        keyboard = [
+            [InlineKeyboardButton(
+                "🚀 Запустить SpaceGrowth",
+                url=f"{self.miniapp_url}#diagnostics"
+            )]
+        ]
+        message_text = (
+            "Вопрос архитектуры ⚙️\n\n"
+            "Оставить всё как есть — это тоже стратегия. Но если цель — масштаб, "
+            "систему нужно пересобрать. Бесплатная диагностика еще доступна по ссылке:"
+        )
+        return message_text, InlineKeyboardMarkup(keyboard)
     
     async def send_first_reminder(self, user_id: int, username: str = None, first_name: str = None):
         """Отправить первое напоминание через 10 минут"""
@@ -24,22 +60,7 @@ class NotificationService:
                 logger.info(f"Первое напоминание пользователю {user_id} уже отправлено")
                 return
             
-            diagnostics_url = f"{self.miniapp_url}#diagnostics"
-            
-            keyboard = [
-                [InlineKeyboardButton(
-                    "🛠 Пройти бесплатную диагностику",
-                    url=diagnostics_url
-                )]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            message_text = (
-                "Ваша система готова к анализу 🔍\n\n"
-                "Напоминаю, что это бесплатный этап, который занимает всего 5 минут. "
-                "За это время вы обнаружите «протечки» прибыли и поймете, как вырасти до 1-2 млн ₽.\n\n"
-                "Начните сейчас!"
-            )
+            message_text, reply_markup = self._first_reminder_message()
             
             await self.bot.send_message(
                 chat_id=user_id,
@@ -68,21 +89,7 @@ class NotificationService:
                 logger.info(f"Второе напоминание пользователю {user_id} уже отправлено")
                 return
             
-            diagnostics_url = f"{self.miniapp_url}#diagnostics"
-            
-            keyboard = [
-                [InlineKeyboardButton(
-                    "🚀 Запустить SpaceGrowth",
-                    url=diagnostics_url
-                )]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            message_text = (
-                "Вопрос архитектуры ⚙️\n\n"
-                "Оставить всё как есть — это тоже стратегия. Но если цель — масштаб, "
-                "систему нужно пересобрать. Бесплатная диагностика еще доступна по ссылке:"
-            )
+            message_text, reply_markup = self._second_reminder_message()
             
             await self.bot.send_message(
                 chat_id=user_id,
@@ -132,28 +139,52 @@ class NotificationService:
         except Exception as e:
             logger.error(f"Ошибка при отправке уведомления о завершении диагностики пользователю {user_id}: {e}")
     
-    async def check_and_send_reminders(self):
-        """Проверить и отправить напоминания (вызывается планировщиком)"""
-        logger.info("Проверка напоминаний запущена")
-        
-        # Первое напоминание
-        users_first = self.db.get_users_for_reminder("first")
-        logger.info(f"Найдено пользователей для первого напоминания: {len(users_first)}")
-        for user in users_first:
-            logger.info(f"Отправка первого напоминания пользователю {user['user_id']}")
-            await self.send_first_reminder(
-                user['user_id'],
-                user['username'],
-                user['first_name']
-            )
-        
-        # Второе напоминание
-        users_second = self.db.get_users_for_reminder("second")
-        logger.info(f"Найдено пользователей для второго напоминания: {len(users_second)}")
-        for user in users_second:
-            logger.info(f"Отправка второго напоминания пользователю {user['user_id']}")
-            await self.send_second_reminder(
-                user['user_id'],
-                user['username'],
-                user['first_name']
-            )
+    async def send_due_reminders(self, batch_size: int = 500) -> list:
+        """Отправить наступившие напоминания (по users.next_reminder_at); возвращает id обработанных"""
+        attempted = set()
+        while True:
+            users = [user for user in self.db.get_due_reminders(batch_size) if user['user_id'] not in attempted]
+            if not users:
+                break
+            logger.info(f"Наступило напоминаний: {len(users)}")
+            attempted.update(user['user_id'] for user in users)
+            await self._deliver_reminders([
+                (user['user_id'], 'second' if user['first_reminder_sent'] else 'first') for user in users
+            ])
+        return list(attempted)
+
+    async def _deliver_reminders(self, reminders: list) -> None:
+        """Отправить напоминания [(user_id, 'first' | 'second')] порциями по типу.
+
+        На порцию два запроса к БД: захват (claim_reminders — отметка до отправки, без
+        повторной отправки) и возврат захвата для временных ошибок доставки. Пользователям,
+        которым отправка невозможна (бот заблокирован), напоминание остается отмеченным,
+        а запланированное вслед второе снимается.
+        """
+        for kind in ('first', 'second'):
+            user_ids = [user_id for user_id, reminder_kind in reminders if reminder_kind == kind]
+            if not user_ids:
+                continue
+            claimed = self.db.claim_reminders(user_ids, kind)
+            if not claimed:
+                continue
+
+            if kind == 'first':
+                message_text, reply_markup = self._first_reminder_message()
+            else:
+                message_text, reply_markup = self._second_reminder_message()
+            report = await self.delivery.run([
+                (user['user_id'], self._sender(user['user_id'], message_text, reply_markup)) for user in claimed
+            ])
+
+            permanent = set(report['permanent_failures'])
+            retry = [user_id for user_id in report['failed'] if user_id not in permanent]
+            if retry:
+                self.db.release_reminder_claims(retry, kind, retry_seconds=REMINDER_RETRY_SECONDS)
+            if permanent:
+                self.db.drop_undeliverable_reminders(list(permanent))
+            logger.info(f"Напоминания '{kind}': захвачено {len(claimed)}, доставлено {len(report['delivered'])}, "
+                        f"повтор {len(retry)}, недоставляемых {len(permanent)}")
+
+    def _sender(self, chat_id: int, text: str, reply_markup: InlineKeyboardMarkup):
+        return lambda: self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
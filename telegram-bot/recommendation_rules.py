@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Декларативные правила рекомендаций
+
+Правило — условия над профилем пользователя (segment, engagement_level, conversion_potential,
+diagnostics_completed, content_preference, behavior_patterns) и действия: списки, которые
+добавляются к соответствующим полям результата. Таблица компилируется один раз в RuleSet:
+правила с условием на конкретный сегмент раскладываются по сегментам, условия — в предикаты.
+
+Форма условия:
+  'field': value          — равенство
+  'field': [v1, v2]       — значение входит в список
+  'field': {'contains': s} — поле-список содержит элемент, в котором есть подстрока s
+"""
+import logging
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Рекомендации персонального отчета (/api/user/<id>/personal-report)
+REPORT_OUTPUTS = ('next_steps', 'automatic_actions', 'content_suggestions', 'cta_suggestions')
+
+REPORT_RULES = [
+    {
+        'name': 'newcomer',
+        'when': {'segment': 'newcomer'},
+        'then': {
+            'next_steps': [
+                'Пройти диагностику для персональных рекомендаций',
+                'Изучить основные разделы сайта',
+                'Ознакомиться с кейсами и услугами'
+            ],
+            'content_suggestions': ['Введение', 'О компании', 'Услуги'],
+            'cta_suggestions': ['Записаться на консультацию', 'Связаться'],
+        },
+    },
+    {
+        'name': 'engaged',
+        'when': {'segment': 'engaged'},
+        'then': {
+            'next_steps': [
+                'Углубить изучение конкретных услуг',
+                'Посмотреть кейсы по интересующим направлениям',
+                'Связаться для детального обсуждения'
+            ],
+            'content_suggestions': ['Кейсы', 'Технологии', 'Результаты'],
+            'cta_suggestions': ['Получить предложение', 'Записаться на встречу'],
+        },
+    },
+    {
+        'name': 'converter',
+        'when': {'segment': 'converter'},
+        'then': {
+            'next_steps': [
+                'Обсудить детали сотрудничества',
+                'Подготовить техническое задание',
+                'Определить сроки и бюджет'
+            ],
+            'automatic_actions': [
+                'Отправка персонального коммерческого предложения',
+                'Приглашение на презентацию услуг'
+            ],
+            'content_suggestions': ['Тарифы', 'Процессы', 'Гарантии'],
+            'cta_suggestions': ['Начать проект', 'Подписать договор'],
+        },
+    },
+    {
+        'name': 'loyal',
+        'when': {'segment': 'loyal'},
+        'then': {
+            'next_steps': [
+                'Обсудить расширение сотрудничества',
+                'Рассмотреть новые направления',
+                'Стать партнером или рефералом'
+            ],
+            'automatic_actions': [
+                'Персональные предложения по новым услугам',
+                'Приглашения на эксклюзивные мероприятия'
+            ],
+            'content_suggestions': ['Новости', 'Партнерские программы', 'Эксклюзивные материалы'],
+            'cta_suggestions': ['Стать партнером', 'Рекомендовать услуги'],
+        },
+    },
+]
+
+# Рекомендации для автоматических действий (UserSegmentation.get_personalized_recommendations)
+ACTION_OUTPUTS = ('recommendations', 'next_best_actions', 'content_suggestions')
+
+ACTION_RULES = [
+    {
+        'name': 'newcomer_onboarding',
+        'when': {'segment': 'newcomer'},
+        'then': {
+            'recommendations': [{'type': 'onboarding', 'priority': 'high',
+                                 'message': 'Показать приветственный тур по MiniApp'}],
+            'next_best_actions': ['diagnostic_start'],
+        },
+    },
+    {
+        'name': 'engaged_conversion',
+        'when': {'segment': 'engaged'},
+        'then': {
+            'recommendations': [{'type': 'conversion', 'priority': 'high',
+                                 'message': 'Предложить персональную диагностику'}],
+            'next_best_actions': ['personal_path_view'],
+        },
+    },
+    {
+        'name': 'converter_retention',
+        'when': {'segment': 'converter'},
+        'then': {
+            'recommendations': [{'type': 'retention', 'priority': 'medium',
+                                 'message': 'Показать дополнительные материалы по теме'}],
+            'next_best_actions': ['content_recommendation'],
+        },
+    },
+    {
+        'name': 'loyal_upsell',
+        'when': {'segment': 'loyal'},
+        'then': {
+            'recommendations': [{'type': 'upsell', 'priority': 'medium',
+                                 'message': 'Предложить премиум услуги'}],
+            'next_best_actions': ['advanced_features'],
+        },
+    },
+    {
+        'name': 'likes_sections',
+        'when': {'content_preference': {'contains': 'likes_section'}},
+        'then': {
+            'content_suggestions': [{'type': 'section', 'content': 'Похожие секции для изучения'}],
+        },
+    },
+    {
+        'name': 'ai_general',
+        'when': {'content_preference': {'contains': 'ai_general'}},
+        'then': {
+            'content_suggestions': [{'type': 'ai_interaction', 'content': 'Продолжить разговор с AI помощником'}],
+        },
+    },
+]
+
+
+def _compile_condition(field: str, expected: Any) -> Callable[[Dict[str, Any]], bool]:
+    if isinstance(expected, dict):
+        if set(expected) != {'contains'}:
+            raise ValueError(f"Неизвестный оператор условия для {field}: {expected}")
+        needle = expected['contains']
+        return lambda profile: any(needle in str(item) for item in profile.get(field) or ())
+    if isinstance(expected, (list, tuple, set, frozenset)):
+        allowed = frozenset(expected)
+        return lambda profile: profile.get(field) in allowed
+    return lambda profile: profile.get(field) == expected
+
+
+class _CompiledRule:
+    __slots__ = ('name', 'predicates', 'then')
+
+    def __init__(self, rule: Dict[str, Any], outputs: Tuple[str, ...]):
+        self.name = rule['name']
+        unknown = set(rule['then']) - set(outputs)
+        if unknown:
+            raise ValueError(f"Правило {self.name}: неизвестные действия {sorted(unknown)}")
+        self.then = {key: tuple(values) for key, values in rule['then'].items()}
+        # Условие на сегмент проверяется выбором корзины, а не предикатом
+        self.predicates = [_compile_condition(field, expected)
+                           for field, expected in rule.get('when', {}).items()
+                           if not (field == 'segment' and isinstance(expected, str))]
+
+
+class RuleSet:
+    """Скомпилированная таблица правил: результат — dict outputs -> список действий"""
+
+    def __init__(self, rules: List[Dict[str, Any]], outputs: Tuple[str, ...]):
+        self.outputs = outputs
+        self._rules: List[Tuple[Optional[str], _CompiledRule]] = []
+        for rule in rules:
+            segment = rule.get('when', {}).get('segment')
+            self._rules.append((segment if isinstance(segment, str) else None, _CompiledRule(rule, outputs)))
+
+        segments = {segment for segment, _ in self._rules if segment is not None}
+        # Для каждого сегмента — правила в исходном порядке: свои и не привязанные к сегменту
+        self._by_segment = {
+            segment: [rule for rule_segment, rule in self._rules if rule_segment in (segment, None)]
+            for segment in segments
+        }
+        self._generic = [rule for rule_segment, rule in self._rules if rule_segment is None]
+
+    def _candidates(self, profile: Dict[str, Any]) -> List[_CompiledRule]:
+        return self._by_segment.get(profile.get('segment'), self._generic)
+
+    def evaluate(self, profile: Dict[str, Any]) -> Dict[str, list]:
+        """Рекомендации для одного профиля"""
+        return self._build(self._matched(profile))
+
+    def _matched(self, profile: Dict[str, Any]) -> Tuple[_CompiledRule, ...]:
+        return tuple(rule for rule in self._candidates(profile)
+                     if all(predicate(profile) for predicate in rule.predicates))
+
+    def _build(self, matched: Tuple[_CompiledRule, ...]) -> Dict[str, list]:
+        result = {key: [] for key in self.outputs}
+        for rule in matched:
+            for key, values in rule.then.items():
+                result[key].extend(values)
+        return result
+
+    def evaluate_many(self, profiles: Iterable[Tuple[Hashable, Dict[str, Any]]]) -> Dict[Hashable, Dict[str, list]]:
+        """Рекомендации для многих профилей (key, profile).
+
+        Результат строится один раз на каждый набор сработавших правил и разделяется
+        пользователями с одинаковым набором — объекты результата не следует изменять.
+        """
+        built: Dict[Tuple[str, ...], Dict[str, list]] = {}
+        results = {}
+        for key, profile in profiles:
+            matched = self._matched(profile)
+            signature = tuple(rule.name for rule in matched)
+            result = built.get(signature)
+            if result is None:
+                result = built[signature] = self._build(matched)
+            results[key] = result
+        return results
+
+
+REPORT_RULESET = RuleSet(REPORT_RULES, REPORT_OUTPUTS)
+ACTION_RULESET = RuleSet(ACTION_RULES, ACTION_OUTPUTS)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Планировщик напоминаний по времени наступления
+
+Вместо опроса таблицы users раз в минуту держит min-heap времен напоминаний
+(users.next_reminder_at) и спит до ближайшего. Обработчики бота сообщают об изменениях
+(refresh / cancel), а редкая перезагрузка по индексу next_reminder_at подхватывает то,
+что изменилось в обход бота.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Как часто перечитывать ближайшие напоминания из БД и на сколько вперед
+DEFAULT_RELOAD_INTERVAL = 600
+# Пауза перед повторной попыткой, если напоминание после доставки все еще не отмечено
+DEFAULT_RETRY_DELAY = 60
+
+
+class ReminderScheduler:
+    """Min-heap (срок, user_id) с ленивым удалением устаревших записей"""
+
+    def __init__(self, db, deliver: Callable[[], Awaitable[List[int]]],
+                 reload_interval: float = DEFAULT_RELOAD_INTERVAL, retry_delay: float = DEFAULT_RETRY_DELAY,
+                 clock=time.monotonic):
+        """deliver() отправляет наступившие напоминания и возвращает id обработанных пользователей"""
+        self.db = db
+        self.deliver = deliver
+        self.reload_interval = reload_interval
+        self.retry_delay = retry_delay
+        self._clock = clock
+
+        self._heap: List[Tuple[float, int, int]] = []
+        # user_id -> актуальный срок; запись кучи с другим сроком считается устаревшей
+        self._deadlines: Dict[int, float] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, user_id: int, delay: Optional[float]) -> None:
+        """Запланировать напоминание через delay секунд (None — отменить)"""
+        if delay is None:
+            self._deadlines.pop(user_id, None)
+            return
+        deadline = self._clock() + max(0.0, delay)
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), user_id))
+        if self._wakeup is not None and self._heap[0][2] == user_id:
+            # Новый срок раньше текущего ожидания — пересчитать сон
+            self._wakeup.set()
+
+    def cancel(self, user_id: int) -> None:
+        self.schedule(user_id, None)
+
+    def refresh(self, user_ids: Iterable[int], retry_overdue: bool = False) -> None:
+        """Перечитать next_reminder_at пользователей из БД и обновить кучу.
+
+        retry_overdue — уже наступившие напоминания (доставка не удалась) откладываются на retry_delay.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        try:
+            now, schedule = self.db.get_reminder_schedule(user_ids=user_ids)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении расписания напоминаний: {e}")
+            return
+        for user_id in user_ids:
+            due = schedule.get(user_id)
+            if due is None:
+                self.cancel(user_id)
+            else:
+                delay = (due - now).total_seconds()
+                if retry_overdue and delay <= 0:
+                    delay = self.retry_delay
+                self.schedule(user_id, delay)
+
+    def reload(self) -> None:
+        """Загрузить напоминания, наступающие в ближайшие reload_interval секунд"""
+        try:
+            now, schedule = self.db.get_reminder_schedule(within_seconds=self.reload_interval)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке расписания напоминаний: {e}")
+            return
+        for user_id, due in schedule.items():
+            # Уже запланированные не трогаем: у них может быть отложенный повтор
+            if user_id not in self._deadlines:
+                self.schedule(user_id, (due - now).total_seconds())
+        logger.info(f"Расписание напоминаний загружено: {len(schedule)} в ближайшие {self.reload_interval} с")
+
+    def _pop_due(self, now: float) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, user_id = heapq.heappop(self._heap)
+            if self._deadlines.get(user_id) == deadline:
+                del self._deadlines[user_id]
+                due.append(user_id)
+        return due
+
+    def _next_deadline(self) -> Optional[float]:
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    async def run_once(self) -> List[int]:
+        """Доставить наступившие напоминания; возвращает id обработанных пользователей"""
+        due = self._pop_due(self._clock())
+        if not due:
+            return []
+        try:
+            processed = await self.deliver()
+        except Exception as e:
+            logger.error(f"Ошибка при доставке напоминаний: {e}")
+            processed = []
+        # Следующий этап (второе напоминание) или повтор, если доставка не удалась
+        self.refresh(set(due) | set(processed), retry_overdue=True)
+        return processed
+
+    async def run(self) -> None:
+        """Основной цикл: спит до ближайшего срока или до изменения расписания"""
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        self.reload()
+        next_reload = self._clock() + self.reload_interval
+        logger.info("Планировщик напоминаний запущен")
+
+        while not self._stopped:
+            if self._clock() >= next_reload:
+                self.reload()
+                next_reload = self._clock() + self.reload_interval
+
+            await self.run_once()
+
+            deadline = self._next_deadline()
+            wake_at = next_reload if deadline is None else min(deadline, next_reload)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, wake_at - self._clock()))
+            except asyncio.TimeoutError:
+                pass
+
+        logger.info("Планировщик напоминаний остановлен")
+
+    def stop(self) -> None:
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
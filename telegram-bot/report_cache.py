@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+LRU кеш сериализованных персональных отчетов с учетом занимаемой памяти
+Запись валидна, пока версия данных пользователя (user_data_versions) не изменилась
+"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+# Примерная стоимость служебных объектов записи: ключ, кортеж, узел OrderedDict
+ENTRY_OVERHEAD = 200
+
+
+class ReportCache:
+    """Потокобезопасный LRU кеш: key -> (version, payload bytes), ограниченный по суммарному размеру"""
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes должен быть положительным")
+        self.max_bytes = max_bytes
+        # Одна запись не должна вытеснять значительную часть кеша
+        self.max_entry_bytes = max_bytes // 8
+
+        self._entries: 'OrderedDict[Hashable, Tuple[int, bytes]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(payload: bytes) -> int:
+        return len(payload) + ENTRY_OVERHEAD
+
+    def get(self, key: Hashable, version: int) -> Optional[bytes]:
+        """Отчет для версии данных version или None (устаревшая запись удаляется)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != version:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, version: int, payload: bytes) -> bool:
+        """Сохранить отчет; возвращает False, если он слишком большой для кеша"""
+        size = self._entry_size(payload)
+        if size > self.max_entry_bytes:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (version, payload)
+            self._bytes += size
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key: Hashable) -> None:
+        _, payload = self._entries.pop(key)
+        self._bytes -= self._entry_size(payload)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
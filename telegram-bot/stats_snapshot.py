@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Снимок статистики бота для команды /stats
+
+Счетчики читаются из БД в фоне (задача JobQueue раз в STATS_REFRESH_INTERVAL секунд,
+запрос выполняется в отдельном потоке), а /stats отвечает из памяти. Если снимок старше
+max_age, команда возвращает имеющийся и запускает одно фоновое обновление. Скорости
+(события и напоминания в минуту) считаются по разнице счетчиков между замерами в окне RATE_WINDOW.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Как часто обновлять снимок в фоне и когда считать его устаревшим
+STATS_REFRESH_INTERVAL = 60
+# Окно, по которому считаются скорости
+RATE_WINDOW = 300
+
+
+class StatsSnapshot:
+    """Кешированные счетчики /stats и скорости по последним замерам"""
+
+    def __init__(self, db, max_age: float = STATS_REFRESH_INTERVAL, rate_window: float = RATE_WINDOW,
+                 clock=time.monotonic):
+        self.db = db
+        self.max_age = max_age
+        self.rate_window = rate_window
+        self._clock = clock
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._refreshed_at: Optional[float] = None
+        # (время замера, события, отправленные напоминания)
+        self._samples: Deque[Tuple[float, int, int]] = deque()
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def age(self) -> Optional[float]:
+        return None if self._refreshed_at is None else self._clock() - self._refreshed_at
+
+    def refresh(self) -> Dict[str, Any]:
+        """Перечитать счетчики из БД (блокирующий вызов) и пересчитать скорости"""
+        counters = self.db.get_bot_stats_counters()
+        now = self._clock()
+        reminders_sent = counters['first_reminders_sent'] + counters['second_reminders_sent']
+        self._samples.append((now, counters['events_total'], reminders_sent))
+        # Самый старый оставшийся замер — последний, сделанный не позже начала окна
+        while len(self._samples) > 2 and self._samples[1][0] <= now - self.rate_window:
+            self._samples.popleft()
+
+        events_per_min = reminders_per_min = None
+        base_time, base_events, base_reminders = self._samples[0]
+        if now > base_time:
+            minutes = (now - base_time) / 60
+            events_per_min = round(max(0, counters['events_total'] - base_events) / minutes, 1)
+            # Освобожденные после неудачной отправки захваты уменьшают счетчик — не уходим в минус
+            reminders_per_min = round(max(0, reminders_sent - base_reminders) / minutes, 1)
+
+        counters['events_per_min'] = events_per_min
+        counters['reminders_per_min'] = reminders_per_min
+        counters['rate_window_seconds'] = round(now - base_time)
+        self._snapshot = counters
+        self._refreshed_at = now
+        return counters
+
+    async def refresh_async(self) -> Optional[Dict[str, Any]]:
+        """Обновить снимок в потоке; одновременные вызовы ждут одно и то же обновление"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(asyncio.to_thread(self.refresh))
+        try:
+            return await asyncio.shield(self._refresh_task)
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении статистики: {e}")
+            return self._snapshot
+
+    async def get(self) -> Optional[Dict[str, Any]]:
+        """Снимок из памяти; БД читается, только если снимка еще нет"""
+        if self._snapshot is None:
+            return await self.refresh_async()
+        if self.age() > self.max_age and (self._refresh_task is None or self._refresh_task.done()):
+            # Отвечаем имеющимся снимком, свежий подготовится к следующему запросу
+            asyncio.ensure_future(self.refresh_async())
+        return self._snapshot
@@ -3,26 +3,96 @@
 Система сегментации пользователей
 Автоматически определяет сегменты пользователей на основе их поведения
 """
+import argparse
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 from db import Database
 
 logger = logging.getLogger(__name__)
 
+# Пользователей в одной порции пакетного расчета сегментов
+SEGMENT_BATCH_SIZE = 500
+
+# Потоков для выполнения автоматических действий
+AUTOMATION_WORKERS = 4
+
+# Диапазонов user_id на процесс при параллельном расчете сегментов (выравнивает нагрузку)
+SHARDS_PER_WORKER = 4
+
+AUTOMATED_ACTIONS = {
+    'welcome_messages': 'приветственное сообщение',
+    'diagnostic_reminders': 'напоминание о диагностике',
+    'content_recommendations': 'рекомендация контента',
+    'personal_offers': 'персональное предложение'
+}
+
+def _shard_user_ids(user_ids: List[int], workers: int) -> List[List[int]]:
+    """Разбить пользователей на непрерывные диапазоны user_id для процессов пула"""
+    ids = sorted(user_ids)
+    size = max(SEGMENT_BATCH_SIZE, -(-len(ids) // (workers * SHARDS_PER_WORKER)))
+    return [ids[offset:offset + size] for offset in range(0, len(ids), size)]
+
+
+def _compute_segment_shard(db_spec: str, user_ids: List[int]) -> Tuple[Dict[int, int], Dict[int, dict]]:
+    """Версии данных и сегменты диапазона пользователей (выполняется в процессе пула).
+
+    Процесс открывает собственное соединение (sqlite — только на чтение); запись
+    результатов выполняет родительский процесс.
+    """
+    db = Database(db_spec, read_only=True)
+    versions: Dict[int, int] = {}
+    segments: Dict[int, dict] = {}
+    for offset in range(0, len(user_ids), SEGMENT_BATCH_SIZE):
+        chunk = user_ids[offset:offset + SEGMENT_BATCH_SIZE]
+        # Версии читаются до расчета: запись, пришедшая во время расчета, оставит пользователя «грязным»
+        versions.update(db.get_user_data_versions(chunk))
+        segments.update(db.get_segments_batch(chunk, include_preferences=False))
+    return versions, segments
+
+
 class UserSegmentation:
     """Класс для сегментации пользователей"""
 
     def __init__(self, db_path: str = "bot_users.db"):
         self.db = Database(db_path)
 
-    def update_user_segments(self) -> Dict[str, int]:
-        """Обновить сегменты для всех активных пользователей"""
+    def _compute_segments(self, user_ids: List[int], workers: int = 1) -> Iterator[Tuple[Dict[int, int], Dict[int, dict]]]:
+        """Порции (версии данных, сегменты) для пользователей.
+
+        workers > 1 — диапазоны user_id считаются в пуле процессов, порции выдаются
+        по мере готовности диапазонов.
+        """
+        if workers <= 1:
+            for offset in range(0, len(user_ids), SEGMENT_BATCH_SIZE):
+                chunk = user_ids[offset:offset + SEGMENT_BATCH_SIZE]
+                try:
+                    yield self.db.get_user_data_versions(chunk), self.db.get_segments_batch(chunk, include_preferences=False)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке пользователей {chunk[0]}..{chunk[-1]}: {e}")
+            return
+
+        shards = _shard_user_ids(user_ids, workers)
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards) or 1)) as pool:
+            futures = {pool.submit(_compute_segment_shard, self.db.db_spec, shard): shard for shard in shards}
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    shard = futures[future]
+                    logger.error(f"Ошибка при обработке пользователей {shard[0]}..{shard[-1]}: {e}")
+
+    def update_user_segments(self, full: bool = False, workers: int = 1) -> Dict[str, int]:
+        """Обновить сегменты пользователей и сохранить их в user_segments.
+
+        По умолчанию пересчитываются только пользователи, данные которых изменились
+        с прошлого расчета; full=True — все активные за последние 30 дней.
+        workers > 1 — расчет в пуле процессов по диапазонам user_id.
+        """
         logger.info("Начинаем обновление сегментов пользователей...")
 
-        # Получить всех активных пользователей (с событиями за последние 30 дней)
-        active_users = self._get_active_users(days=30)
-
         segment_counts = {
             'total_processed': 0,
             'newcomer': 0,
@@ -31,220 +101,143 @@ class UserSegmentation:
             'loyal': 0
         }
 
-        for user_id in active_users:
-            try:
-                segment = self.db.get_user_segment(user_id)
+        if not full and workers <= 1:
+            result = self.db.refresh_dirty_segments(SEGMENT_BATCH_SIZE)
+            for segment, count in result['segments'].items():
+                segment_counts[segment] += count
+            segment_counts['total_processed'] = result['processed']
+            logger.info(f"Обновление сегментов завершено. Обработано: {segment_counts['total_processed']} пользователей")
+            return segment_counts
+
+        if full:
+            # Все активные пользователи (с событиями за последние 30 дней)
+            user_ids = self._get_active_users(days=30)
+        else:
+            user_ids = [user_id for chunk in self.db.iter_dirty_segment_users(SEGMENT_BATCH_SIZE) for user_id in chunk]
+
+        # Сегменты считаются пакетно: сгруппированные запросы на порцию вместо ~10 запросов на пользователя
+        for versions, segments in self._compute_segments(user_ids, workers):
+            self.db.save_user_segments(segments, versions)
+            for user_id, segment in segments.items():
                 segment_counts[segment['segment']] += 1
                 segment_counts['total_processed'] += 1
-
-                # Логируем изменение сегмента (можно сохранить в БД для истории)
                 logger.debug(f"Пользователь {user_id}: сегмент {segment['segment']}, вовлеченность {segment['engagement_level']}")
 
-            except Exception as e:
-                logger.error(f"Ошибка при обработке пользователя {user_id}: {e}")
-
         logger.info(f"Обновление сегментов завершено. Обработано: {segment_counts['total_processed']} пользователей")
         return segment_counts
 
     def get_segment_insights(self, segment: str) -> Dict[str, Any]:
-        """Получить аналитику по сегменту"""
-        users = self.db.get_segment_users({'segment': segment})
-
-        if not users:
-            return {'segment': segment, 'users_count': 0, 'insights': {}}
-
-        insights = {
-            'segment': segment,
-            'users_count': len(users),
-            'insights': {
-                'avg_sessions': 0,
-                'avg_events': 0,
-                'conversion_rate': 0,
-                'top_sources': [],
-                'top_content_types': [],
-                'engagement_distribution': {},
-                'behavior_patterns': []
-            }
-        }
+        """Получить аналитику по сегменту (по всем пользователям из users).
 
-        # Собираем статистику по пользователям сегмента
-        total_sessions = 0
-        total_events = 0
-        converted_users = 0
-        sources = {}
-        content_types = {}
-        behavior_patterns = {}
-
-        for user_id in users[:100]:  # Ограничиваем для производительности
-            try:
-                analytics = self.db.get_user_analytics(user_id)
-
-                total_sessions += analytics.get('total_sessions', 0)
-                total_events += analytics.get('total_events', 0)
-
-                if analytics.get('diagnostics_completed'):
-                    converted_users += 1
-
-                # Анализируем источники
-                user_patterns = self.db._analyze_behavior_patterns(user_id)
-                for pattern in user_patterns:
-                    if 'source_' in pattern:
-                        sources[pattern] = sources.get(pattern, 0) + 1
-
-                # Анализируем предпочтения контента
-                preferences = self.db._analyze_content_preferences(user_id)
-                for pref in preferences:
-                    if pref.startswith('likes_'):
-                        content_types[pref] = content_types.get(pref, 0) + 1
-
-                # Собираем паттерны поведения
-                for pattern in user_patterns:
-                    behavior_patterns[pattern] = behavior_patterns.get(pattern, 0) + 1
-
-            except Exception as e:
-                logger.error(f"Ошибка при анализе пользователя {user_id}: {e}")
-
-        # Вычисляем средние значения
-        user_count = len(users)
-        if user_count > 0:
-            insights['insights']['avg_sessions'] = total_sessions / user_count
-            insights['insights']['avg_events'] = total_events / user_count
-            insights['insights']['conversion_rate'] = converted_users / user_count
-
-        # Топ источников
-        insights['insights']['top_sources'] = sorted(
-            sources.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:5]
-
-        # Топ типов контента
-        insights['insights']['top_content_types'] = sorted(
-            content_types.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:5]
-
-        # Паттерны поведения
-        insights['insights']['behavior_patterns'] = sorted(
-            behavior_patterns.items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:10]
-
-        return insights
+        Перед расчетом сегменты пересчитываются инкрементально: пользователи без строки
+        в user_segments считаются «грязными», поэтому первый вызов заполняет сегменты всех
+        пользователей, а следующие пересчитывают только изменившихся.
+        """
+        self.update_user_segments()
+        return self.db.get_segment_insights(segment)
 
     def get_personalized_recommendations(self, tg_user_id: int) -> Dict[str, Any]:
-        """Получить персонализированные рекомендации для пользователя"""
-        try:
-            segment = self.db.get_user_segment(tg_user_id)
-            analytics = self.db.get_user_analytics(tg_user_id)
-
-            recommendations = {
-                'user_id': tg_user_id,
-                'segment': segment['segment'],
-                'engagement_level': segment['engagement_level'],
-                'recommendations': [],
-                'next_best_actions': [],
-                'content_suggestions': []
-            }
-
-            # Логика рекомендаций на основе сегмента
-            if segment['segment'] == 'newcomer':
-                recommendations['recommendations'].append({
-                    'type': 'onboarding',
-                    'priority': 'high',
-                    'message': 'Показать приветственный тур по MiniApp'
-                })
-                recommendations['next_best_actions'].append('diagnostic_start')
-
-            elif segment['segment'] == 'engaged':
-                recommendations['recommendations'].append({
-                    'type': 'conversion',
-                    'priority': 'high',
-                    'message': 'Предложить персональную диагностику'
-                })
-                recommendations['next_best_actions'].append('personal_path_view')
-
-            elif segment['segment'] == 'converter':
-                recommendations['recommendations'].append({
-                    'type': 'retention',
-                    'priority': 'medium',
-                    'message': 'Показать дополнительные материалы по теме'
-                })
-                recommendations['next_best_actions'].append('content_recommendation')
-
-            elif segment['segment'] == 'loyal':
-                recommendations['recommendations'].append({
-                    'type': 'upsell',
-                    'priority': 'medium',
-                    'message': 'Предложить премиум услуги'
-                })
-                recommendations['next_best_actions'].append('advanced_features')
-
-            # Рекомендации контента на основе предпочтений
-            content_prefs = segment.get('content_preference', [])
-            if 'likes_section' in str(content_prefs):
-                recommendations['content_suggestions'].append({
-                    'type': 'section',
-                    'content': 'Похожие секции для изучения'
-                })
-
-            if 'ai_general' in str(content_prefs):
-                recommendations['content_suggestions'].append({
-                    'type': 'ai_interaction',
-                    'content': 'Продолжить разговор с AI помощником'
-                })
-
-            return recommendations
+        """Получить персонализированные рекомендации для пользователя.
 
+        Правила — recommendation_rules.ACTION_RULES; результат хранится в user_recommendations
+        и пересчитывается только при изменении данных пользователя.
+        """
+        try:
+            return self.db.get_user_recommendations(tg_user_id)
         except Exception as e:
             logger.error(f"Ошибка при генерации рекомендаций для пользователя {tg_user_id}: {e}")
             return {'error': str(e)}
 
-    def trigger_automated_actions(self) -> Dict[str, int]:
-        """Выполнить автоматические действия на основе сегментов"""
+    def refresh_recommendations(self) -> int:
+        """Пересчитать сохраненные рекомендации пользователей с изменившимися данными"""
+        return self.db.refresh_user_recommendations()
+
+    def build_segment_snapshot(self, workers: int = 1) -> Dict[str, Any]:
+        """Снимок сегментации всех пользователей.
+
+        Пересчитываются только пользователи, данные которых изменились с прошлого расчета
+        (workers > 1 — в пуле процессов), затем сегменты всех пользователей читаются одним
+        запросом к user_segments. Сам снимок (время, размеры сегментов) — в segment_snapshots.
+        """
+        started = time.perf_counter()
+        self.update_user_segments(workers=workers)
+        segments = self.db.get_segment_memberships()
+
+        counts: Dict[str, int] = {}
+        for segment in segments.values():
+            counts[segment['segment']] = counts.get(segment['segment'], 0) + 1
+
+        duration_ms = int((time.perf_counter() - started) * 1000)
+        snapshot_id = self.db.save_segment_snapshot(counts, len(segments), duration_ms)
+        return {'id': snapshot_id, 'users': segments, 'counts': counts}
+
+    @staticmethod
+    def _select(snapshot: Dict[str, Any], criteria: Dict[str, Any], limit: int) -> List[int]:
+        """Пользователи снимка, подходящие под критерии (по возрастанию user_id)"""
+        selected = []
+        for user_id in sorted(snapshot['users']):
+            segment = snapshot['users'][user_id]
+            if all(segment.get(key) == value for key, value in criteria.items()):
+                selected.append(user_id)
+                if len(selected) >= limit:
+                    break
+        return selected
+
+    def _dispatch_action(self, action: str, user_id: int) -> str:
+        """Выполнить автоматическое действие для пользователя"""
+        # Здесь можно интегрировать отправку сообщений в Telegram
+        logger.info(f"Триггер: {AUTOMATED_ACTIONS[action]} для пользователя {user_id}")
+        return action
+
+    def trigger_automated_actions(self, max_workers: int = AUTOMATION_WORKERS,
+                                  segment_workers: int = 1) -> Dict[str, Any]:
+        """Выполнить автоматические действия на основе сегментов.
+
+        Один снимок сегментации на прогон (segment_workers процессов); все выборки читают его.
+        Действия выполняются пулом из max_workers потоков. В результате — счетчики действий,
+        id снимка и время фаз.
+        """
         actions_triggered = {
             'welcome_messages': 0,
             'diagnostic_reminders': 0,
             'content_recommendations': 0,
             'personal_offers': 0
         }
+        timings_ms = {}
 
         try:
-            # Найти новичков для приветствия (пользователи с 1 сессией, без диагностики)
-            newcomers = self.db.get_segment_users({
-                'segment': 'newcomer',
-                'diagnostics_completed': False
-            })
-
-            for user_id in newcomers[:50]:  # Ограничиваем количество
-                # Здесь можно интегрировать отправку сообщений в Telegram
-                logger.info(f"Триггер: приветственное сообщение для пользователя {user_id}")
-                actions_triggered['welcome_messages'] += 1
-
-            # Найти пользователей, которые начали диагностику но не закончили
-            engaged_incomplete = self.db.get_segment_users({
-                'segment': 'engaged',
-                'diagnostics_completed': False
-            })
-
-            for user_id in engaged_incomplete[:30]:
-                logger.info(f"Триггер: напоминание о диагностике для пользователя {user_id}")
-                actions_triggered['diagnostic_reminders'] += 1
-
-            # Найти конвертированных пользователей для персональных рекомендаций
-            converters = self.db.get_segment_users({
-                'segment': 'converter'
-            })
-
-            for user_id in converters[:20]:
-                logger.info(f"Триггер: персональное предложение для пользователя {user_id}")
-                actions_triggered['personal_offers'] += 1
-
+            started = time.perf_counter()
+            snapshot = self.build_segment_snapshot(workers=segment_workers)
+            timings_ms['snapshot'] = int((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            planned = []
+            # Новички для приветствия (без диагностики)
+            planned += [('welcome_messages', user_id) for user_id in self._select(
+                snapshot, {'segment': 'newcomer', 'diagnostics_completed': False}, 50)]
+            # Вовлеченные, но не завершившие диагностику
+            planned += [('diagnostic_reminders', user_id) for user_id in self._select(
+                snapshot, {'segment': 'engaged', 'diagnostics_completed': False}, 30)]
+            # Конвертированные — персональные предложения
+            planned += [('personal_offers', user_id) for user_id in self._select(
+                snapshot, {'segment': 'converter'}, 20)]
+            timings_ms['select'] = int((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [pool.submit(self._dispatch_action, action, user_id) for action, user_id in planned]
+                for future in as_completed(futures):
+                    try:
+                        actions_triggered[future.result()] += 1
+                    except Exception as e:
+                        logger.error(f"Ошибка при выполнении автоматического действия: {e}")
+            timings_ms['dispatch'] = int((time.perf_counter() - started) * 1000)
+
+            actions_triggered['snapshot_id'] = snapshot['id']
         except Exception as e:
             logger.error(f"Ошибка при выполнении автоматических действий: {e}")
 
+        actions_triggered['timings_ms'] = timings_ms
         logger.info(f"Автоматические действия выполнены: {actions_triggered}")
         return actions_triggered
 
@@ -277,10 +270,10 @@ class UserSegmentation:
         finally:
             conn.close()
 
-def update_all_segments(db_path: str = "bot_users.db") -> Dict[str, int]:
-    """Обновить сегменты для всех пользователей"""
+def update_all_segments(db_path: str = "bot_users.db", full: bool = False, workers: int = 1) -> Dict[str, int]:
+    """Обновить сегменты пользователей (full=True — полный пересчет активных, workers — процессов)"""
     segmentation = UserSegmentation(db_path)
-    return segmentation.update_user_segments()
+    return segmentation.update_user_segments(full=full, workers=workers)
 
 def get_segment_report(segment: str, db_path: str = "bot_users.db") -> Dict[str, Any]:
     """Получить отчет по сегменту"""
@@ -292,21 +285,31 @@ def get_user_recommendations(tg_user_id: int, db_path: str = "bot_users.db") ->
     segmentation = UserSegmentation(db_path)
     return segmentation.get_personalized_recommendations(tg_user_id)
 
-def run_automated_actions(db_path: str = "bot_users.db") -> Dict[str, int]:
-    """Запустить автоматические действия"""
+def refresh_all_recommendations(db_path: str = "bot_users.db") -> int:
+    """Инкрементально обновить предрасчитанные рекомендации"""
+    segmentation = UserSegmentation(db_path)
+    return segmentation.refresh_recommendations()
+
+def run_automated_actions(db_path: str = "bot_users.db", workers: int = 1) -> Dict[str, Any]:
+    """Запустить автоматические действия (workers — процессов для снимка сегментации)"""
     segmentation = UserSegmentation(db_path)
-    return segmentation.trigger_automated_actions()
+    return segmentation.trigger_automated_actions(segment_workers=workers)
 
 if __name__ == "__main__":
-    # Пример использования
+    parser = argparse.ArgumentParser(description='Сегментация пользователей и автоматические действия')
+    parser.add_argument('--db', default='bot_users.db', help='путь к sqlite или DATABASE_URL')
+    parser.add_argument('--workers', type=int, default=1, help='процессов для расчета сегментов')
+    parser.add_argument('--full', action='store_true', help='пересчитать всех активных, а не только изменившихся')
+    args = parser.parse_args()
+
     print("Обновление сегментов пользователей...")
-    result = update_all_segments()
+    result = update_all_segments(args.db, full=args.full, workers=args.workers)
     print(f"Результат: {result}")
 
     print("\nПолучение отчета по сегменту 'engaged'...")
-    report = get_segment_report('engaged')
+    report = get_segment_report('engaged', args.db)
     print(f"Отчет: {report}")
 
     print("\nЗапуск автоматических действий...")
-    actions = run_automated_actions()
-    print(f"Действия: {actions}")
\ No newline at end of file
+    actions = run_automated_actions(args.db, workers=args.workers)
+    print(f"Действия: {actions}")
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Режим webhook: встроенный асинхронный HTTP сервер для обновлений Telegram
+
+Telegram сам присылает обновления POST-запросами на WEBHOOK_URL, поэтому нет задержки
+long polling. Сервер (asyncio, без сторонних зависимостей) проверяет заголовок
+X-Telegram-Bot-Api-Secret-Token, кладет обновление в update_queue приложения и сразу
+отвечает 200; обработку ведет Application (параллельно, если задан concurrent_updates).
+При остановке сервер перестает принимать запросы, дожидается начатых, а Application.stop()
+обрабатывает все уже принятые обновления.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import re
+import signal
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+# Допустимый секрет Telegram: 1-256 символов A-Z, a-z, 0-9, _ и -
+SECRET_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,256}$')
+MAX_BODY_SIZE = 1 << 20
+MAX_HEADERS = 100
+# Сколько держать простаивающее keep-alive соединение
+KEEPALIVE_TIMEOUT = 75
+# Сколько ждать завершения начатых запросов при остановке
+DRAIN_TIMEOUT = 30
+DEFAULT_MAX_CONNECTIONS = 40
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed', 411: 'Length Required', 413: 'Payload Too Large'}
+
+
+class WebhookServer:
+    """HTTP/1.1 сервер с keep-alive, принимающий обновления на path"""
+
+    def __init__(self, application: Application, secret_token: str, path: str = '/',
+                 host: str = '0.0.0.0', port: int = 8443):
+        if not SECRET_PATTERN.match(secret_token or ''):
+            raise ValueError("Секрет webhook: 1-256 символов A-Z, a-z, 0-9, _ и -")
+        self.application = application
+        self.secret_token = secret_token.encode('ascii')
+        self.path = path or '/'
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+        # writer -> обрабатывается ли сейчас запрос на этом соединении
+        self._connections: Dict[asyncio.StreamWriter, bool] = {}
+        self._idle = asyncio.Event()
+        self._closing = False
+        self.counters = {'accepted': 0, 'rejected': 0}
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # Порт 0 — выбирается системой (тесты, бенчмарк)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook сервер слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        """Перестать принимать запросы и дождаться начатых (не дольше timeout)"""
+        if self._server is None:
+            return
+        self._closing = True
+        self._server.close()
+        for writer, busy in list(self._connections.items()):
+            if not busy:
+                writer.close()
+        if any(self._connections.values()):
+            self._idle.clear()
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Webhook: не все запросы завершились до остановки")
+        await self._server.wait_closed()
+        self._server = None
+        logger.info(f"Webhook сервер остановлен: принято {self.counters['accepted']}, "
+                    f"отклонено {self.counters['rejected']}")
+
+    def _set_busy(self, writer: asyncio.StreamWriter, busy: bool) -> None:
+        self._connections[writer] = busy
+        if not busy and not any(self._connections.values()):
+            self._idle.set()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._set_busy(writer, False)
+        try:
+            while not self._closing:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), timeout=KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                self._set_busy(writer, True)
+                status, keep_alive = await self._handle_request(request_line, reader)
+                keep_alive = keep_alive and not self._closing
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('ascii')
+                )
+                await writer.drain()
+                self._set_busy(writer, False)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            logger.debug(f"Webhook: соединение прервано: {e}")
+        finally:
+            self._connections.pop(writer, None)
+            if not any(self._connections.values()):
+                self._idle.set()
+            writer.close()
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> Optional[Dict[str, str]]:
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return None
+
+    async def _handle_request(self, request_line: bytes, reader: asyncio.StreamReader) -> Tuple[int, bool]:
+        """(HTTP статус, можно ли продолжать соединение)"""
+        parts = request_line.decode('latin-1').split()
+        headers = await self._read_headers(reader)
+        if len(parts) != 3 or headers is None:
+            return self._reject(400, "некорректный запрос"), False
+        method, target, version = parts
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if 'content-length' not in headers:
+            # Без длины тело не дочитать (chunked Telegram не использует) — соединение закрываем
+            return self._reject(411 if method == 'POST' else 400, "нет Content-Length"), False
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            return self._reject(400, "некорректный Content-Length"), False
+        if length < 0 or length > MAX_BODY_SIZE:
+            return self._reject(413, f"тело {length} байт"), False
+        body = await reader.readexactly(length)
+
+        if target.split('?', 1)[0] != self.path:
+            return self._reject(404, f"путь {target}"), keep_alive
+        if method != 'POST':
+            return self._reject(405, f"метод {method}"), keep_alive
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode('latin-1'), self.secret_token):
+            return self._reject(403, "неверный секрет"), keep_alive
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            return self._reject(400, f"не удалось разобрать обновление: {e}"), keep_alive
+        if update is None:
+            return self._reject(400, "пустое обновление"), keep_alive
+
+        # Ответ 200 сразу после постановки в очередь: Telegram не ждет обработки
+        await self.application.update_queue.put(update)
+        self.counters['accepted'] += 1
+        return 200, keep_alive
+
+    def _reject(self, status: int, reason: str) -> int:
+        self.counters['rejected'] += 1
+        logger.warning(f"Webhook: запрос отклонен ({status}): {reason}")
+        return status
+
+
+async def serve_webhook(application: Application, webhook_url: str, secret_token: str,
+                        listen: str = '0.0.0.0', port: int = 8443, path: str = '/',
+                        allowed_updates: Optional[List[str]] = None,
+                        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                        stop_event: Optional[asyncio.Event] = None) -> None:
+    """Запустить приложение в режиме webhook и работать до SIGINT/SIGTERM (или stop_event).
+
+    Порядок запуска и остановки такой же, как в Application.run_polling: post_init до старта,
+    post_stop и post_shutdown после остановки.
+    """
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    server = WebhookServer(application, secret_token, path=path, host=listen, port=port)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=allowed_updates,
+            max_connections=max_connections,
+        )
+        logger.info(f"Webhook установлен: {webhook_url}")
+        await stop_event.wait()
+        logger.info("Остановка webhook: дожидаемся принятых обновлений")
+    finally:
+        # Сначала перестаем принимать обновления, затем обрабатываем уже принятые
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.remove_signal_handler(sig)
+            except (NotImplementedError, RuntimeError):
+                pass
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Тесты инкрементального профиля активности пользователя
+"""
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from db import _activity_patterns
+
+
+def add_history(db, tg_user_id):
+    """События и сессии, записанные до появления профилей (разные часы и дни)"""
+    conn = db.get_connection()
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (?, 'U')", (tg_user_id,))
+    for days_ago in (9, 5, 2):
+        session_id = conn.execute(
+            "INSERT INTO site_sessions (cookie_id, tg_user_id, session_start) VALUES (?, ?, datetime('now', ?))",
+            (f'ck{tg_user_id}', tg_user_id, f'-{days_ago} days')).lastrowid
+        for hour in (7, 7, 20):
+            conn.execute('''
+                INSERT INTO site_events (session_id, tg_user_id, event_type, event_name, created_at)
+                VALUES (?, ?, 'page_view', 'view', datetime('now', 'start of day', ?, ?))
+            ''', (session_id, tg_user_id, f'-{days_ago} days', f'+{hour} hours'))
+    conn.commit()
+    conn.close()
+
+
+def rebuilt_profile(db, tg_user_id):
+    """Профиль, построенный заново по истории"""
+    conn = db.get_connection()
+    conn.execute('DELETE FROM user_activity_profiles WHERE tg_user_id = ?', (tg_user_id,))
+    conn.commit()
+    conn.close()
+    return db.get_activity_profile(tg_user_id)
+
+
+def test_write_path_matches_rebuild_from_history(db):
+    add_history(db, 1)
+    # Первая запись строит профиль по истории, следующие обновляют его инкрементально
+    session_id = db.create_site_session('ck1', tg_user_id=1)
+    for _ in range(4):
+        db.log_event(session_id, 'page_view', 'view', tg_user_id=1)
+    db.create_site_session('ck1', tg_user_id=1)
+
+    incremental = db.get_activity_profile(1)
+    assert sum(incremental['hour_histogram']) == 9 + 4
+    assert incremental['hour_histogram'][7] >= 6 and incremental['sessions_count'] == 5
+
+    rebuilt = rebuilt_profile(db, 1)
+    assert incremental['hour_histogram'] == rebuilt['hour_histogram']
+    assert incremental['sessions_count'] == rebuilt['sessions_count']
+    assert incremental['first_seen_at'] == rebuilt['first_seen_at']
+    assert incremental['first_session_at'] == rebuilt['first_session_at']
+    last_seen = [datetime.fromisoformat(p['last_seen_at']) for p in (incremental, rebuilt)]
+    assert abs((last_seen[0] - last_seen[1]).total_seconds()) <= 1
+    assert _activity_patterns(incremental) == _activity_patterns(rebuilt)
+    assert _activity_patterns(incremental)[1] == 'regular_visitor'
+
+
+def test_profile_without_history(db):
+    assert db.get_activity_profile(2) is None
+    session_id = db.create_site_session('ck2', tg_user_id=2)
+    profile = db.get_activity_profile(2)
+    assert profile['sessions_count'] == 1 and not any(profile['hour_histogram'])
+    assert _activity_patterns(profile) == ['frequent_visitor']
+
+    db.log_event(session_id, 'click', 'cta', tg_user_id=2)
+    profile = db.get_activity_profile(2)
+    assert profile['hour_histogram'][datetime.utcnow().hour] == 1
+    assert profile['hour_histogram'] == rebuilt_profile(db, 2)['hour_histogram']
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Тесты рассылок по сегментам (очередь broadcast_outbox и отправитель)
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from telegram.error import Forbidden, TimedOut
+
+import delivery
+from broadcast import BroadcastSender, send_active_campaigns
+from delivery import DeliveryEngine, RateLimiter
+
+
+def seed(db):
+    conn = db.get_connection()
+    conn.executemany('INSERT INTO users (user_id, first_name) VALUES (?, ?)', [(i, 'U') for i in range(1, 7)])
+    conn.commit()
+    conn.close()
+    # Сегменты заданы вручную; версия 0 (данных нет) — enqueue не пересчитывает их
+    db.save_user_segments({i: {
+        'segment': 'engaged' if i <= 4 else 'newcomer', 'engagement_level': 'medium',
+        'conversion_potential': 'high', 'diagnostics_completed': i == 4,
+    } for i in range(1, 7)}, {i: 0 for i in range(1, 7)})
+
+
+class FakeBot:
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if self.errors.get(chat_id):
+            raise self.errors[chat_id].pop(0)
+        self.sent.append(chat_id)
+
+
+def test_enqueue_is_idempotent(db):
+    seed(db)
+    criteria = {'segment': 'engaged', 'diagnostics_completed': False}
+    campaign_id = db.create_broadcast_campaign('october', 'Привет', criteria)
+    assert db.create_broadcast_campaign('october', 'Привет', criteria) == campaign_id
+
+    assert db.enqueue_broadcast(campaign_id) == 3
+    assert db.enqueue_broadcast(campaign_id) == 0
+    assert db.get_broadcast_progress(campaign_id) == {'pending': 3, 'sending': 0, 'sent': 0, 'failed': 0, 'total': 3}
+
+
+def test_sender_classifies_failures_and_resumes(db, monkeypatch):
+    monkeypatch.setattr(delivery, 'NETWORK_RETRY_DELAY', 0)
+    seed(db)
+    campaign_id = db.create_broadcast_campaign('october', 'Привет', {'segment': 'engaged'})
+    db.enqueue_broadcast(campaign_id)
+
+    # 2 заблокировал бота, 3 недоступен в первом прогоне порций и доставляется во втором
+    bot = FakeBot({2: [Forbidden('bot was blocked by the user')], 3: [TimedOut()]})
+    engine = DeliveryEngine(RateLimiter(global_rate=1000, per_chat_rate=1000), max_retries=0)
+    totals = asyncio.run(BroadcastSender(bot, db, delivery=engine, batch_size=2).run(campaign_id))
+
+    assert sorted(bot.sent) == [1, 3, 4]
+    assert totals['progress'] == {'pending': 0, 'sending': 0, 'sent': 3, 'failed': 1, 'total': 4}
+    assert totals['completed'] is True
+
+    # Повторный запуск ничего не отправляет
+    again = asyncio.run(BroadcastSender(bot, db, delivery=engine).run(campaign_id))
+    assert again['delivered'] == 0 and sorted(bot.sent) == [1, 3, 4]
+
+
+def test_enqueue_refreshes_changed_segments(db):
+    seed(db)
+    conn = db.get_connection()
+    # Пользователь 7 появился после расчета сегментов: у него есть данные, но нет строки user_segments
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (7, 'U')")
+    conn.execute('INSERT INTO user_data_versions (tg_user_id, version) VALUES (7, 1)')
+    # Пользователь 8 только запустил бота: данных и строки user_segments нет
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (8, 'U')")
+    conn.commit()
+    conn.close()
+
+    campaign_id = db.create_broadcast_campaign('newcomers', 'Привет', {'segment': 'newcomer'})
+    assert db.enqueue_broadcast(campaign_id) == 4
+    assert db.claim_broadcast_batch(campaign_id, 10) == [5, 6, 7, 8]
+
+
+def test_bot_sends_active_campaigns_with_shared_delivery(db):
+    seed(db)
+    engaged = db.create_broadcast_campaign('engaged', 'Привет', {'segment': 'engaged'})
+    newcomers = db.create_broadcast_campaign('newcomers', 'Привет', {'segment': 'newcomer'})
+    db.enqueue_broadcast(engaged)
+    db.enqueue_broadcast(newcomers)
+
+    bot = FakeBot({})
+    engine = DeliveryEngine(RateLimiter(global_rate=1000, per_chat_rate=1000))
+    engine_runs = []
+    run = engine.run
+    engine.run = lambda *args, **kwargs: engine_runs.append(1) or run(*args, **kwargs)
+    results = asyncio.run(send_active_campaigns(bot, db, engine))
+
+    assert sorted(results) == [engaged, newcomers]
+    assert sorted(bot.sent) == [1, 2, 3, 4, 5, 6]
+    # Обе кампании прошли через переданный (общий с напоминаниями) лимитер
+    assert len(engine_runs) == 2
+    assert db.get_active_broadcast_campaigns() == []
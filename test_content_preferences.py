@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Тесты счетчиков предпочтений контента
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+# user_id -> (просмотры по типу контента, AI взаимодействия по типу разговора)
+ACTIVITY = {
+    1: ({'article': 5, 'video': 3, 'course': 2, 'podcast': 1}, {'consultation': 4, 'smalltalk': 2, 'faq': 1}),
+    2: ({'video': 1}, {}),
+    3: ({}, {'faq': 2}),
+}
+
+
+def record_activity(db):
+    conn = db.get_connection()
+    for user_id in ACTIVITY:
+        conn.execute("INSERT INTO users (user_id, first_name) VALUES (?, 'U')", (user_id,))
+    conn.commit()
+    conn.close()
+    for user_id, (views, interactions) in ACTIVITY.items():
+        session_id = db.create_site_session(f'ck{user_id}', tg_user_id=user_id)
+        for content_type, count in views.items():
+            for i in range(count):
+                assert db._save_content_view(session_id, content_type, f'{content_type}-{i}', tg_user_id=user_id)
+        for conversation_type, count in interactions.items():
+            for _ in range(count):
+                assert db._save_ai_interaction(session_id, 3, ['topic'], 60, conversation_type, tg_user_id=user_id)
+    # Просмотр без пользователя счетчики не меняет
+    assert db._save_content_view(db.create_site_session('anon'), 'article', 'a-anon')
+
+
+def aggregated_preferences(db, tg_user_id):
+    """Предпочтения прежней агрегацией по content_views и ai_interactions"""
+    conn = db.get_connection()
+    try:
+        content_types = [row[0] for row in conn.execute('''
+            SELECT content_type, COUNT(*) AS views FROM content_views WHERE tg_user_id = ?
+            GROUP BY content_type ORDER BY views DESC LIMIT 3
+        ''', (tg_user_id,))]
+        ai_types = [row[0] for row in conn.execute('''
+            SELECT conversation_type, COUNT(*) AS interactions FROM ai_interactions WHERE tg_user_id = ?
+            GROUP BY conversation_type ORDER BY interactions DESC LIMIT 2
+        ''', (tg_user_id,))]
+    finally:
+        conn.close()
+    return [f'likes_{ctype}' for ctype in content_types] + [f'ai_{ai_type}' for ai_type in ai_types]
+
+
+def test_counters_match_aggregation(db):
+    record_activity(db)
+    batch = db.get_content_preferences_batch([1, 2, 3, 4, 2, None])
+    assert list(batch) == [1, 2, 3, 4]
+    for user_id in ACTIVITY:
+        assert batch[user_id] == aggregated_preferences(db, user_id)
+        assert db._analyze_content_preferences(user_id) == batch[user_id]
+    assert batch[1] == ['likes_article', 'likes_video', 'likes_course', 'ai_consultation', 'ai_smalltalk']
+    assert batch[4] == []
+
+
+def test_batch_endpoint(db, api_client):
+    record_activity(db)
+    response = api_client.post('/api/analytics/content-preferences/batch', json={'user_ids': [1, '3', 99]})
+    assert response.status_code == 200
+    assert response.get_json() == {'preferences': {
+        '1': aggregated_preferences(db, 1), '3': ['ai_faq'], '99': [],
+    }}
+
+    assert api_client.post('/api/analytics/content-preferences/batch', json={'user_ids': 1}).status_code == 400
+    assert api_client.post('/api/analytics/content-preferences/batch', json={'user_ids': ['x']}).status_code == 400
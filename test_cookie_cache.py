@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Тесты кеша cookie_id -> tg_user_id
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from cookie_cache import CookieUserCache, MISS
+from db import Database
+
+
+def test_positive_and_negative_ttl(clock):
+    cache = CookieUserCache(ttl=300, negative_ttl=30, clock=clock)
+    assert cache.get('a') is MISS
+    cache.put('a', 42)
+    cache.put('b', None)
+    assert cache.get('a') == 42
+    assert cache.get('b') is None
+
+    clock.now = 31
+    assert cache.get('b') is MISS
+    assert cache.get('a') == 42
+    clock.now = 301
+    assert cache.get('a') is MISS
+
+
+def test_invalidate_and_lru_limit():
+    cache = CookieUserCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is MISS
+    assert cache.get('a') == 1
+    cache.invalidate('a')
+    assert cache.get('a') is MISS
+
+
+def count_queries(db, monkeypatch):
+    """Счетчик SQL-запросов всех соединений, открытых через db.get_connection"""
+    statements = []
+    open_connection = Database.get_connection
+
+    def get_connection():
+        conn = open_connection(db)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(db, 'get_connection', get_connection)
+    return statements
+
+
+def test_user_by_cookie_is_one_query(db, monkeypatch):
+    conn = db.get_connection()
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (7, 'U')")
+    conn.commit()
+    conn.close()
+    db.link_telegram_to_cookie(7, 'linked')
+
+    statements = count_queries(db, monkeypatch)
+    assert db.get_user_by_cookie('linked')['user_id'] == 7
+    assert db.get_user_by_cookie('unknown') is None
+    assert len(statements) == 2
+
+    # Известное отсутствие привязки отвечается из кеша
+    assert db.resolve_cookie_user('unknown') is None
+    statements.clear()
+    assert db.get_user_by_cookie('unknown') is None
+    assert statements == []
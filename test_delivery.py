@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Тесты лимитера и движка доставки сообщений
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from telegram.error import Forbidden, RetryAfter, TimedOut
+
+import delivery
+from delivery import DeliveryEngine, RateLimiter, TokenBucket
+
+
+def test_token_bucket_reservations(clock):
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 0.5, 1.0]
+    clock.now = 10
+    assert bucket.reserve() == 0.0
+
+    bucket.pause(3)
+    assert bucket.reserve() == 3.0
+
+
+def test_per_chat_spacing(clock):
+    sleeps = []
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+        clock.now += seconds
+
+    limiter = RateLimiter(global_rate=1000, per_chat_rate=1, clock=clock, sleep=sleep)
+
+    async def run():
+        for chat_id in (1, 2, 1, 1):
+            await limiter.acquire(chat_id)
+
+    asyncio.run(run())
+    # Второе и третье сообщения в чат 1 ждут своей секунды
+    assert sleeps[0] == 1.0 and sleeps[-1] == 1.0
+
+
+def test_retries_and_permanent_failures(monkeypatch):
+    monkeypatch.setattr(delivery, 'NETWORK_RETRY_DELAY', 0)
+    attempts = {}
+
+    def sender(chat_id, errors):
+        async def send():
+            attempts[chat_id] = attempts.get(chat_id, 0) + 1
+            if errors:
+                raise errors.pop(0)
+        return send
+
+    engine = DeliveryEngine(RateLimiter(global_rate=1000, per_chat_rate=1000), concurrency=3, max_retries=2)
+    report = asyncio.run(engine.run([
+        (1, sender(1, [RetryAfter(0)])),
+        (2, sender(2, [Forbidden('bot was blocked by the user')])),
+        (3, sender(3, [TimedOut(), TimedOut(), TimedOut()])),
+        (4, sender(4, [])),
+    ]))
+
+    assert sorted(report['delivered']) == [1, 4]
+    assert set(report['failed']) == {2, 3}
+    assert report['permanent_failures'] == [2]
+    assert attempts == {1: 2, 2: 1, 3: 3, 4: 1}
+    assert report['rate_limited'] == 1
+    assert report['retries'] == 3
+
+
+def test_concurrency_is_bounded():
+    active = {'now': 0, 'max': 0}
+
+    async def send():
+        active['now'] += 1
+        active['max'] = max(active['max'], active['now'])
+        await asyncio.sleep(0.001)
+        active['now'] -= 1
+
+    engine = DeliveryEngine(RateLimiter(global_rate=10_000, per_chat_rate=1000), concurrency=5)
+    report = asyncio.run(engine.run([(chat_id, send) for chat_id in range(40)]))
+    assert len(report['delivered']) == 40
+    assert active['max'] == 5
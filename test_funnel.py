@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Тесты движка многошаговых воронок
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from funnel import FunnelEngine, FunnelStep, parse_steps
+
+HOUR = 3600
+
+STEPS = [
+    FunnelStep(name='visit', event_type='visit'),
+    FunnelStep(name='diagnostic', event_name='diagnostic_completed'),
+    FunnelStep(name='cta', event_type='cta', cta_location='footer'),
+]
+
+
+def event(user, ts, event_type, event_name='', section=None, cta_location=None):
+    return (user, ts, event_type, event_name, section, cta_location)
+
+
+def test_counts_drop_off_and_median():
+    events = [
+        event(1, 0, 'visit'), event(1, HOUR, 'diagnostic', 'diagnostic_completed'),
+        event(1, 3 * HOUR, 'cta', 'cta_click', cta_location='footer'),
+        event(2, 0, 'visit'), event(2, 3 * HOUR, 'diagnostic', 'diagnostic_completed'),
+        event(3, 0, 'visit'), event(3, HOUR, 'cta', 'cta_click', cta_location='footer'),
+    ]
+    report = FunnelEngine(STEPS, window_seconds=24 * HOUR).evaluate(events)
+
+    assert [s['users'] for s in report['steps']] == [3, 2, 1]
+    assert [s['drop_off'] for s in report['steps']] == [0, 1, 1]
+    assert report['steps'][1]['median_seconds_from_previous'] == 2 * HOUR
+    assert report['steps'][2]['median_seconds_from_previous'] == 2 * HOUR
+    assert report['users_completed'] == 1
+
+
+def test_steps_must_fit_window():
+    events = [
+        event(1, 0, 'visit'),
+        event(1, 30 * HOUR, 'diagnostic', 'diagnostic_completed'),
+    ]
+    report = FunnelEngine(STEPS, window_seconds=24 * HOUR).evaluate(events)
+    assert [s['users'] for s in report['steps']] == [1, 0, 0]
+
+
+def test_new_entry_after_expired_window():
+    events = [
+        event(1, 0, 'visit'),
+        event(1, 48 * HOUR, 'visit'),
+        event(1, 49 * HOUR, 'diagnostic', 'diagnostic_completed'),
+    ]
+    report = FunnelEngine(STEPS, window_seconds=24 * HOUR).evaluate(events)
+    assert [s['users'] for s in report['steps']] == [1, 1, 0]
+
+
+def test_cta_location_predicate():
+    events = [
+        event(1, 0, 'visit'), event(1, 1, 'diagnostic', 'diagnostic_completed'),
+        event(1, 2, 'cta', 'cta_click', cta_location='header'),
+    ]
+    report = FunnelEngine(STEPS).evaluate(events)
+    assert report['users_completed'] == 0
+
+
+def test_parse_steps_validation():
+    assert parse_steps([{'event_type': 'visit'}])[0].name == 'visit'
+    for bad in (None, [], [{}], [{'page': '/'}]):
+        try:
+            parse_steps(bad)
+        except ValueError:
+            continue
+        assert False, f"Ожидалась ошибка ValueError для {bad!r}"
+
+
+def test_reentry_keeps_earlier_attempt_open():
+    steps = [FunnelStep(name='visit', event_type='visit'),
+             FunnelStep(name='diagnostic', event_name='diagnostic_completed')]
+    events = [
+        event(1, 0, 'visit'),
+        event(1, 23 * HOUR, 'visit'),
+        event(1, 25 * HOUR, 'diagnostic', 'diagnostic_completed'),
+    ]
+    report = FunnelEngine(steps, window_seconds=24 * HOUR).evaluate(events)
+    assert [s['users'] for s in report['steps']] == [1, 1]
+    assert report['steps'][1]['median_seconds_from_previous'] == 2 * HOUR
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Тесты для HyperLogLog скетчей уникальных посетителей
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from hyperloglog import HyperLogLog
+
+
+def test_small_cardinality_is_exact():
+    sketch = HyperLogLog()
+    sketch.update(f"cookie_{i}" for i in range(50))
+    assert sketch.count() == 50
+
+
+def test_error_within_bound():
+    for n in (1000, 20000, 100000):
+        sketch = HyperLogLog()
+        sketch.update(f"cookie_{i}" for i in range(n))
+        # 3 сигмы от стандартной ошибки
+        assert abs(sketch.count() - n) / n < 3 * sketch.relative_error
+
+
+def test_duplicates_do_not_change_sketch():
+    sketch = HyperLogLog()
+    assert sketch.add("cookie_1") is True
+    assert sketch.add("cookie_1") is False
+    assert sketch.count() == 1
+
+
+def test_merge_equals_union():
+    a, b, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    a.update(range(0, 6000))
+    b.update(range(4000, 10000))
+    union.update(range(0, 10000))
+
+    a.merge(b)
+    assert a.registers == union.registers
+
+
+def test_serialization_roundtrip():
+    sketch = HyperLogLog(precision=10)
+    sketch.update(range(500))
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert restored.precision == 10
+    assert restored.count() == sketch.count()
+
+
+def test_merge_rejects_different_precision():
+    try:
+        HyperLogLog(precision=10).merge(HyperLogLog(precision=12))
+    except ValueError:
+        return
+    assert False, "Ожидалась ошибка ValueError"
+
+
+def log_visits(db):
+    """30 посетителей: 20 из vk (10 из них по кампании spring) и 10 из telegram, у части повторные визиты"""
+    for i in range(30):
+        cookie_id = f'ck{i}'
+        source = 'vk' if i < 20 else 'telegram'
+        utm = {'utm_campaign': 'spring'} if i < 10 else {}
+        for _ in range(1 if i % 3 else 2):
+            session_id = db.create_site_session(cookie_id)
+            db.log_source_visit(session_id, source, cookie_id, utm_params=utm)
+
+
+def test_unique_visitors_from_logged_visits(db):
+    log_visits(db)
+
+    assert db.get_unique_visitors()['unique_visitors'] == 30
+    by_source = db.get_unique_visitors(dimension='source')
+    assert by_source['breakdown'] == [{'value': 'vk', 'unique_visitors': 20},
+                                      {'value': 'telegram', 'unique_visitors': 10}]
+    assert db.get_unique_visitors(dimension='utm_campaign', value='spring')['unique_visitors'] == 10
+
+
+def test_unique_visitors_endpoint(db, api_client):
+    log_visits(db)
+
+    response = api_client.get('/api/analytics/unique-visitors', query_string={'dimension': 'source'})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['dimension'] == 'source' and result['unique_visitors'] == 30
+    assert {row['value']: row['unique_visitors'] for row in result['breakdown']} == {'vk': 20, 'telegram': 10}
+
+    # Скетчи дневные: в периоде без визитов посетителей нет
+    response = api_client.get('/api/analytics/unique-visitors',
+                              query_string={'start_date': '2020-01-01', 'end_date': '2020-01-31'})
+    assert response.get_json()['unique_visitors'] == 0
+    assert api_client.get('/api/analytics/unique-visitors', query_string={'dimension': 'page'}).status_code == 400
+    assert api_client.get('/api/analytics/unique-visitors', query_string={'start_date': '01.01.2020'}).status_code == 400
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Тесты кольцевых буферов персонального пути пользователя
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from db import JOURNEY_LIMITS
+
+
+def add_user(db, tg_user_id):
+    conn = db.get_connection()
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (?, 'U')", (tg_user_id,))
+    conn.commit()
+    conn.close()
+
+
+def rebuilt_journey(db, tg_user_id):
+    """Путь, построенный заново по site_events/site_sessions"""
+    conn = db.get_connection()
+    conn.execute('DELETE FROM user_journeys WHERE tg_user_id = ?', (tg_user_id,))
+    conn.commit()
+    conn.close()
+    return db.get_user_journey(tg_user_id)
+
+
+def test_miniapp_open_keeps_page_and_device(db):
+    add_user(db, 1)
+    session_id = db.create_site_session('ck1', tg_user_id=1)
+    assert db.get_user_journey(1)['miniapp_opens'][0]['device'] == 'Не определено'
+
+    assert db.log_miniapp_open(session_id, 'mobile', 'services', 'ck1', tg_user_id=1)
+    # Повторное открытие в той же сессии не перезаписывает первую страницу
+    db.log_miniapp_open(session_id, 'desktop', 'about', 'ck1', tg_user_id=1)
+    db.log_content_view(session_id, 'article', 'a1', None, 'services', 30, 60, 'ck1', 1)
+    db.log_cta_click(session_id, 'telegram', None, 'footer', None, 5, 'ck1', 1)
+
+    journey = db.get_user_journey(1)
+    opened = journey['miniapp_opens'][0]
+    assert (opened['page'], opened['device']) == ('services', 'mobile')
+    assert journey == rebuilt_journey(db, 1)
+
+
+def test_ring_buffer_keeps_latest_entries(db):
+    add_user(db, 2)
+    session_id = db.create_site_session('ck2', tg_user_id=2)
+    limit = JOURNEY_LIMITS['cta_clicks']
+    for step in range(limit + 5):
+        db.log_cta_click(session_id, 'telegram', None, 'footer', None, step + 1, 'ck2', 2)
+
+    clicks = db.get_user_journey(2)['cta_clicks']
+    assert [entry['duration'] for entry in clicks] == list(range(limit + 5, 5, -1))
+    # Построение по истории тоже оставляет не больше лимита записей раздела
+    assert len(rebuilt_journey(db, 2)['cta_clicks']) == limit
+
+
+def test_rebuild_for_user_with_history_only(db):
+    add_user(db, 3)
+    conn = db.get_connection()
+    session_id = conn.execute('''
+        INSERT INTO site_sessions (cookie_id, tg_user_id, page_id, device_type, session_start)
+        VALUES ('ck3', 3, 'home', 'mobile', datetime('now', '-1 day'))
+    ''').lastrowid
+    conn.execute('''
+        INSERT INTO site_events (session_id, tg_user_id, event_type, event_name, custom_data, created_at)
+        VALUES (?, 3, 'diagnostic', 'diagnostic_step', '{"progress": 40}', datetime('now', '-1 day'))
+    ''', (session_id,))
+    conn.commit()
+    conn.close()
+
+    journey = db.get_user_journey(3)
+    assert journey['miniapp_opens'][0]['page'] == 'home' and journey['diagnostics'][0]['progress'] == 40
+    # Построенный путь сохраняется, и следующая запись дописывается в буфер
+    db.log_event(session_id, 'diagnostic', 'diagnostic_step', tg_user_id=3, custom_data={'progress': 80})
+    assert [entry['progress'] for entry in db.get_user_journey(3)['diagnostics']] == [80, 40]
+
+
+def test_sessions_opened_in_same_second_keep_own_entries(db):
+    add_user(db, 4)
+    first = db.create_site_session('ck4', tg_user_id=4)
+    second = db.create_site_session('ck4', tg_user_id=4)
+    conn = db.get_connection()
+    conn.execute("UPDATE site_sessions SET session_start = '2024-01-01 10:00:00' WHERE tg_user_id = 4")
+    conn.commit()
+    conn.close()
+    rebuilt_journey(db, 4)
+
+    db.log_miniapp_open(first, 'mobile', 'services', 'ck4', tg_user_id=4)
+    db.log_miniapp_open(second, 'desktop', 'about', 'ck4', tg_user_id=4)
+
+    opens = db.get_user_journey(4)['miniapp_opens']
+    assert [(entry['session_id'], entry['page'], entry['device']) for entry in opens] == [
+        (second, 'about', 'desktop'), (first, 'services', 'mobile')]
+    assert opens == rebuilt_journey(db, 4)['miniapp_opens']
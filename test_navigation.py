@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Тесты подсчета переходов и путей навигации
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from navigation import NavigationAccumulator, PATH_KIND_ALL, PATH_KIND_TO_CTA, event_node
+
+
+def test_event_node():
+    assert event_node('cta', '/', 'about', 'footer') == 'cta:footer'
+    assert event_node('content', '/', 'about') == 'section:about'
+    assert event_node('page_view', '/', None) == 'page:/'
+    assert event_node('click', None, None) is None
+
+
+def test_transitions_and_paths():
+    acc = NavigationAccumulator(path_length=3)
+    for event_id, node in enumerate(['page:/', 'section:a', 'section:a', 'section:b', 'cta:footer'], 1):
+        acc.add(1, event_id, node)
+    acc.add(2, 10, 'page:/')
+    acc.add(2, 11, 'section:b')
+
+    assert acc.transitions == {
+        ('page:/', 'section:a'): 1,
+        ('section:a', 'section:b'): 1,
+        ('section:b', 'cta:footer'): 1,
+        ('page:/', 'section:b'): 1,
+    }
+    assert acc.paths[(PATH_KIND_ALL, 'page:/ > section:a > section:b')] == 1
+    assert acc.paths[(PATH_KIND_TO_CTA, 'section:a > section:b > cta:footer')] == 1
+
+
+def test_previous_event_id_overrides_order():
+    acc = NavigationAccumulator()
+    acc.add(1, 1, 'page:/')
+    acc.add(1, 2, 'section:a')
+    acc.add(1, 3, 'section:b', previous_event_id=1)
+    assert acc.transitions[('page:/', 'section:b')] == 1
+    assert ('section:a', 'section:b') not in acc.transitions
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Тесты очереди генерации PDF
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
+
+from pdf_jobs import PdfJobManager, PdfQueueFull, STATUS_DONE, STATUS_FAILED, STATUS_QUEUED
+
+
+def fake_renderer(html, path):
+    if 'broken' in html:
+        raise RuntimeError('render failed')
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-' + html.encode())
+    return path
+
+
+def make_manager(tmp_path, **kwargs):
+    return PdfJobManager(str(tmp_path), executor=ThreadPoolExecutor(max_workers=1),
+                         renderer=fake_renderer, **kwargs)
+
+
+def test_render_and_content_hash_cache(tmp_path):
+    jobs = make_manager(tmp_path)
+    first = jobs.submit('<p>report</p>', 'a.pdf')
+    jobs._executor.shutdown(wait=True)
+    assert jobs.get(first['jobId'])['status'] == STATUS_DONE
+    with open(jobs.file_path(first['jobId']), 'rb') as f:
+        assert f.read() == b'%PDF-<p>report</p>'
+
+    again = jobs.submit('<p>report</p>', 'b.pdf')
+    assert again['status'] == STATUS_DONE and again['cached'] is True
+    assert again['jobId'] != first['jobId']
+
+
+def test_failure_dedup_and_queue_limit(tmp_path):
+    release = threading.Event()
+
+    def slow_renderer(html, path):
+        release.wait(5)
+        return fake_renderer(html, path)
+
+    jobs = make_manager(tmp_path, max_pending=1)
+    jobs.renderer = slow_renderer
+    first = jobs.submit('broken', 'x.pdf')
+    assert first['status'] == STATUS_QUEUED
+    # Тот же HTML не ставится в очередь повторно
+    assert jobs.submit('broken', 'y.pdf')['jobId'] == first['jobId']
+    try:
+        jobs.submit('other', 'z.pdf')
+        assert False, 'ожидалось PdfQueueFull'
+    except PdfQueueFull:
+        pass
+
+    release.set()
+    jobs._executor.shutdown(wait=True)
+    failed = jobs.get(first['jobId'])
+    assert failed['status'] == STATUS_FAILED and failed['error'] == 'render failed'
+    assert jobs.file_path(first['jobId']) is None
+
+
+def test_callback_host_allowlist(tmp_path):
+    jobs = make_manager(tmp_path, callback_hosts=['hooks.example.com'])
+    assert jobs.callback_allowed('https://hooks.example.com/pdf')
+    assert not jobs.callback_allowed('http://169.254.169.254/latest')
+    assert not jobs.callback_allowed('file:///etc/passwd')
+
+
+def test_dedup_notifies_every_callback(tmp_path):
+    release = threading.Event()
+    renders = []
+
+    def slow_renderer(html, path):
+        renders.append(html)
+        release.wait(5)
+        return fake_renderer(html, path)
+
+    jobs = make_manager(tmp_path, callback_hosts=['hooks.example.com'])
+    jobs.renderer = slow_renderer
+    notified = []
+    jobs._send_callback = lambda job, url: notified.append((job['id'], job['status'], url))
+
+    first = jobs.submit('<p>shared</p>', 'a.pdf', callback_url='https://hooks.example.com/a')
+    second = jobs.submit('<p>shared</p>', 'b.pdf', callback_url='https://hooks.example.com/b')
+    assert second['jobId'] == first['jobId'] and notified == []
+
+    release.set()
+    jobs._executor.shutdown(wait=True)
+    assert renders == ['<p>shared</p>']
+    assert sorted(notified) == [(first['jobId'], STATUS_DONE, 'https://hooks.example.com/a'),
+                                (first['jobId'], STATUS_DONE, 'https://hooks.example.com/b')]
+
+
+def test_endpoint_refuses_jobs_without_renderer(api_client, tmp_path, monkeypatch):
+    import app
+    import pdf_jobs
+
+    manager = PdfJobManager(str(tmp_path), executor=ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(app, 'pdf_jobs', manager)
+    monkeypatch.setattr(pdf_jobs, 'renderer_available', lambda: False)
+
+    response = api_client.post('/api/generate-personal-report-pdf', json={'reportData': {'user': {}}})
+    assert response.status_code == 503
+    # Задача не создана
+    assert manager._jobs == {}
+
+    monkeypatch.setattr(pdf_jobs, 'renderer_available', lambda: True)
+    assert manager.renderer_ready()
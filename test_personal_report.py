@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Тесты сборки данных персонального отчета
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+import pytest
+
+LEGACY_FIRST_VISIT_SQL = '''
+    SELECT cookie_id, source, utm_params, referrer, MIN(session_start) as first_visit
+    FROM site_sessions
+    WHERE tg_user_id = ?
+    GROUP BY cookie_id, source, utm_params, referrer
+    ORDER BY first_visit ASC
+    LIMIT 1
+'''
+
+
+def legacy_report(db, tg_user_id):
+    """Раздел user и сегментация прежними запросами эндпоинта и get_user_segment"""
+    user_info = {'tg_user_id': tg_user_id, 'cookie_id': None, 'traffic_source': 'Не определен',
+                 'utm_params': {}, 'referrer': None, 'first_visit_date': None}
+    conn = db.get_connection()
+    row = conn.execute(LEGACY_FIRST_VISIT_SQL, (tg_user_id,)).fetchone()
+    conn.close()
+    if row:
+        user_info.update(cookie_id=row[0], traffic_source=row[1] or 'Не определен',
+                         utm_params=json.loads(row[2]) if row[2] else {}, referrer=row[3],
+                         first_visit_date=row[4])
+    segment = db.get_user_segment(tg_user_id)
+    # Отчет не включает предпочтения и паттерны поведения
+    segment.update(content_preference=[], behavior_patterns=[])
+    return user_info, segment
+
+
+def seed(db):
+    conn = db.get_connection()
+    for user_id in (1, 2, 3):
+        conn.execute("INSERT INTO users (user_id, first_name) VALUES (?, 'U')", (user_id,))
+    # Старые сессии пользователя 1 — первый визит из vk
+    for days_ago, source in ((20, 'vk'), (12, 'telegram'), (5, 'direct')):
+        conn.execute('''
+            INSERT INTO site_sessions (cookie_id, tg_user_id, source, utm_params, referrer, session_start)
+            VALUES ('ck1', 1, ?, ?, ?, datetime('now', ?))
+        ''', (source, json.dumps({'utm_campaign': source}), f'https://{source}.example', f'-{days_ago} days'))
+    conn.commit()
+    conn.close()
+
+    session_id = db.create_site_session('ck1', tg_user_id=1)
+    for i in range(16):
+        db.log_content_view(session_id, 'article', f'a{i}', None, 'services', 30, 60, 'ck1', 1)
+    db.log_cta_click(session_id, 'telegram', None, 'footer', None, 5, 'ck1', 1)
+    db.save_diagnostics_result(1, {'score': 7}, cookie_id='ck1')
+
+    session_id = db.create_site_session('ck2', tg_user_id=2)
+    db.log_source_visit(session_id, 'telegram', 'ck2', {'utm_source': 'tg'}, tg_user_id=2)
+
+
+def test_report_matches_previous_queries(db):
+    seed(db)
+    for tg_user_id in (1, 2, 3):
+        report = db.get_personal_report_data(tg_user_id)
+        user_info, segment = legacy_report(db, tg_user_id)
+        assert report['user'] == user_info
+        assert report['segmentation'] == segment
+
+    report = db.get_personal_report_data(1)
+    assert report['user']['traffic_source'] == 'vk'
+    assert report['segmentation']['segment'] == 'engaged' and report['segmentation']['diagnostics_completed']
+    assert report['journey']['content_views'] and report['journey']['cta_clicks']
+    assert db.get_personal_report_data(3)['journey'] == {category: [] for category in report['journey']}
+
+
+def test_segment_report_data_matches_single_reports(db):
+    seed(db)
+    batches = list(db.iter_segment_report_data({}, chunk_size=2))
+    # Диапазоны по 2 пользователя: 1-2 и 3
+    assert [scanned for scanned, _ in batches] == [2, 1]
+    reports = [data for _, batch in batches for data in batch]
+    assert reports == [db.get_personal_report_data(tg_user_id) for tg_user_id in (1, 2, 3)]
+
+    engaged = [data['user']['tg_user_id'] for _, batch in db.iter_segment_report_data({'segment': 'engaged'})
+               for data in batch]
+    assert engaged == [1]
+
+
+def test_segment_report_data_rejects_unknown_criteria(db):
+    with pytest.raises(ValueError):
+        next(db.iter_segment_report_data({'city': 'Москва'}))
+    with pytest.raises(ValueError):
+        next(db.iter_segment_report_data({}, chunk_size=0))
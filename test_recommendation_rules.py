@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Тесты таблицы правил рекомендаций
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from recommendation_rules import ACTION_RULESET, REPORT_RULESET, RuleSet
+
+
+def test_segment_and_preference_rules():
+    result = ACTION_RULESET.evaluate({'segment': 'engaged', 'content_preference': ['likes_section', 'ai_general']})
+    assert result['next_best_actions'] == ['personal_path_view']
+    assert [s['type'] for s in result['content_suggestions']] == ['section', 'ai_interaction']
+
+    report = REPORT_RULESET.evaluate({'segment': 'converter'})
+    assert report['cta_suggestions'] == ['Начать проект', 'Подписать договор']
+    assert len(report['automatic_actions']) == 2
+    assert REPORT_RULESET.evaluate({'segment': 'unknown'})['next_steps'] == []
+
+
+def test_evaluate_many_shares_results_per_rule_set():
+    profiles = [(1, {'segment': 'newcomer'}), (2, {'segment': 'newcomer'}),
+                (3, {'segment': 'newcomer', 'content_preference': ['ai_general']})]
+    results = ACTION_RULESET.evaluate_many(profiles)
+    assert results[1] is results[2]
+    assert results[3]['content_suggestions'] and not results[1]['content_suggestions']
+    assert results[3]['next_best_actions'] == ['diagnostic_start']
+
+
+def test_list_condition_and_validation():
+    rules = RuleSet([{'name': 'warm', 'when': {'engagement_level': ['medium', 'high']}, 'then': {'tags': ['warm']}}],
+                    ('tags',))
+    assert rules.evaluate({'engagement_level': 'high'}) == {'tags': ['warm']}
+    assert rules.evaluate({'engagement_level': 'low'}) == {'tags': []}
+    try:
+        RuleSet([{'name': 'bad', 'when': {}, 'then': {'unknown': []}}], ('tags',))
+        assert False, 'ожидался ValueError'
+    except ValueError:
+        pass
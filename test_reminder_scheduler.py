@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Тесты планировщика напоминаний по времени наступления
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from reminder_scheduler import ReminderScheduler
+
+EPOCH = datetime(2024, 1, 1)
+
+
+class FakeDb:
+    """next_reminder_at в секундах от EPOCH; время БД совпадает с часами теста"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.due = {}
+
+    def get_reminder_schedule(self, user_ids=None, within_seconds=None):
+        now = EPOCH + timedelta(seconds=self.clock())
+        schedule = {}
+        for user_id, seconds in self.due.items():
+            due = EPOCH + timedelta(seconds=seconds)
+            if user_ids is not None and user_id not in user_ids:
+                continue
+            if within_seconds is not None and due > now + timedelta(seconds=within_seconds):
+                continue
+            schedule[user_id] = due
+        return now, schedule
+
+
+def make_scheduler(clock, deliver_ok=True):
+    db = FakeDb(clock)
+    delivered = []
+
+    async def deliver():
+        due = [uid for uid, seconds in db.due.items() if seconds <= clock()]
+        delivered.append(due)
+        if deliver_ok:
+            for uid in due:
+                del db.due[uid]
+        return due
+
+    return ReminderScheduler(db, deliver, reload_interval=600, retry_delay=60, clock=clock), db, delivered
+
+
+def test_fires_only_due_users(clock):
+    scheduler, db, delivered = make_scheduler(clock)
+    db.due = {1: 10, 2: 100, 3: 5000}
+    scheduler.reload()
+    # Напоминание за горизонтом перезагрузки не загружается
+    assert len(scheduler) == 2
+
+    assert asyncio.run(scheduler.run_once()) == []
+    clock.now = 10
+    assert asyncio.run(scheduler.run_once()) == [1]
+    assert len(scheduler) == 1
+    clock.now = 100
+    assert asyncio.run(scheduler.run_once()) == [2]
+    assert delivered == [[1], [2]]
+
+
+def test_cancel_and_reschedule(clock):
+    scheduler, db, delivered = make_scheduler(clock)
+    db.due = {1: 10, 2: 20}
+    scheduler.reload()
+    # Пользователь 1 начал диагностику, пользователю 2 напоминание перенесено
+    del db.due[1]
+    scheduler.cancel(1)
+    db.due[2] = 300
+    scheduler.refresh([2])
+
+    clock.now = 30
+    asyncio.run(scheduler.run_once())
+    assert delivered == []
+    clock.now = 300
+    asyncio.run(scheduler.run_once())
+    assert delivered == [[2]]
+
+
+def test_failed_delivery_is_retried_after_delay(clock):
+    scheduler, db, delivered = make_scheduler(clock, deliver_ok=False)
+    db.due = {1: 0}
+    scheduler.reload()
+    asyncio.run(scheduler.run_once())
+    clock.now = 30
+    asyncio.run(scheduler.run_once())
+    assert len(delivered) == 1
+    clock.now = 60
+    asyncio.run(scheduler.run_once())
+    assert len(delivered) == 2
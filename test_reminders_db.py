@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Тесты хранения и захвата напоминаний в БД (sqlite)
+"""
+import asyncio
+import os
+import sys
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from telegram.error import Forbidden, TimedOut
+
+import delivery
+from delivery import DeliveryEngine, RateLimiter
+from notifications import NotificationService
+
+
+def user_row(db, user_id):
+    conn = db.get_connection()
+    try:
+        return dict(conn.execute('''
+            SELECT first_reminder_sent, second_reminder_sent, next_reminder_at,
+                   next_reminder_at > CURRENT_TIMESTAMP AS in_future
+            FROM users WHERE user_id = ?
+        ''', (user_id,)).fetchone())
+    finally:
+        conn.close()
+
+
+def backdate(db, minutes):
+    """Сдвинуть started_at и next_reminder_at всех пользователей в прошлое"""
+    conn = db.get_connection()
+    conn.execute(f'''
+        UPDATE users SET started_at = datetime(started_at, '-{minutes} minutes'),
+                         next_reminder_at = datetime(next_reminder_at, '-{minutes} minutes')
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def test_init_db_builds_full_users_schema(db):
+    conn = db.get_connection()
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    conn.close()
+    assert {'next_reminder_at', 'diagnostics_completed_at'} <= columns
+    assert {'idx_users_next_reminder', 'idx_users_first_reminder_pending',
+            'idx_users_second_reminder_pending'} <= indexes
+
+
+def test_next_reminder_at_follows_user_state(db):
+    db.create_or_update_user(1, 'user1', 'U')
+    db.create_or_update_user(2, 'user2', 'U')
+
+    now, schedule = db.get_reminder_schedule()
+    # Первое напоминание — через 10 минут после /start
+    assert sorted(schedule) == [1, 2]
+    assert all(timedelta(minutes=9) < due - now <= timedelta(minutes=10) for due in schedule.values())
+    assert db.get_reminder_schedule(within_seconds=60)[1] == {}
+    assert sorted(db.get_reminder_schedule(user_ids=[2])[1]) == [2]
+    assert db.get_reminder_schedule(user_ids=[])[1] == {}
+    assert db.get_due_reminders() == []
+
+    backdate(db, 11)
+    due = db.get_due_reminders()
+    assert [user['user_id'] for user in due] == [1, 2] and due[0]['first_reminder_sent'] == 0
+    assert len(db.get_due_reminders(limit=1)) == 1
+
+    # После первого напоминания второе планируется на started_at + 24 часа
+    db.mark_reminder_sent(1, 'first')
+    now, schedule = db.get_reminder_schedule(user_ids=[1])
+    assert timedelta(hours=23) < schedule[1] - now < timedelta(hours=24)
+    # Повторный /start до диагностики переносит второе напоминание от нового started_at
+    db.create_or_update_user(1, 'user1', 'U')
+    now, schedule = db.get_reminder_schedule(user_ids=[1])
+    assert timedelta(hours=23, minutes=59) < schedule[1] - now <= timedelta(hours=24)
+
+    db.mark_reminder_sent(1, 'second')
+    db.mark_diagnostics_started(2)
+    assert db.get_reminder_schedule()[1] == {}
+    assert db.get_due_reminders() == []
+    # Начавшему диагностику /start напоминания не возвращает
+    db.create_or_update_user(2, 'user2', 'U')
+    assert user_row(db, 2)['next_reminder_at'] is None
+
+
+def test_reminder_candidates_predicate_uses_partial_indexes(db):
+    for user_id in (1, 2, 3, 4):
+        db.create_or_update_user(user_id, f'user{user_id}', 'U')
+    db.mark_reminder_sent(2, 'first')
+    db.mark_diagnostics_started(3)
+    conn = db.get_connection()
+    # 4 начал недавно — первое напоминание ему еще рано
+    conn.execute("UPDATE users SET started_at = datetime('now', '-11 minutes') WHERE user_id IN (1, 2, 3)")
+    conn.commit()
+
+    def candidates(kind):
+        return sorted(row[0] for row in conn.execute(db._reminder_candidates_sql(kind, 'user_id')))
+
+    assert candidates('first') == [1]
+    assert candidates('second') == []
+    conn.execute("UPDATE users SET started_at = datetime('now', '-25 hours') WHERE user_id IN (1, 2, 3)")
+    assert candidates('second') == [1, 2]
+
+    for kind in ('first', 'second'):
+        plan = ' '.join(row[-1] for row in conn.execute(
+            'EXPLAIN QUERY PLAN ' + db._reminder_candidates_sql(kind, 'user_id')))
+        assert f'idx_users_{kind}_reminder_pending' in plan
+    conn.close()
+
+
+class FakeBot:
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if self.errors.get(chat_id):
+            raise self.errors[chat_id].pop(0)
+        self.sent.append(chat_id)
+
+
+def test_claim_is_exclusive_and_release_reschedules(db):
+    for user_id in (1, 2):
+        db.create_or_update_user(user_id, f'user{user_id}', 'U')
+
+    claimed = db.claim_reminders([1, 2], 'first')
+    assert sorted(user['user_id'] for user in claimed) == [1, 2]
+    # Второй захват (другой процесс или повторный проход) ничего не получает
+    assert db.claim_reminders([1, 2], 'first') == []
+    # После захвата первого запланировано второе
+    assert user_row(db, 1)['first_reminder_sent'] == 1 and user_row(db, 1)['in_future'] == 1
+
+    assert db.release_reminder_claims([2], 'first', retry_seconds=60) == 1
+    row = user_row(db, 2)
+    assert row['first_reminder_sent'] == 0 and row['in_future'] == 1
+    assert [user['user_id'] for user in db.claim_reminders([2], 'first')] == [2]
+
+    # Начавший диагностику не захватывается и не возвращается
+    db.mark_diagnostics_started(1)
+    assert db.claim_reminders([1], 'second') == []
+    assert db.release_reminder_claims([1], 'first') == 0
+
+
+def test_permanent_failure_drops_the_second_reminder(db, monkeypatch):
+    monkeypatch.setattr(delivery, 'NETWORK_RETRY_DELAY', 0)
+    for user_id in (1, 2, 3):
+        db.create_or_update_user(user_id, f'user{user_id}', 'U')
+    backdate(db, 11)
+
+    # 2 заблокировал бота, 3 временно недоступен
+    bot = FakeBot({2: [Forbidden('bot was blocked by the user')], 3: [TimedOut()]})
+    engine = DeliveryEngine(RateLimiter(global_rate=1000, per_chat_rate=1000), max_retries=0)
+    service = NotificationService(bot, db, 'https://example.com', delivery=engine)
+    assert sorted(asyncio.run(service.send_due_reminders())) == [1, 2, 3]
+    assert bot.sent == [1]
+
+    delivered, blocked, retried = user_row(db, 1), user_row(db, 2), user_row(db, 3)
+    assert delivered['first_reminder_sent'] == 1 and delivered['second_reminder_sent'] == 0
+    assert delivered['next_reminder_at'] is not None
+    # Недоставляемому второе напоминание не планируется
+    assert blocked['first_reminder_sent'] == 1 and blocked['second_reminder_sent'] == 1
+    assert blocked['next_reminder_at'] is None
+    assert retried['first_reminder_sent'] == 0 and retried['in_future'] == 1
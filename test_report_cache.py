@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Тесты LRU кеша персональных отчетов
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from report_cache import ReportCache, ENTRY_OVERHEAD
+
+
+def test_version_mismatch_is_miss():
+    cache = ReportCache(max_bytes=1024 * 1024)
+    cache.put(1, 3, b'{"v": 3}')
+    assert cache.get(1, 3) == b'{"v": 3}'
+    assert cache.get(1, 4) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_lru_eviction_by_size():
+    entry = 1000
+    cache = ReportCache(max_bytes=3 * (entry + ENTRY_OVERHEAD) * 8)
+    cache.max_entry_bytes = cache.max_bytes
+    payload = b'x' * entry
+    for key in range(1, 25):
+        cache.put(key, 1, payload)
+    # Повторная запись делает ключ 1 самым свежим
+    cache.put(1, 1, payload)
+    cache.put(100, 1, payload)
+
+    stats = cache.stats()
+    assert stats['bytes'] <= cache.max_bytes
+    assert stats['evictions'] > 0
+    assert cache.get(1, 1) == payload
+    assert cache.get(2, 1) is None
+
+
+def test_oversized_payload_is_not_cached():
+    cache = ReportCache(max_bytes=8000)
+    assert cache.put(1, 1, b'x' * 2000) is False
+    assert cache.get(1, 1) is None
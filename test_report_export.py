@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Тесты массовой выгрузки персональных отчетов сегмента
+"""
+import io
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
+
+import pytest
+
+import report_export
+from personal_report import assemble_personal_report
+from report_export import iter_segment_export
+from test_personal_report import seed
+
+SCRIPT = os.path.join(os.path.dirname(__file__), 'scripts', 'export_segment_reports.py')
+
+
+def without_generated_at(report):
+    report.pop('generated_at')
+    return report
+
+
+def expected_lines(db, user_ids):
+    return [without_generated_at(json.loads(json.dumps(
+        assemble_personal_report(db.get_personal_report_data(user_id)), ensure_ascii=False, default=str)))
+        for user_id in user_ids]
+
+
+def read_lines(text):
+    return [without_generated_at(json.loads(line)) for line in text.splitlines()]
+
+
+def test_ndjson_export_renders_in_pool(db):
+    seed(db)
+    states = []
+    stream = iter_segment_export(db, {}, fmt='ndjson', chunk_size=2, workers=2, progress=states.append)
+    reports = read_lines(b''.join(stream).decode('utf-8'))
+
+    assert reports == expected_lines(db, (1, 2, 3))
+    assert [(state['scanned_users'], state['exported_reports']) for state in states] == [(2, 2), (3, 3)]
+
+
+def test_zip_export_has_report_per_user(db):
+    seed(db)
+    data = b''.join(iter_segment_export(db, {'segment': 'engaged'}, fmt='zip', chunk_size=2, workers=2))
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.namelist() == ['report_1.html']
+        assert archive.read('report_1.html').decode('utf-8').lstrip().startswith('<')
+
+
+def test_export_validates_before_streaming(db):
+    with pytest.raises(ValueError):
+        iter_segment_export(db, {}, fmt='csv')
+    with pytest.raises(ValueError):
+        iter_segment_export(db, {'city': 'Москва'})
+    with pytest.raises(ValueError):
+        iter_segment_export(db, ['segment'])
+
+
+def test_exports_share_one_pool(db):
+    seed(db)
+    b''.join(iter_segment_export(db, {}, workers=2))
+    pool = report_export._pool
+    b''.join(iter_segment_export(db, {}, fmt='zip', workers=2))
+    assert pool is not None and report_export._pool is pool
+
+
+def test_endpoint_rejects_non_object_criteria(api_client):
+    response = api_client.post('/api/analytics/segment-reports/export', json={'criteria': ['segment']})
+    assert response.status_code == 400
+
+
+def test_export_script_writes_file_and_progress(db, tmp_path):
+    seed(db)
+    out = tmp_path / 'engaged.ndjson'
+    result = subprocess.run(
+        [sys.executable, SCRIPT, '--db', db.db_path, '--segment', 'engaged', '--out', str(out),
+         '--chunk', '2', '--workers', '2'],
+        capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 0, result.stderr
+    assert read_lines(out.read_text(encoding='utf-8')) == expected_lines(db, (1,))
+    assert result.stderr.count('Просмотрено пользователей') == 2
+    assert f'Готово: {out}' in result.stdout
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Тесты предкомпилированного шаблона персонального отчета
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
+
+from report_template import CompiledTemplate, render_personal_report
+
+
+def test_compiled_template_render():
+    template = CompiledTemplate('<p>{{ a }}</p>{{b}}!')
+    assert template.slots == ['a', 'b']
+    assert template.render({'a': '1', 'b': '2'}) == '<p>1</p>2!'
+
+
+def test_personal_report_escapes_user_fields():
+    html = render_personal_report({
+        'generated_at': '2026-01-23T17:00:00Z',
+        'user': {'tg_user_id': 1, 'cookie_id': '<script>alert(1)</script>'},
+        'segmentation': {'user_segment': 'loyal'},
+        'recommendations': {'next_steps': ['a & b', '2', '3', '4']},
+    })
+    assert '<script>' not in html
+    assert '&lt;script&gt;alert(1)&lt;/script&gt;' in html
+    assert '<li>a &amp; b</li><li>2</li><li>3</li>' in html and '<li>4</li>' not in html
+    assert '#9b59b6' in html
+    assert '✨ Персональный отчет • 23.01.2026 ✨' in html
+    assert '{{' not in html
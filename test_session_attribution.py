@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Тесты денормализованной атрибуции сессий (источник и UTM в site_sessions)
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from db import SESSION_ATTRIBUTION_FIELDS
+
+# cookie_id -> визиты сессии (source, utm_params, referrer), диагностик, кликов CTA
+SESSIONS = {
+    'ck1': ([('telegram', {'utm_source': 'tg', 'utm_campaign': 'spring'}, None)], 1, 2),
+    # Атрибуция первого касания: второй визит заполняет только пустые колонки
+    'ck2': ([('vk', {'utm_campaign': 'spring'}, 'https://vk.com'),
+             ('direct', {'utm_medium': 'post', 'utm_campaign': 'autumn'}, 'https://other.example')], 0, 1),
+    'ck3': ([('direct', {}, None)], 1, 0),
+    'ck4': ([], 0, 1),
+}
+
+
+def attribution_columns(db):
+    columns = ', '.join(SESSION_ATTRIBUTION_FIELDS + ('utm_params',))
+    conn = db.get_connection()
+    try:
+        return {row['cookie_id']: dict(row) for row in conn.execute(
+            f'SELECT cookie_id, {columns} FROM site_sessions ORDER BY id')}
+    finally:
+        conn.close()
+
+
+def test_backfill_matches_write_path(db):
+    for cookie_id, (visits, diagnostics, cta_clicks) in SESSIONS.items():
+        session_id = db.create_site_session(cookie_id)
+        for source, utm_params, referrer in visits:
+            db.log_source_visit(session_id, source, cookie_id, utm_params=utm_params, referrer=referrer)
+        for _ in range(diagnostics):
+            db.log_event(session_id, 'diagnostic', 'diagnostic_completed')
+        for _ in range(cta_clicks):
+            db.log_cta_click(session_id, 'consultation', cookie_id=cookie_id)
+
+    written = attribution_columns(db)
+    report = db.get_source_attribution()
+    assert written['ck2']['source'] == 'vk' and written['ck2']['utm_medium'] == 'post'
+    assert written['ck2']['referrer'] == 'https://vk.com'
+    assert json.loads(written['ck2']['utm_params']) == {'utm_campaign': 'spring'}
+    assert written['ck4']['source'] is None
+    by_group = {(row['source'], row['utm_campaign']): row for row in report['attribution']}
+    assert by_group[('telegram', 'spring')]['diagnostics'] == 1
+    assert by_group[('telegram', 'spring')]['cta_clicks'] == 2
+    assert by_group[('unknown', None)]['cta_conversion'] == 1.0
+
+    # Сессии до денормализации: колонки пустые, атрибуция только в JSON событий source_visit
+    conn = db.get_connection()
+    conn.execute('UPDATE site_sessions SET ' + ', '.join(
+        f'{field} = NULL' for field in SESSION_ATTRIBUTION_FIELDS + ('utm_params',)))
+    conn.commit()
+    conn.close()
+    assert db.get_source_attribution() != report
+
+    assert db.backfill_session_attribution(chunk_size=2) == 3
+    assert attribution_columns(db) == written
+    assert db.get_source_attribution() == report
+    # Повторный запуск ничего не меняет
+    assert db.backfill_session_attribution() == 0
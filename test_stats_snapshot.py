@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Тесты снимка статистики /stats
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+from stats_snapshot import StatsSnapshot
+
+
+class FakeDb:
+    def __init__(self):
+        self.calls = 0
+        self.events = 0
+        self.reminders = 0
+
+    def get_bot_stats_counters(self):
+        self.calls += 1
+        return {
+            'total_users': 10, 'started_diagnostics': 2,
+            'first_reminders_sent': self.reminders, 'second_reminders_sent': 0,
+            'pending_first_reminder': 0, 'events_total': self.events,
+            'segmentation_dirty': 0, 'segmentation_lag_seconds': 0.0, 'recent_users': [],
+        }
+
+
+def test_rates_from_counter_deltas(clock):
+    db = FakeDb()
+    snapshot = StatsSnapshot(db, rate_window=300, clock=clock)
+    first = snapshot.refresh()
+    assert first['events_per_min'] is None
+
+    clock.now, db.events, db.reminders = 120, 60, 4
+    stats = snapshot.refresh()
+    assert stats['events_per_min'] == 30.0
+    assert stats['reminders_per_min'] == 2.0
+
+    # Замеры старше окна отбрасываются: база — последний замер, сделанный не позже начала окна
+    clock.now = 600
+    assert snapshot.refresh()['rate_window_seconds'] == 480
+    clock.now = 700
+    assert snapshot.refresh()['events_per_min'] == 0.0
+
+
+def test_get_answers_from_memory(clock):
+    db = FakeDb()
+    snapshot = StatsSnapshot(db, max_age=60, clock=clock)
+
+    async def run():
+        await snapshot.get()
+        clock.now = 30
+        await snapshot.get()
+        assert db.calls == 1
+        # Устаревший снимок отдается сразу, обновление идет в фоне
+        clock.now = 90
+        stale = await snapshot.get()
+        assert stale['rate_window_seconds'] == 0
+        await asyncio.sleep(0.1)
+        assert db.calls == 2
+
+    asyncio.run(run())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Тесты сегментации пользователей и снимков сегментов
+"""
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+import pytest
+
+from db import Database
+from user_segmentation import AUTOMATED_ACTIONS, UserSegmentation
+
+# user_id -> (источники сессий, событий, прошел диагностику)
+USERS = {
+    1: ([], 0, False),                                  # только /start — новичок
+    2: (['vk'], 2, True),                               # converter
+    3: (['telegram', 'telegram', 'direct'], 15, False),  # engaged
+    4: (['telegram'] * 4, 20, False),                   # engaged
+    5: (['vk'] * 6 + ['telegram'] * 4, 50, True),       # loyal
+    6: (['vk'], 1, False),                              # новичок с визитом
+}
+
+
+def seed(db, users=USERS, versions=True):
+    """Пользователи users с сессиями, событиями и диагностиками"""
+    conn = db.get_connection()
+    for user_id, (sources, events, diagnostics) in users.items():
+        conn.execute("INSERT INTO users (user_id, first_name) VALUES (?, 'U')", (user_id,))
+        session_ids = []
+        for source in sources:
+            cursor = conn.execute('INSERT INTO site_sessions (cookie_id, tg_user_id, source) VALUES (?, ?, ?)',
+                                  (f'ck{user_id}', user_id, source))
+            session_ids.append(cursor.lastrowid)
+        for i in range(events):
+            conn.execute("INSERT INTO site_events (session_id, tg_user_id, event_type, event_name) "
+                         "VALUES (?, ?, 'page_view', 'view')", (session_ids[i % len(session_ids)], user_id))
+        if diagnostics:
+            conn.execute("INSERT INTO diagnostics_results (tg_user_id, result_json) VALUES (?, '{}')", (user_id,))
+        if versions and (sources or diagnostics):
+            # Запись данных пользователя увеличивает его версию
+            conn.execute('INSERT INTO user_data_versions (tg_user_id, version) VALUES (?, 1)', (user_id,))
+    conn.commit()
+    conn.close()
+
+
+def make_segmentation(db):
+    seed(db)
+    return UserSegmentation(db.db_path)
+
+
+def test_snapshot_recomputes_only_changed_users(db):
+    segmentation = make_segmentation(db)
+    first = segmentation.build_segment_snapshot()
+    assert first['counts'] == {'newcomer': 2, 'converter': 1, 'engaged': 2, 'loyal': 1}
+    assert first['users'][1] == {'segment': 'newcomer', 'diagnostics_completed': False}
+    assert first['users'][2] == {'segment': 'converter', 'diagnostics_completed': True}
+
+    calls = []
+    get_segments_batch = segmentation.db.get_segments_batch
+    segmentation.db.get_segments_batch = lambda ids, **kwargs: calls.append(sorted(ids)) or get_segments_batch(ids, **kwargs)
+
+    # Без изменений данных снимок только читает user_segments
+    second = segmentation.build_segment_snapshot()
+    assert calls == [] and second['users'] == first['users'] and second['id'] != first['id']
+
+    # Пользователь 6 прошел диагностику — пересчитывается только он
+    conn = segmentation.db.get_connection()
+    conn.execute("INSERT INTO diagnostics_results (tg_user_id, result_json) VALUES (6, '{}')")
+    conn.execute('UPDATE user_data_versions SET version = version + 1 WHERE tg_user_id = 6')
+    conn.commit()
+    conn.close()
+    third = segmentation.build_segment_snapshot()
+    assert calls == [[6]]
+    assert third['users'][6] == {'segment': 'converter', 'diagnostics_completed': True}
+    assert third['counts'] == {'newcomer': 1, 'converter': 2, 'engaged': 2, 'loyal': 1}
+
+
+def test_segment_insights_on_fixture(db):
+    segmentation = make_segmentation(db)
+    conn = segmentation.db.get_connection()
+    conn.executemany('INSERT INTO user_preference_counters (tg_user_id, kind, value, count) VALUES (?, ?, ?, ?)', [
+        (3, 'content_type', 'article', 5), (3, 'content_type', 'video', 2), (4, 'content_type', 'article', 1),
+    ])
+    conn.commit()
+    conn.close()
+
+    engaged = segmentation.get_segment_insights('engaged')
+    assert engaged['users_count'] == 2
+    insights = engaged['insights']
+    # Сессий 3 + 4, событий 15 + 20; основной источник обоих — telegram
+    assert insights['avg_sessions'] == 3.5 and insights['avg_events'] == 17.5
+    assert insights['conversion_rate'] == 0
+    assert insights['top_sources'] == [('source_telegram', 2)]
+    assert insights['top_content_types'] == [('likes_article', 2), ('likes_video', 1)]
+    assert insights['engagement_distribution'] == {'medium': 2}
+
+    # У пользователя 5 сессий vk больше, чем telegram
+    loyal = segmentation.get_segment_insights('loyal')
+    assert loyal['users_count'] == 1
+    assert loyal['insights']['avg_sessions'] == 10 and loyal['insights']['avg_events'] == 50
+    assert loyal['insights']['conversion_rate'] == 1 and loyal['insights']['top_sources'] == [('source_vk', 1)]
+
+    assert segmentation.get_segment_insights('unknown') == {'segment': 'unknown', 'users_count': 0, 'insights': {}}
+
+
+def make_segmented(db, groups):
+    """БД с готовыми строками user_segments: groups — список (сегмент, диагностика, сколько)"""
+    segments = {}
+    for segment, diagnostics, count in groups:
+        for _ in range(count):
+            segments[len(segments) + 1] = {'segment': segment, 'engagement_level': 'medium',
+                                           'conversion_potential': 'high', 'diagnostics_completed': diagnostics}
+    conn = db.get_connection()
+    conn.executemany("INSERT INTO users (user_id, first_name) VALUES (?, 'U')", [(i,) for i in segments])
+    conn.commit()
+    conn.close()
+    # Версия 0 (данных нет) — инкрементальный проход не пересчитывает заданные вручную сегменты
+    db.save_user_segments(segments, {user_id: 0 for user_id in segments})
+    return UserSegmentation(db.db_path)
+
+
+def snapshot_rows(db):
+    conn = db.get_connection()
+    rows = conn.execute('SELECT id, users_count, segment_counts, duration_ms FROM segment_snapshots ORDER BY id').fetchall()
+    conn.close()
+    return [tuple(row) for row in rows]
+
+
+def test_save_segment_snapshot(db):
+    first = db.save_segment_snapshot({'newcomer': 2, 'loyal': 1}, 3, 12)
+    second = db.save_segment_snapshot({}, 0)
+    assert second > first
+    assert snapshot_rows(db) == [(first, 3, '{"newcomer": 2, "loyal": 1}', 12), (second, 0, '{}', None)]
+
+
+def test_build_segment_snapshot_reads_all_users(db):
+    segmentation = make_segmented(db, [('engaged', False, 2), ('converter', True, 1)])
+    # Пользователь без строки user_segments попадает в снимок новичком
+    conn = segmentation.db.get_connection()
+    conn.execute("INSERT INTO users (user_id, first_name) VALUES (4, 'U')")
+    conn.commit()
+    conn.close()
+
+    snapshot = segmentation.build_segment_snapshot()
+    assert snapshot['counts'] == {'engaged': 2, 'converter': 1, 'newcomer': 1}
+    assert snapshot['users'][4] == {'segment': 'newcomer', 'diagnostics_completed': False}
+    [(snapshot_id, users_count, counts, duration_ms)] = snapshot_rows(segmentation.db)
+    assert snapshot_id == snapshot['id'] and users_count == 4 and duration_ms >= 0
+    assert json.loads(counts) == snapshot['counts']
+
+
+def test_automated_actions_use_one_snapshot_and_limits(db):
+    segmentation = make_segmented(db, [
+        ('newcomer', False, 60),   # 1..60
+        ('engaged', True, 5),      # 61..65 — диагностика пройдена, напоминать не нужно
+        ('engaged', False, 40),    # 66..105
+        ('converter', True, 25),   # 106..130
+    ])
+    snapshots = []
+    build_segment_snapshot = segmentation.build_segment_snapshot
+    segmentation.build_segment_snapshot = lambda **kwargs: snapshots.append(kwargs) or build_segment_snapshot(**kwargs)
+    dispatched = []
+    segmentation._dispatch_action = lambda action, user_id: dispatched.append((action, user_id)) or action
+
+    result = segmentation.trigger_automated_actions(max_workers=2)
+
+    assert len(snapshots) == 1 and len(snapshot_rows(segmentation.db)) == 1
+    assert result['snapshot_id'] == snapshot_rows(segmentation.db)[0][0]
+    assert {key: result[key] for key in AUTOMATED_ACTIONS} == {
+        'welcome_messages': 50, 'diagnostic_reminders': 30, 'content_recommendations': 0, 'personal_offers': 20}
+    # Выборки берут пользователей по возрастанию user_id
+    by_action = {}
+    for action, user_id in dispatched:
+        by_action.setdefault(action, []).append(user_id)
+    assert sorted(by_action['welcome_messages']) == list(range(1, 51))
+    assert sorted(by_action['diagnostic_reminders']) == list(range(66, 96))
+    assert sorted(by_action['personal_offers']) == list(range(106, 126))
+    assert set(result['timings_ms']) == {'snapshot', 'select', 'dispatch'}
+    assert all(isinstance(value, int) and value >= 0 for value in result['timings_ms'].values())
+
+
+def segment_rows(db):
+    conn = db.get_connection()
+    rows = conn.execute('''
+        SELECT tg_user_id, segment, engagement_level, conversion_potential, diagnostics_completed
+        FROM user_segments ORDER BY tg_user_id
+    ''').fetchall()
+    conn.close()
+    return [tuple(row) for row in rows]
+
+
+@pytest.mark.parametrize('full', [False, True])
+def test_parallel_segments_match_serial(db, full):
+    segmentation = make_segmentation(db)
+    serial = segmentation.update_user_segments(full=full, workers=1)
+    serial_rows = segment_rows(db)
+    serial_again = segmentation.update_user_segments(workers=1)
+
+    conn = db.get_connection()
+    conn.execute('DELETE FROM user_segments')
+    conn.commit()
+    conn.close()
+
+    assert segmentation.update_user_segments(full=full, workers=2) == serial
+    assert segment_rows(db) == serial_rows != []
+    # Повторный прогон: оба режима считают пользователей обработанными
+    assert segmentation.update_user_segments(workers=2) == serial_again
+
+
+def test_worker_connections_are_read_only(db):
+    seed(db)
+    conn = Database(db.db_path, read_only=True).get_connection()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("INSERT INTO users (user_id, first_name) VALUES (100, 'U')")
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('migrated', [True, False])
+def test_data_from_before_versions_is_segmented(db, migrated):
+    path = db.db_path
+    # Сессии, события и диагностики записаны до появления user_data_versions
+    seed(db, versions=False)
+    if migrated:
+        conn = db.get_connection()
+        conn.execute('DROP TABLE user_data_versions')
+        conn.commit()
+        conn.close()
+        # Миграция создает таблицу и выставляет версию 1 пользователям с накопленными данными
+        db = Database(path)
+        assert db.get_user_data_versions(list(USERS)) == {1: 0, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1}
+
+    segmentation = UserSegmentation(path)
+    dispatched = []
+    segmentation._dispatch_action = lambda action, user_id: dispatched.append((action, user_id)) or action
+    result = segmentation.trigger_automated_actions()
+
+    assert segment_rows(segmentation.db) == [
+        (1, 'newcomer', 'low', 'low', 0), (2, 'converter', 'low', 'converted', 1),
+        (3, 'engaged', 'medium', 'high', 0), (4, 'engaged', 'medium', 'high', 0),
+        (5, 'loyal', 'high', 'converted', 1), (6, 'newcomer', 'low', 'low', 0),
+    ]
+    assert segmentation.get_segment_insights('converter')['users_count'] == 1
+    # Приветствие получают только новички, а не converter 2
+    assert sorted(user_id for action, user_id in dispatched if action == 'welcome_messages') == [1, 6]
+    assert result['personal_offers'] == 1
+
+
+def test_memberships_compute_users_without_segment_row(db):
+    seed(db)
+    memberships = db.get_segment_memberships()
+
+    # Строк user_segments еще нет: сегменты считаются по данным, новичок — только пользователь без данных
+    assert memberships == {
+        1: {'segment': 'newcomer', 'diagnostics_completed': False},
+        2: {'segment': 'converter', 'diagnostics_completed': True},
+        3: {'segment': 'engaged', 'diagnostics_completed': False},
+        4: {'segment': 'engaged', 'diagnostics_completed': False},
+        5: {'segment': 'loyal', 'diagnostics_completed': True},
+        6: {'segment': 'newcomer', 'diagnostics_completed': False},
+    }
+    # Рассчитанные сегменты сохранены с версиями данных — пересчитывать нечего
+    assert len(segment_rows(db)) == 6
+    assert db.refresh_dirty_segments()['processed'] == 0
+
+
+def test_segment_insights_agree_with_snapshot(db):
+    segmentation = make_segmentation(db)
+    # Один пользователь уже сегментирован — остальные все равно должны попасть в аналитику
+    segmentation.db.save_user_segments(segmentation.db.get_segments_batch([5]), {5: 1})
+    # Посетитель сайта с tg_user_id, которого нет в users, не участник сегментов
+    conn = segmentation.db.get_connection()
+    conn.execute("INSERT INTO site_sessions (cookie_id, tg_user_id, source) VALUES ('ck99', 99, 'vk')")
+    conn.execute('INSERT INTO user_data_versions (tg_user_id, version) VALUES (99, 1)')
+    conn.commit()
+    conn.close()
+
+    insights = {segment: segmentation.get_segment_insights(segment)['users_count']
+                for segment in ('newcomer', 'engaged', 'converter', 'loyal')}
+    assert insights == {'newcomer': 2, 'engaged': 2, 'converter': 1, 'loyal': 1}
+    assert segmentation.build_segment_snapshot()['counts'] == insights
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Тесты webhook сервера бота
+"""
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram-bot'))
+
+import pytest
+from telegram.ext import Application, MessageHandler, filters
+from telegram.request import BaseRequest
+
+from webhook import WebhookServer
+
+UPDATE = {'update_id': 7, 'message': {
+    'message_id': 1, 'date': 0, 'text': 'hi',
+    'chat': {'id': 42, 'type': 'private'}, 'from': {'id': 42, 'is_bot': False, 'first_name': 'U'},
+}}
+
+
+class StubRequest(BaseRequest):
+    """Bot API без сети: getMe отвечает ботом, остальные методы — True"""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        result = True
+        if url.endswith('/getMe'):
+            result = {'id': 123, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+def make_update(update_id):
+    return dict(UPDATE, update_id=update_id)
+
+
+def request(path, secret, body):
+    data = json.dumps(body).encode('utf-8')
+    return (f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n'
+            f'X-Telegram-Bot-Api-Secret-Token: {secret}\r\n\r\n').encode('ascii') + data
+
+
+async def exchange(writer, reader, payload):
+    writer.write(payload)
+    await writer.drain()
+    status_line = await reader.readline()
+    while (await reader.readline()) not in (b'\r\n', b''):
+        pass
+    return int(status_line.split()[1])
+
+
+def test_secret_and_path_are_checked_on_keepalive_connection():
+    application = Application.builder().token('123:TEST').build()
+
+    async def run():
+        server = WebhookServer(application, 'secret', path='/hook', host='127.0.0.1', port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        statuses = [
+            await exchange(writer, reader, request('/hook', 'wrong', UPDATE)),
+            await exchange(writer, reader, request('/other', 'secret', UPDATE)),
+            await exchange(writer, reader, request('/hook', 'secret', {'not': 'an update'})),
+            await exchange(writer, reader, request('/hook', 'secret', UPDATE)),
+        ]
+        writer.close()
+        await server.stop()
+        return statuses
+
+    assert asyncio.run(run()) == [403, 404, 400, 200]
+    update = application.update_queue.get_nowait()
+    assert update.update_id == 7 and update.message.chat.id == 42
+
+
+def test_invalid_secret_is_refused():
+    application = Application.builder().token('123:TEST').build()
+    with pytest.raises(ValueError):
+        WebhookServer(application, 'bad secret!')
+
+
+def test_accepted_updates_are_processed_on_stop():
+    handled = []
+
+    async def slow_handler(update, context):
+        await asyncio.sleep(0.1)
+        handled.append(update.update_id)
+
+    application = Application.builder().token('123:TEST').request(StubRequest()) \
+        .get_updates_request(StubRequest()).build()
+    application.add_handler(MessageHandler(filters.TEXT, slow_handler))
+
+    async def run():
+        server = WebhookServer(application, 'secret', path='/hook', host='127.0.0.1', port=0)
+        await application.initialize()
+        await application.start()
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        statuses = [await exchange(writer, reader, request('/hook', 'secret', make_update(update_id)))
+                    for update_id in (1, 2, 3)]
+        writer.close()
+        # Ответ 200 пришел сразу, обработка еще идет
+        pending = 3 - len(handled)
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        return statuses, pending
+
+    statuses, pending = asyncio.run(run())
+    assert statuses == [200, 200, 200] and pending > 0
+    assert handled == [1, 2, 3]
+
+
+def test_in_flight_request_finishes_before_server_closes():
+    application = Application.builder().token('123:TEST').build()
+
+    async def run():
+        server = WebhookServer(application, 'secret', path='/hook', host='127.0.0.1', port=0)
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        payload = request('/hook', 'secret', make_update(8))
+        split = payload.index(b'\r\n\r\n') + 4
+        # Заголовки отправлены, тело еще нет — запрос в полете
+        writer.write(payload[:split])
+        await writer.drain()
+        await asyncio.sleep(0.05)
+
+        stop = asyncio.ensure_future(server.stop(timeout=5))
+        await asyncio.sleep(0.05)
+        stopped_early = stop.done()
+        # Новые соединения уже не принимаются
+        with pytest.raises(OSError):
+            await asyncio.open_connection('127.0.0.1', server.port)
+
+        writer.write(payload[split:])
+        await writer.drain()
+        status = await exchange(writer, reader, b'')
+        await stop
+        writer.close()
+        return stopped_early, status
+
+    stopped_early, status = asyncio.run(run())
+    assert not stopped_early and status == 200
+    assert application.update_queue.get_nowait().update_id == 8